@@ -43,6 +43,8 @@ class Optitrack:
         # this is converted 2D state (x,y,heading) in track space
         self.state2d_list = []
         self.kf_state_list = []
+        # wall clock time (s) of the latest frame of each object
+        self.frame_time_list = []
         self.state_lock = Lock()
 
         # a mapping from internal id to optitrack id
@@ -127,6 +129,7 @@ class Optitrack:
             self.state_lock.acquire(timeout=0.01)
             self.state_list.append((x,y,z,rx,ry,rz))
             self.state2d_list.append((x_local,y_local,theta_local))
+            self.frame_time_list.append(time())
             if self.enableKF.isSet():
                 # (x,y,v,theta,omega)
                 self.kf_state_list.append((x_local,y_local,0,theta_local,0))
@@ -134,6 +137,7 @@ class Optitrack:
 
     # regular callback for state update
     def receiveRigidBodyFrame(self, optitrack_id, position, rotation ):
+        t_frame = time()
         #print( "Received frame for rigid body", id )
         internal_id = self.getInternalId(optitrack_id)
         x,y,z = position
@@ -159,6 +163,7 @@ class Optitrack:
         self.state_lock.acquire(timeout=0.01)
         self.state_list[internal_id] = (x,y,z,rx,ry,rz)
         self.state2d_list[internal_id] = (x_local,y_local,theta_local)
+        self.frame_time_list[internal_id] = t_frame
 
         if self.enableKF.isSet():
             # kf.getState() := (x,y,v,theta,omega)
@@ -202,6 +207,13 @@ class Optitrack:
             
         return retval
 
+    # wall clock time (s) the latest frame of an object was received, by internal id
+    def getFrameTime(self,internal_id):
+        self.state_lock.acquire(timeout=0.01)
+        retval = self.frame_time_list[internal_id]
+        self.state_lock.release()
+        return retval
+
     # get KF state by internal id
     def getKFstate(self,internal_id):
         self.kf[internal_id].predict(self.action)
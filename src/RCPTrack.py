@@ -21,7 +21,6 @@ import matplotlib.pyplot as plt
 from math import atan2,radians,degrees,sin,cos,pi,tan,copysign,asin,acos,isnan
 from scipy.interpolate import splprep, splev,CubicSpline,interp1d
 from scipy.optimize import minimize_scalar,minimize,brentq
-from scipy.integrate import solve_ivp
 from time import sleep,time
 import cv2
 from PIL import Image
@@ -29,8 +28,9 @@ from car import Car
 from Track import Track
 import pickle
 from common import *
-from bisect import bisect
 from timeUtil import execution_timer
+from racelineTable import RacelineTable
+from trackArtifact import artifactFilename,writeArtifact,readArtifact
 
 # debugging
 K_vec = [] # curvature
@@ -69,6 +69,16 @@ class RCPtrack(Track):
 
         # when localTrajectory is called multiple times, we need an initial guess for the parameter for raceline 
         self.last_u = None
+        # dense table of raceline points and derivatives sampled in u, see prepareProjectionTable()
+        # rebuilt when self.raceline changes
+        self.projection_table = None
+        self.projection_table_raceline = None
+        # table samples per unit u (one grid)
+        self.projection_table_density = 64
+        # uniform grid lookup tables along raceline, see racelineTable.py, built in reconstructRaceline()
+        self.raceline_table = None
+        # headless mode, never plot or block on plt.show(), e.g. for batch raceline optimization
+        self.headless = False
 
     def resolveLogname(self,):
 
@@ -377,52 +387,53 @@ class RCPtrack(Track):
         # first pass, based on lateral acceleration
         v1 = (mu*g/curvature)**0.5
 
-        dist = lambda a,b: ((a[0]-b[0])**2+(a[1]-b[1])**2)**0.5
+        # distance between consecutive steps, ds[i] is between xx[i] and xx[i+1]
+        r = np.array(splev(xx,self.raceline,der=0))
+        ds = _norm(np.diff(r,axis=1))
+
+        # the passes below are sequential scans where each step depends on the speed at the previous one
+        # they run on python floats, numpy overhead dominates for scalar steps
+        curvature_list = curvature.tolist()
+        v1_list = v1.tolist()
+        ds_list = ds.tolist()
+        mu_g_2 = (mu*g)**2
+
         # second pass, based on engine capacity and available longitudinal traction
         # start from the index with lowest speed
-        min_xx = np.argmin(v1)
-        v2 = np.zeros_like(v1)
-        v2[min_xx] = v1[min_xx]
+        min_xx = int(np.argmin(v1))
+        v2 = [0.0]*(n_steps+1)
+        v2[min_xx] = v1_list[min_xx]
         for i in range(min_xx,min_xx+n_steps):
+            i0 = i%n_steps
+            i1 = (i+1)%n_steps
             # lateral acc at next step if the car mainains speed
-            a_lat = v2[i%n_steps]**2*curvature[(i+1)%n_steps]
+            a_lat = v2[i0]**2*curvature_list[i1]
 
             # is there available traction for acceleration?
-            if ((mu*g)**2-a_lat**2)>0:
-                a_lon_available_traction = ((mu*g)**2-a_lat**2)**0.5
+            if (mu_g_2-a_lat**2)>0:
+                a_lon_available_traction = (mu_g_2-a_lat**2)**0.5
                 # constrain with motor capacity
-                a_lon = min(acc_max_motor(v2[i%n_steps]),a_lon_available_traction)
-
-                (x_i, y_i) = splev(xx[i%n_steps], self.raceline, der=0)
-                (x_i_1, y_i_1) = splev(xx[(i+1)%n_steps], self.raceline, der=0)
-                # distance between two steps
-                ds = dist((x_i, y_i),(x_i_1, y_i_1))
+                a_lon = min(acc_max_motor(v2[i0]),a_lon_available_traction)
                 # assume vehicle accelerate uniformly between the two steps
-                v2[(i+1)%n_steps] =  min((v2[i%n_steps]**2 + 2*a_lon*ds)**0.5,v1[(i+1)%n_steps])
+                v2[i1] =  min((v2[i0]**2 + 2*a_lon*ds_list[i0])**0.5,v1_list[i1])
             else:
-                v2[(i+1)%n_steps] =  v1[(i+1)%n_steps]
+                v2[i1] =  v1_list[i1]
 
         v2[-1]=v2[0]
         # third pass, backwards for braking
-        min_xx = np.argmin(v2)
-        v3 = np.zeros_like(v1)
+        min_xx = int(np.argmin(v2))
+        v3 = [0.0]*(n_steps+1)
         v3[min_xx] = v2[min_xx]
-        for i in np.linspace(min_xx,min_xx-n_steps,n_steps+2):
-            i = int(i)
-            a_lat = v3[i%n_steps]**2*curvature[(i-1+n_steps)%n_steps]
-            a_lon_available_traction = abs((mu*g)**2-a_lat**2)**0.5
-            a_lon = min(dec_max_motor(v3[i%n_steps]),a_lon_available_traction)
-            #print(a_lon)
-
-            (x_i, y_i) = splev(xx[i%n_steps], self.raceline, der=0)
-            (x_i_1, y_i_1) = splev(xx[(i-1+n_steps)%n_steps], self.raceline, der=0)
-            # distance between two steps
-            ds = dist((x_i, y_i),(x_i_1, y_i_1))
-            #print(ds)
-            v3[(i-1+n_steps)%n_steps] =  min((v3[i%n_steps]**2 + 2*a_lon*ds)**0.5,v2[(i-1+n_steps)%n_steps])
-            #print(v3[(i-1+n_steps)%n_steps],v2[(i-1+n_steps)%n_steps])
-            pass
-
+        for i in range(min_xx,min_xx-n_steps,-1):
+            i0 = i%n_steps
+            i1 = (i-1)%n_steps
+            a_lat = v3[i0]**2*curvature_list[i1]
+            a_lon_available_traction = abs(mu_g_2-a_lat**2)**0.5
+            a_lon = min(dec_max_motor(v3[i0]),a_lon_available_traction)
+            v3[i1] =  min((v3[i0]**2 + 2*a_lon*ds_list[i1])**0.5,v2[i1])
+
+        v2 = np.array(v2)
+        v3 = np.array(v3)
         v3[-1]=v3[0]
 
         # call with self.targetVfromU(u) alwayos u is in range [0,len(self.ctrl_pts)]
@@ -444,12 +455,22 @@ class RCPtrack(Track):
 
 
         # three pass of velocity profile
-        p0, = plt.plot(curvature, label='curvature')
-        p1, = plt.plot(v1,label='1st pass')
-        p2, = plt.plot(v2,label='2nd pass')
-        p3, = plt.plot(v3,label='3rd pass')
-        plt.legend(handles=[p1,p2,p3])
-        plt.show()
+        if not self.headless:
+            p0, = plt.plot(curvature, label='curvature')
+            p1, = plt.plot(v1,label='1st pass')
+            p2, = plt.plot(v2,label='2nd pass')
+            p3, = plt.plot(v3,label='3rd pass')
+            plt.legend(handles=[p1,p2,p3])
+            plt.show()
+
+    # theoretical laptime of current raceline and speed profile, same as t_total in verifySpeedProfile()
+    # without the acceleration analysis and printing, call after generateSpeedProfile()
+    def calcLaptime(self,n_steps=1000):
+        xx = np.linspace(0,self.track_length_grid,n_steps+1)
+        r = np.array(splev(xx,self.raceline,der=0))
+        ds = np.linalg.norm(np.diff(r,axis=1),axis=0)
+        v = self.targetVfromU(xx[:-1])
+        return np.sum(ds/v)
 
     def verifySpeedProfile(self,n_steps=1000):
         # calculate theoretical lap time
@@ -600,6 +621,7 @@ class RCPtrack(Track):
         return
 
     # save raceline to pickle file
+    # target velocity is stored as samples, not as an interp1d object
     def save(self,filename=None):
         if filename is None:
             filename = "raceline.p"
@@ -613,7 +635,8 @@ class RCPtrack(Track):
         save['raceline'] = self.raceline
         save['gridsize'] = self.gridsize
         save['resolution'] = self.resolution
-        save['targetVfromU'] = self.targetVfromU
+        save['targetV_u'] = np.linspace(0,self.track_length_grid,getattr(self,'n_steps',1000)+1)
+        save['targetV'] = np.asarray(self.targetVfromU(save['targetV_u']),dtype=np.float64)
         save['track'] = self.track
         save['min_v'] = self.min_v
         save['max_v'] = self.max_v
@@ -622,9 +645,19 @@ class RCPtrack(Track):
             pickle.dump(save,f)
         print_ok("track and raceline saved")
 
+    # load track file saved with save()
+    # everything derived from it is cached in a binary artifact next to it (see trackArtifact.py)
+    # keyed by the content hash of the track file, later loads memory map the artifact instead of rebuilding
     def load(self,filename=None):
         if filename is None:
             filename = "raceline.p"
+        # caches derived from this track file are stored next to it
+        self.raceline_filename = filename
+
+        artifact_filename = artifactFilename(filename)
+        if os.path.isfile(artifact_filename) and self.loadArtifact(artifact_filename):
+            print_ok("track and raceline loaded")
+            return
 
         with open(filename, 'rb') as f:
             save = pickle.load(f)
@@ -637,15 +670,91 @@ class RCPtrack(Track):
         self.raceline = save['raceline']
         self.gridsize = save['gridsize']
         #self.resolution = save['resolution']
-        self.targetVfromU = save['targetVfromU']
+        if 'targetVfromU' in save:
+            # files saved by older versions pickle the interp1d object
+            self.targetVfromU = save['targetVfromU']
+        else:
+            self.targetVfromU = interp1d(save['targetV_u'],save['targetV'],kind='cubic')
         self.track = save['track']
         self.min_v = save['min_v']
         self.max_v = save['max_v']
 
         print_ok("track and raceline loaded")
         self.reconstructRaceline()
+        # look up target velocity from the raceline table, same as after loading the artifact
+        self.targetVfromU = self.raceline_table.uToV
+        self.prepareProjectionTable()
+        self.saveArtifact(artifact_filename)
+        return
+
+    # save track, raceline and all tables derived from them, see trackArtifact.py
+    def saveArtifact(self,filename):
+        t,(cx,cy),k = self.raceline
+        ts,(csx,csy),ks = self.raceline_s
+        scalars = {
+                'grid_sequence':np.array(self.grid_sequence).tolist(),
+                'scale':float(self.scale),
+                'origin_seq_no':int(self.origin_seq_no),
+                'track_length_grid':int(self.track_length_grid),
+                'gridsize':[int(val) for val in self.gridsize],
+                'track':self.track,
+                'min_v':float(self.min_v),
+                'max_v':float(self.max_v),
+                'raceline_len_m':float(self.raceline_len_m),
+                'raceline_k':int(k),
+                'raceline_s_k':int(ks),
+                'projection_table_du':float(self.projection_table[0]),
+                'raceline_table_u_len':self.raceline_table.u_len,
+                'raceline_table_s_len':self.raceline_table.s_len,
+                }
+        arrays = {
+                'raceline_t':t,'raceline_cx':cx,'raceline_cy':cy,
+                'raceline_s_t':ts,'raceline_s_cx':csx,'raceline_s_cy':csy,
+                'projection_r':self.projection_table[1],
+                'projection_dr':self.projection_table[2],
+                'projection_ddr':self.projection_table[3],
+                }
+        # target velocity is not stored separately, it is looked up from v_of_s in the raceline table
+        arrays.update(self.raceline_table.arrays())
+        # boundary raster, see prepareBoundaryTiles()
+        if getattr(self,'boundary_tiles_track',None) is not self.track:
+            self.prepareBoundaryTiles()
+        arrays['boundary_tile_kind'],arrays['boundary_tile_apex'] = self.boundary_tiles
+        writeArtifact(filename,scalars,arrays)
+        print_ok("track artifact saved at "+filename)
         return
 
+    # return: True if loaded, False if filename is not an artifact of the current version
+    def loadArtifact(self,filename):
+        retval = readArtifact(filename)
+        if retval is None:
+            return False
+        scalars,arrays = retval
+
+        self.grid_sequence = scalars['grid_sequence']
+        self.scale = scalars['scale']
+        self.origin_seq_no = scalars['origin_seq_no']
+        self.track_length_grid = scalars['track_length_grid']
+        self.gridsize = tuple(scalars['gridsize'])
+        self.track = scalars['track']
+        self.min_v = scalars['min_v']
+        self.max_v = scalars['max_v']
+        self.raceline_len_m = scalars['raceline_len_m']
+        self.raceline = [arrays['raceline_t'],[arrays['raceline_cx'],arrays['raceline_cy']],scalars['raceline_k']]
+        self.raceline_s = [arrays['raceline_s_t'],[arrays['raceline_s_cx'],arrays['raceline_s_cy']],scalars['raceline_s_k']]
+
+        self.raceline_table = RacelineTable(scalars['raceline_table_u_len'],scalars['raceline_table_s_len'],*[arrays[name] for name in RacelineTable.table_names])
+        self.uToS = self.raceline_table.uToS
+        self.sToU = self.raceline_table.sToU
+        self.sToV = self.raceline_table.sToV
+        self.targetVfromU = self.raceline_table.uToV
+        self.boundary_tiles = (arrays['boundary_tile_kind'],arrays['boundary_tile_apex'])
+        self.boundary_tiles_track = self.track
+
+        self.projection_table = (scalars['projection_table_du'],arrays['projection_r'],arrays['projection_dr'],arrays['projection_ddr'])
+        self.projection_table_raceline = self.raceline
+        return True
+
     # calculate distance
     def calcPathDistance(self,u0,u1):
         s = 0
@@ -703,19 +812,9 @@ class RCPtrack(Track):
     # verify that we can restore x,y coordinate from K(s)/curvature path distance space
     def verify(self,K=None):
         # convert from K(s) space to X,Y(s) space using Fresnel integral
-        # state variable X,Y,Heading
         if K is None:
             K = self.K
-        K = interp1d(self.S,self.K)
-        def kensel(s,x):
-            return [ cos(x[2]), sin(x[2]), K(s)]
-
-        s_span = [0,self.S[-1]]
-        x0 = (self.x0,self.y0,self.phi0)
-        # error 0.02, lateral error
-        #sol = solve_ivp(kensel,s_span, x0, method='DOP853',t_eval = self.S )
-        # error 0.02, longitudinal error
-        sol = solve_ivp(kensel,s_span, x0, method='LSODA',t_eval = self.S )
+        x_k,y_k = self.kenselTransform(K,self.ds)
 
         # plot results
         # original path
@@ -723,13 +822,14 @@ class RCPtrack(Track):
         u = np.linspace(0,self.u[-1],steps)
         x,y = splev(u,self.raceline,der=0)
         # quantify error
-        error = ((x[-1]-sol.y[0,-1])**2 + (y[-1]-sol.y[1,-1])**2)**0.5
+        error = ((x[-1]-x_k[-1])**2 + (y[-1]-y_k[-1])**2)**0.5
         print("error %.2f"%error)
 
-        plt.plot(x,y)
-        # regenerated path
-        plt.plot(sol.y[0],sol.y[1])
-        plt.show()
+        if not self.headless:
+            plt.plot(x,y)
+            # regenerated path
+            plt.plot(x_k,y_k)
+            plt.show()
                 
         return
 
@@ -741,50 +841,110 @@ class RCPtrack(Track):
     # constrain >= 0
     # given coord=(x,y) unit:m
     # calculate distance to left/right boundary
-    # return min(wl, wr), distance to closest side
+    # return min(wl, wr), distance to closest side, in grid widths
+    # see trackBoundaryClearance() for many points at once
     def checkTrackBoundary(self,coord):
-        # figure out which grid the coord is in
-        # grid coordinate, (col, row), col starts from left and row starts from bottom, both indexed from 0
-        nondim= np.array(np.array(coord)/self.scale//1,dtype=np.int)
-        nondim[0] = np.clip(nondim[0],0,len(self.track)-1).astype(np.int)
-        nondim[1] = np.clip(nondim[1],0,len(self.track[0])-1).astype(np.int)
-
-        # e.g. 'WE','SE'
-        grid_type = self.track[nondim[0]][nondim[1]]
-
-        # change ref frame to tile local ref frame
-        x_local = coord[0]/self.scale - nondim[0]
-        y_local = coord[1]/self.scale - nondim[1]
+        clearance,_ = self.trackBoundaryClearance(np.array(coord,dtype=np.float64).reshape(1,2))
+        return clearance[0]/self.scale
+
+    # smoothing of |dK| in the smoothness term of cost(), 1/m
+    # the plain absolute value has a kink at dK = 0 where SLSQP's gradient based steps stall
+    SMOOTHNESS_EPS = 1e-3
+
+    # tile type codes used by trackBoundaryClearance()
+    TILE_NONE = 0
+    TILE_WE = 1
+    TILE_NS = 2
+    TILE_TURN = 3
+
+    # per tile arrays describing self.track, indexed (col,row) like self.track
+    # tile_kind: TILE_* code, tile_apex: apex of turn tiles in tile local frame
+    def prepareBoundaryTiles(self):
+        cols = len(self.track)
+        rows = len(self.track[0])
+        kind = np.zeros((cols,rows),dtype=np.int8)
+        apex = np.zeros((cols,rows,2))
+        apex_lookup = {'SE':(1,0),'SW':(0,0),'NE':(1,1),'NW':(0,1)}
+        for i in range(cols):
+            for j in range(rows):
+                grid_type = self.track[i][j]
+                if grid_type == 'WE':
+                    kind[i,j] = self.TILE_WE
+                elif grid_type == 'NS':
+                    kind[i,j] = self.TILE_NS
+                elif grid_type in apex_lookup:
+                    kind[i,j] = self.TILE_TURN
+                    apex[i,j] = apex_lookup[grid_type]
+        self.boundary_tiles = (kind,apex)
+        self.boundary_tiles_track = self.track
+        return
 
-        # find the distance to track sides
-        # boundary/wall width / grid side length
-        deadzone = 0.087
-        straights = ['WE','NS']
-        turns = ['SE','SW','NE','NW']
-        if grid_type in straights:
-            if grid_type == 'WE':
-                # track section is staight, arranged horizontally
-                # remaining space on top (negative means coord outside track
-                wl = y_local - deadzone
-                wr = 1 - deadzone - y_local
-            if grid_type == 'NS':
-                # track section is staight, arranged vertically
-                # remaining space on left (negative means coord outside track
-                wl = x_local - deadzone
-                wr = 1 - deadzone - x_local
-        elif grid_type in turns:
-            if grid_type == 'SE':
-                apex = (1,0)
-            if grid_type == 'SW':
-                apex = (0,0)
-            if grid_type == 'NE':
-                apex = (1,1)
-            if grid_type == 'NW':
-                apex = (0,1)
-            radius = ((x_local - apex[0])**2 + (y_local - apex[1])**2)**0.5
-            wl = 1-deadzone-radius
-            wr = radius - deadzone
-        return min(wl,wr)
+    # vectorized distance to both track sides
+    # coords: (n,2) x,y in meters
+    # deadzone: boundary/wall width / grid side length
+    # return: wall (n,2) distance to each of the two sides, in grid widths, negative outside track
+    #         grad (n,2,2) gradient of each w.r.t. coords, in grid widths per grid width
+    #         kind (n,) TILE_* code of the tile each point is on
+    #         points on tiles that are not part of the track get wall -1 and zero gradient
+    def trackBoundaryWalls(self,coords,deadzone=0.087):
+        if getattr(self,'boundary_tiles_track',None) is not self.track:
+            self.prepareBoundaryTiles()
+        kind_table,apex_table = self.boundary_tiles
+
+        local = np.asarray(coords,dtype=np.float64).reshape(-1,2)/self.scale
+        # grid coordinate, (col, row), col starts from left and row starts from bottom, both indexed from 0
+        col = np.clip(np.floor(local[:,0]).astype(np.int64),0,kind_table.shape[0]-1)
+        row = np.clip(np.floor(local[:,1]).astype(np.int64),0,kind_table.shape[1]-1)
+        kind = kind_table[col,row]
+        # tile local frame
+        local[:,0] -= col
+        local[:,1] -= row
+
+        # distance to the two sides, (n,2), and gradient of each, (n,2,2), all in grid widths
+        wall = np.full((local.shape[0],2),-1.0)
+        grad = np.zeros((local.shape[0],2,2))
+
+        # straight, arranged horizontally
+        mask = kind == self.TILE_WE
+        wall[mask,0] = local[mask,1] - deadzone
+        wall[mask,1] = 1 - deadzone - local[mask,1]
+        grad[mask,0,1] = 1.0
+        grad[mask,1,1] = -1.0
+
+        # straight, arranged vertically
+        mask = kind == self.TILE_NS
+        wall[mask,0] = local[mask,0] - deadzone
+        wall[mask,1] = 1 - deadzone - local[mask,0]
+        grad[mask,0,0] = 1.0
+        grad[mask,1,0] = -1.0
+
+        # turn, sides are arcs centered at the apex
+        mask = kind == self.TILE_TURN
+        radial = local[mask] - apex_table[col[mask],row[mask]]
+        radius = np.linalg.norm(radial,axis=1)
+        wall[mask,0] = 1 - deadzone - radius
+        wall[mask,1] = radius - deadzone
+        radial /= np.maximum(radius,1e-9)[:,np.newaxis]
+        grad[mask,0] = -radial
+        grad[mask,1] = radial
+        return wall,grad,kind
+
+    # vectorized distance to the closest track side, same geometry as checkTrackBoundary()
+    # coords: (...,2) x,y in meters
+    # deadzone: boundary/wall width / grid side length
+    # return: clearance (...,) in meters, negative outside track
+    #         gradient (...,2) of clearance w.r.t. coords
+    #         points on tiles that are not part of the track get clearance -scale and zero gradient
+    def trackBoundaryClearance(self,coords,deadzone=0.087):
+        coords = np.asarray(coords,dtype=np.float64)
+        shape = coords.shape[:-1]
+        wall,grad,_ = self.trackBoundaryWalls(coords,deadzone)
+
+        side = np.argmin(wall,axis=1)
+        index = np.arange(wall.shape[0])
+        clearance = wall[index,side]*self.scale
+        gradient = grad[index,side]
+        return clearance.reshape(shape),gradient.reshape(shape+(2,))
 
     # distance between start and end of path, 
     # must be sufficiently close
@@ -792,34 +952,57 @@ class RCPtrack(Track):
         return
 
     # convert from K(s) space to cartesian X,Y(s) space using Fresnel integral
-    def kenselTransform(self,K,ds):
+    # K is taken to be piecewise linear in s, so heading is integrated exactly with the trapezoidal rule
+    # and position with simpson's rule over each segment, all in closed form with cumulative sums
+    # K: (steps,) curvature at uniform interval ds
+    # jac: also return jacobian of x,y w.r.t. K
+    # return: x,y (steps,), and if jac, dx/dK, dy/dK (steps,steps)
+    def kenselTransform(self,K,ds,jac=False):
+        K = np.asarray(K,dtype=np.float64)
         steps = K.shape[0]
-        s_total = ds*(steps-1)
-        S = np.linspace(0,s_total,steps)
-        # state variable X,Y,Heading
-        Kfun = interp1d(S,K)
-        def kensel(s,x):
-            return [ cos(x[2]), sin(x[2]), Kfun(s)]
-
-        s_span = [0,s_total]
-        x0 = (self.x0,self.y0,self.phi0)
-        sol = solve_ivp(kensel,s_span, x0, method='LSODA',t_eval = S )
-        x = sol.y[0]
-        y = sol.y[1]
-        return x,y
+        # heading at each point
+        phi = self.phi0 + np.concatenate([[0],np.cumsum((K[:-1]+K[1:])*(ds/2))])
+        # heading at middle of each segment
+        psi = phi[:-1] + (3*K[:-1]+K[1:])*(ds/8)
+        cos_phi = np.cos(phi)
+        sin_phi = np.sin(phi)
+        cos_psi = np.cos(psi)
+        sin_psi = np.sin(psi)
+        x = self.x0 + np.concatenate([[0],np.cumsum((cos_phi[:-1] + 4*cos_psi + cos_phi[1:])*(ds/6))])
+        y = self.y0 + np.concatenate([[0],np.cumsum((sin_phi[:-1] + 4*sin_psi + sin_phi[1:])*(ds/6))])
+        if not jac:
+            return x,y
+
+        # dphi[i,m] = d phi_i / d K_m
+        # each segment j adds ds/2 to K_j and K_j+1 for all points after it
+        dseg = np.zeros((steps-1,steps))
+        index = np.arange(steps-1)
+        dseg[index,index] = ds/2
+        dseg[index,index+1] = ds/2
+        dphi = np.vstack([np.zeros((1,steps)),np.cumsum(dseg,axis=0)])
+        dpsi = dphi[:-1].copy()
+        dpsi[index,index] += 3*ds/8
+        dpsi[index,index+1] += ds/8
+        # derivative of each segment's increment
+        dx_seg = -(sin_phi[:-1,np.newaxis]*dphi[:-1] + 4*sin_psi[:,np.newaxis]*dpsi + sin_phi[1:,np.newaxis]*dphi[1:])*(ds/6)
+        dy_seg = (cos_phi[:-1,np.newaxis]*dphi[:-1] + 4*cos_psi[:,np.newaxis]*dpsi + cos_phi[1:,np.newaxis]*dphi[1:])*(ds/6)
+        dx = np.vstack([np.zeros((1,steps)),np.cumsum(dx_seg,axis=0)])
+        dy = np.vstack([np.zeros((1,steps)),np.cumsum(dy_seg,axis=0)])
+        return x,y,dx,dy
 
     # generate an array of boundary clearance
     def boundaryClearanceVector(self,k):
         x,y = self.kenselTransform(k,self.ds)
-        retval = [self.checkTrackBoundary((xx,yy)) for xx,yy in zip(x,y)]
-        # DEBUG
-        '''
-        for i in retval:
-            if i<0:
-                print("unmet constrain!")
-                break
-        '''
+        # same as checkTrackBoundary() on each point, in grid widths
+        clearance,_ = self.trackBoundaryClearance(np.vstack([x,y]).T)
+        retval = clearance/self.scale
         return retval
+
+    # jacobian of boundaryClearanceVector() w.r.t. k, (steps,steps)
+    def boundaryClearanceJac(self,k):
+        x,y,dx,dy = self.kenselTransform(k,self.ds,jac=True)
+        _,gradient = self.trackBoundaryClearance(np.vstack([x,y]).T)
+        return (gradient[:,0,np.newaxis]*dx + gradient[:,1,np.newaxis]*dy)/self.scale
         
     # calculate cost, among other things
     def cost(self,k):
@@ -845,13 +1028,37 @@ class RCPtrack(Track):
         # part 2: smoothness
         # relative importance of smoothness w.r.t curvature
         alfa = 1.0
-        p2_cost = np.sum(np.abs(np.diff(k)))
+        # |dk| smoothed as sqrt(dk^2+eps^2) so the cost is differentiable where dk = 0, see SMOOTHNESS_EPS
+        dk = np.diff(k)
+        p2_cost = np.sum(np.sqrt(dk*dk + self.SMOOTHNESS_EPS**2))
         total_cost = p1_cost + alfa*p2_cost
 
         #print("call %d, cost = %.5f"%(self.cost_count,total_cost))
         #print("p1/p2 = %.2f"%(p1_cost/p2_cost))
         return total_cost
 
+    # gradient of cost() w.r.t. k
+    def costJac(self,k):
+        k = np.array(k)
+        alfa = 1.0
+        dk = np.diff(k)
+        # derivative of the smoothed |dk|, tends to sign(dk) away from 0
+        slope = dk/np.sqrt(dk*dk + self.SMOOTHNESS_EPS**2)
+        grad = 2*k
+        grad[:-1] -= alfa*slope
+        grad[1:] += alfa*slope
+        return grad
+
+    # loop constraint of minimizeCurvatureRoutine(), curvature at start and finish must agree
+    def loopConstraint(self,k):
+        return k[-1]-k[0]
+
+    def loopConstraintJac(self,k):
+        jac = np.zeros(len(k))
+        jac[0] = -1
+        jac[-1] = 1
+        return jac
+
     def minimizeCurvatureRoutine(self,):
         steps = 100
         self.steps=steps
@@ -899,8 +1106,8 @@ class RCPtrack(Track):
         R_min = wheelbase / tan(max_steering)
         K_max = 1.0/R_min
         # track boundary
-        cons = [{'type': 'ineq', 'fun': self.boundaryClearanceVector}]
-        cons.append({'type': 'eq', 'fun': lambda x: x[-1]-x[0]})
+        cons = [{'type': 'ineq', 'fun': self.boundaryClearanceVector, 'jac': self.boundaryClearanceJac}]
+        cons.append({'type': 'eq', 'fun': self.loopConstraint, 'jac': self.loopConstraintJac})
 
         cons = tuple(cons)
 
@@ -910,12 +1117,12 @@ class RCPtrack(Track):
         bnds = tuple([(-K_max,K_max) for i in range(steps)])
 
         self.cost_count = 0
-        res = minimize(self.cost,K0,method='SLSQP', jac='2-point',constraints=cons,bounds=bnds,options={'maxiter':1000,'eps':1e-10} )
+        res = minimize(self.cost,K0,method='SLSQP', jac=self.costJac,constraints=cons,bounds=bnds,options={'maxiter':1000} )
         print(res)
         # verify again
         self.K = res.x
         print(self.K)
-        self.verify(steps)
+        self.verify()
 
     # ---------- for curvature norm minimization -----
 
@@ -1113,7 +1320,7 @@ class RCPtrack(Track):
         heading = state[2]
         # grid coordinate, (col, row), col starts from left and row starts from bottom, both indexed from 0
         # coord should be given in meters
-        nondim= np.array((coord/self.scale)//1,dtype=np.int)
+        nondim= np.array((coord/self.scale)//1,dtype=int)
 
         # distance squared, not need to find distance here
         dist_2 = lambda a,b: (a[0]-b[0])**2+(a[1]-b[1])**2
@@ -1164,54 +1371,17 @@ class RCPtrack(Track):
         #res = minimize_scalar(fun,bounds=[seq-0.6,seq+0.6],method='Bounded')
         #lt.e('minimize_scalar')
 
-        # improved method: from observation, fun(x) is quadratic in proximity of seq
-        # we assume it to be ax^3 + bx^2 + cx + d and formulate this minimization as a linalg problem
-        # sample some points to build the trinomial simulation
+        # table based method: search the precomputed table within seq +- 0.6
+        # then refine with newton's method, see projectToRaceline()
+        # this replaced a cubic fit of fun(x) minimized with L-BFGS-B on every call
         self.debug['seq'] = seq
-        iv = np.array([-0.6,-0.3,0,0.3,0.6])+seq
-        # formulate linear problem
-        A = np.vstack([iv**3, iv**2,iv,[1,1,1,1,1]]).T
-        #B = np.mat([fun(x0), fun(x1), fun(x2)]).T
-        B = fun(iv).T
-        #abc = np.linalg.solve(A,B)
-        abc = np.linalg.lstsq(A,B, rcond=-1)[0]
-        a = abc[0]
-        b = abc[1]
-        c = abc[2]
-        d = abc[3]
-        fun = lambda x : a*x*x*x + b*x*x + c*x + d
-        fit = minimize(fun, x0=seq, method='L-BFGS-B', bounds=((seq-0.6,seq+0.6),))
-        min_fun_x = fit.x[0]
+        min_fun_x = self.projectToRaceline(coord,seq,0.6)
         self.last_u = min_fun_x%self.track_length_grid
 
-        min_fun_val = fit.fun[0]
-        # find min val
-        #x = min_fun_x = (-b+(b*b-3*a*c)**0.5)/(3*a)
-        #if (seq-0.6<x<seq+0.6):
-        #    min_fun_val = a*x*x*x + b*x*x + c*x + d
-        #else:
-        #    # XXX this is a bit sketchy, maybe none of them is right
-        #    x = (-b+(b*b-3*a*c)**0.5)/(3*a)
-        #    min_fun_val = a*x*x*x + b*x*x + c*x + d
-
-        '''
-        xx = np.linspace(seq-0.6,seq+0.6)
-        plt.plot(xx,fun(xx),'b--')
-        plt.plot(iv,fun(iv),'bo')
-        plt.plot(xx,a*xx**3+b*xx**2+c*xx+d,'r-')
-        plt.plot(iv,a*iv**3+b*iv**2+c*iv+d,'ro')
-        plt.show()
-        '''
-
-        #lt.track('x err', abs(min_fun_x-res.x))
-        #lt.track('fun err',abs(min_fun_val-res.fun))
-        #print('x err', abs(min_fun_x-res.x))
-        #print('fun err',abs(min_fun_val-res.fun))
-
-        raceline_point = splev(min_fun_x%self.track_length_grid,self.raceline)
-        #raceline_point = splev(res.x,self.raceline)
+        # raceline point and derivatives from the same table, in place of three splev calls
+        raceline_point,der,vec_curvature = self.evaluateProjectionTable(min_fun_x)
+        min_fun_val = dist_2(raceline_point,coord)
 
-        der = splev(min_fun_x%self.track_length_grid,self.raceline,der=1)
         #der = splev(res.x,self.raceline,der=1)
 
         if (False):
@@ -1227,17 +1397,19 @@ class RCPtrack(Track):
         # negative offset means car is to the right of the trajectory
         vec_raceline = (der[0],der[1])
         vec_offset = coord - raceline_point
-        cross_theta = np.cross(vec_raceline,vec_offset)
+        cross_theta = vec_raceline[0]*vec_offset[1]-vec_raceline[1]*vec_offset[0]
 
 
-        vec_curvature = splev(min_fun_x%self.track_length_grid,self.raceline,der=2)
-        norm_curvature = np.linalg.norm(vec_curvature)
+        norm_curvature = (vec_curvature[0]**2+vec_curvature[1]**2)**0.5
         # gives right sign for omega, this is indep of track direction since it's calculated based off vehicle orientation
         #cross_curvature = np.cross((cos(heading),sin(heading)),vec_curvature)
         cross_curvature = der[0]*vec_curvature[1]-der[1]*vec_curvature[0]
 
         # return target velocity
-        request_velocity = self.targetVfromU(min_fun_x%self.track_length_grid)
+        if self.raceline_table is None:
+            request_velocity = self.targetVfromU(min_fun_x%self.track_length_grid)
+        else:
+            request_velocity = self.raceline_table.uToV(min_fun_x%self.track_length_grid)
 
         # reference point on raceline,lateral offset, tangent line orientation, curvature(signed), v_target(not implemented)
         if return_u:
@@ -1246,37 +1418,169 @@ class RCPtrack(Track):
             return (raceline_point,copysign(abs(min_fun_val)**0.5,cross_theta),atan2(der[1],der[0]),copysign(norm_curvature,cross_curvature),request_velocity)
 
 
+    # sample raceline and its first two derivatives densely in u, used by projectToRaceline()
+    def prepareProjectionTable(self):
+        du = 1.0/self.projection_table_density
+        uu = np.arange(0,self.track_length_grid,du)
+        r = np.array(splev(uu,self.raceline)).T
+        dr = np.array(splev(uu,self.raceline,der=1)).T
+        ddr = np.array(splev(uu,self.raceline,der=2)).T
+        self.projection_table = (du,r,dr,ddr)
+        self.projection_table_raceline = self.raceline
+        return
+
+    # raceline point, first and second derivative at u, from the projection table
+    # taylor expansion around the nearest sample, the second derivative of the cubic raceline spline
+    # is linear between samples (unless a knot falls in between), so this agrees with splev to well under 1e-6 grid
+    # return: three [x,y] lists
+    def evaluateProjectionTable(self,u):
+        if self.projection_table is None or not (self.projection_table_raceline is self.raceline):
+            self.prepareProjectionTable()
+        du,r,dr,ddr = self.projection_table
+        n = r.shape[0]
+        i = int(round(u/du))
+        h = u - i*du
+        # next sample in the direction of h, for the rate of change of the second derivative
+        j = (i+1)%n if h >= 0 else (i-1)%n
+        i %= n
+        rx,ry = r[i].tolist()
+        r1x,r1y = dr[i].tolist()
+        r2x,r2y = ddr[i].tolist()
+        r2x_next,r2y_next = ddr[j].tolist()
+        # third derivative, one sided
+        r3x = (r2x_next-r2x)/du*(1 if h >= 0 else -1)
+        r3y = (r2y_next-r2y)/du*(1 if h >= 0 else -1)
+        point = [rx + h*(r1x + h*(0.5*r2x + h*r3x/6)), ry + h*(r1y + h*(0.5*r2y + h*r3y/6))]
+        der = [r1x + h*(r2x + 0.5*h*r3x), r1y + h*(r2y + 0.5*h*r3y)]
+        dder = [r2x + h*r3x, r2y + h*r3y]
+        return point,der,dder
+
+    # find u of the raceline point closest to coord, within [seq-window,seq+window]
+    # starting from the table sample at seq, walk downhill on the sampled squared distance to the nearest local minimum
+    # the window may reach a different section of the raceline (e.g. across a hairpin) that is closer to coord,
+    # the local minimum is kept so u doesn't jump between sections, same as the previous local fit
+    # then refined with newton's method on the squared distance, using a second order expansion of the raceline at that sample
+    # return: u, not wrapped, so it stays close to seq
+    def projectToRaceline(self,coord,seq,window):
+        if self.projection_table is None or not (self.projection_table_raceline is self.raceline):
+            self.prepareProjectionTable()
+        du,r,dr,ddr = self.projection_table
+        n = r.shape[0]
+
+        i0 = int(np.floor((seq-window)/du))
+        i1 = int(np.ceil((seq+window)/du))
+        ids = np.arange(i0,i1+1)
+        diff = r[ids%n] - coord
+        dist = np.sum(diff*diff,axis=1)
+        k = min(max(int(np.rint(seq/du))-i0,0),len(ids)-1)
+        # descending: dist[i+1] < dist[i]
+        descending = dist[1:] < dist[:-1]
+        if k < len(ids)-1 and descending[k]:
+            # walk forward to the first sample after which distance no longer decreases
+            rising = np.flatnonzero(~descending[k:])
+            k = len(ids)-1 if rising.size == 0 else k + rising[0]
+        elif k > 0 and not descending[k-1]:
+            # walk backward
+            rising = np.flatnonzero(descending[:k][::-1])
+            k = 0 if rising.size == 0 else k - rising[0]
+        idx = ids[k]%n
+
+        # r(u0+h) ~= r0 + r1*h + r2*h^2/2, minimize |r(u0+h)-coord|^2 over h
+        # on python floats, numpy overhead dominates for 2d vectors
+        r0x,r0y = diff[k].tolist()
+        r1x,r1y = dr[idx].tolist()
+        r2x,r2y = ddr[idx].tolist()
+        h = 0.0
+        for i in range(3):
+            ex = r0x + r1x*h + 0.5*r2x*h*h
+            ey = r0y + r1y*h + 0.5*r2y*h*h
+            tx = r1x + r2x*h
+            ty = r1y + r2y*h
+            grad = ex*tx + ey*ty
+            hess = tx*tx + ty*ty + ex*r2x + ey*r2y
+            if hess <= 0:
+                break
+            h -= grad/hess
+            # the closest sample is within half a sample spacing of the minimum
+            h = min(max(h,-du),du)
+        u = ids[k]*du + h
+        return min(max(u,seq-window),seq+window)
+
+    # batched, stateless version of localTrajectory() for many poses at once
+    # does not read or update self.last_u
+    # states: (N,3) or longer, x,y,heading of each pose, in meters
+    # u_guess: optional (N,) initial estimate of u, e.g. from the previous call
+    #       if given, each pose only searches within u_guess +- window, otherwise the whole raceline is searched
+    # return: tuple of arrays, same quantities as localTrajectory(...,return_u=True), plus s
+    #       raceline_point (N,2), offset (N,), heading (N,), curvature (N,), v_target (N,), u (N,), s (N,)
+    #       all u are wrapped to [0,track_length_grid), so results are continuous across the lap seam
+    def localTrajectoryBatch(self,states,wheelbase=90e-3,u_guess=None,window=0.6):
+        if self.projection_table is None or not (self.projection_table_raceline is self.raceline):
+            self.prepareProjectionTable()
+        du,r,dr,ddr = self.projection_table
+        n = r.shape[0]
+
+        states = np.array(states,dtype=np.float64).reshape(-1,np.shape(states)[-1])
+        heading = states[:,2]
+        # center of front axle
+        coord = states[:,:2] + wheelbase*np.vstack([np.cos(heading),np.sin(heading)]).T
+
+        # index of closest table sample for each pose, processed in chunks to bound memory use
+        idx = np.empty(coord.shape[0],dtype=np.int64)
+        chunk = max(1,(1<<21)//n)
+        if u_guess is None:
+            for i in range(0,coord.shape[0],chunk):
+                diff = r[np.newaxis,:,:] - coord[i:i+chunk,np.newaxis,:]
+                idx[i:i+chunk] = np.argmin(np.sum(diff*diff,axis=2),axis=1)
+        else:
+            u_guess = np.array(u_guess,dtype=np.float64).reshape(-1)
+            offsets = np.arange(-int(np.ceil(window/du)),int(np.ceil(window/du))+1)
+            for i in range(0,coord.shape[0],chunk):
+                ids = (np.rint(u_guess[i:i+chunk]/du).astype(np.int64)[:,np.newaxis] + offsets) % n
+                diff = r[ids] - coord[i:i+chunk,np.newaxis,:]
+                k = np.argmin(np.sum(diff*diff,axis=2),axis=1)
+                idx[i:i+chunk] = ids[np.arange(ids.shape[0]),k]
+
+        # newton refinement on second order expansion at the closest sample, same as projectToRaceline()
+        r0 = r[idx] - coord
+        r1 = dr[idx]
+        r2 = ddr[idx]
+        h = np.zeros(coord.shape[0])
+        for i in range(3):
+            e = r0 + r1*h[:,np.newaxis] + 0.5*r2*(h*h)[:,np.newaxis]
+            t = r1 + r2*h[:,np.newaxis]
+            grad = np.sum(e*t,axis=1)
+            hess = np.sum(t*t,axis=1) + np.sum(e*r2,axis=1)
+            step = np.where(hess > 0,grad/np.where(hess > 0,hess,1.0),0.0)
+            h = np.clip(h - step,-du,du)
+        u = (idx*du + h) % self.track_length_grid
+
+        raceline_point = np.array(splev(u,self.raceline)).T
+        der = np.array(splev(u,self.raceline,der=1)).T
+        vec_curvature = np.array(splev(u,self.raceline,der=2)).T
+
+        # same sign conventions as localTrajectory()
+        vec_offset = coord - raceline_point
+        cross_theta = der[:,0]*vec_offset[:,1] - der[:,1]*vec_offset[:,0]
+        offset = np.copysign(np.linalg.norm(vec_offset,axis=1),cross_theta)
+        cross_curvature = der[:,0]*vec_curvature[:,1] - der[:,1]*vec_curvature[:,0]
+        curvature = np.copysign(np.linalg.norm(vec_curvature,axis=1),cross_curvature)
+        orientation = np.arctan2(der[:,1],der[:,0])
+        s = self.raceline_table.uToS(u)
+        v_target = self.raceline_table.sToV(s)
+        return (raceline_point,offset,orientation,curvature,v_target,u,s)
+
     # create two function to map between u(raceline parameter)<->s(distance along racelien)
     # also create mapping between s -> v_ref
     # also create raceline_s, raceline parameterized with s
     def reconstructRaceline(self):
-        s_vec = [0]
         n_steps = 1000
         uu = np.linspace(0,self.track_length_grid,n_steps+1)
-        dist = lambda a,b: ((a[0]-b[0])**2+(a[1]-b[1])**2)**0.5
-        path_len = 0
-        for i in range(n_steps):
-            (x_i, y_i) = splev(uu[i%n_steps], self.raceline, der=0)
-            (x_i_1, y_i_1) = splev(uu[(i+1)%n_steps], self.raceline, der=0)
-            # distance between two steps
-            ds = dist((x_i, y_i),(x_i_1, y_i_1))
-            path_len += ds
-            s_vec.append(path_len)
-
-        ss = np.array(s_vec)
-        vv = self.targetVfromU(uu%self.track_length_grid)
-
-        # using interp1d functions can cause some overhead
-        # when absolute speed is needed, use lookup tables
-        # this may lose some accuracy but with larger n_step
-        # and moderate change in velocity this should not be an issue
-        self.sToV_lut = lambda x: self.v_lut[bisect(self.s_lut,x)]
-        self.s_lut = ss
-        self.v_lut = vv
-
-        self.uToS = interp1d(uu,ss,kind='cubic')
-        self.sToU = interp1d(ss,uu,kind='cubic')
-        self.sToV = interp1d(ss,vv,kind='cubic')
+        # evaluate all steps at once, s is the cumulative distance between consecutive steps
+        rr = splev(uu%self.track_length_grid,self.raceline)
+        ds = np.linalg.norm(np.diff(np.array(rr),axis=1),axis=0)
+        ss = np.concatenate([[0],np.cumsum(ds)])
+        path_len = ss[-1]
         self.raceline_len_m = path_len
         #print("verify u and s mapping accuracy")
         #ss_remap = self.uToS(self.sToU(ss))
@@ -1285,9 +1589,14 @@ class RCPtrack(Track):
 
         # convert self.raceline(parameterized w.r.t. u) 
         # to self.raceline_s (parameterized w.r.t. s, distance along path)
-        rr = splev(uu%self.track_length_grid,self.raceline)
         tck, u = splprep(rr, u=ss,s=0,per=1) 
         self.raceline_s = tck
+
+        # interp1d has a large per call overhead, u<->s<->v conversions are looked up from uniform grid tables instead
+        self.raceline_table = RacelineTable.build(self.raceline,self.raceline_s,uu,ss,self.targetVfromU)
+        self.uToS = self.raceline_table.uToS
+        self.sToU = self.raceline_table.sToU
+        self.sToV = self.raceline_table.sToV
         return
 
     # get future reference point for dynamic MPC
@@ -1323,40 +1632,14 @@ class RCPtrack(Track):
 
         # calculate s value for projection ref points
         t.s("find s")
-        s0 = self.uToS(u0).item()
-        v0 = self.targetVfromU(u0%self.track_length_grid).item()
-        der = splev(u0%self.track_length_grid,self.raceline,der=1)
-        heading0 = atan2(der[1],der[0])
+        table = self.raceline_table
+        s0 = table.uToS(u0%self.track_length_grid)
+        v0 = table.sToV(s0)
+        heading0 = table.sToHeading(s0)
         t.e("find s")
 
-        t.s("curvature")
-        _norm = lambda x:np.linalg.norm(x,axis=0)
-        # gives right sign for omega, this is indep of track direction since it's calculated based off vehicle orientation
-
-        dr = np.array(splev(u0%self.track_length_grid,self.raceline,der=1))
-        ddr = vec_curvature = np.array(splev(u0%self.track_length_grid,self.raceline,der=2))
-        cross_curvature = der[0]*vec_curvature[1]-der[1]*vec_curvature[0]
-        curvature = 1.0/(_norm(dr)**3/(_norm(dr)**2*_norm(ddr)**2 - np.sum(dr*ddr,axis=0)**2)**0.5)
-
-        t.e("curvature")
-
-        # curvature needs to be signed to indicate whether signage target angular velocity
-        # a cross product gives right signage for omega, this is indep of track direction since it's calculated based off vehicle orientation
-        cross_curvature = der[0]*vec_curvature[1]-der[1]*vec_curvature[0]
-
-        #k_vec.append(norm_curvature)
-        #k_sign_vec.append(cross_curvature)
-        k_vec = curvature
-        k_sign_vec = cross_curvature
-
-
         s_vec = [s0]
         v_vec = [v0]
-        heading_vec = [heading0]
-        k_vec = [curvature]
-        k_sign_vec = [cross_curvature]
-
-        u_vec = [u0]
 
         t.s("main loop")
         for k in range(1,p+1):
@@ -1364,49 +1647,20 @@ class RCPtrack(Track):
             s_vec.append(s_k)
             # find ref velocity for projection ref points
             # TODO adjust ref velocity for current vehicle velocity
-            #v_k = self.targetVfromU(u_k%self.track_length_grid)
-            #v_k = self.sToV(s_k%self.raceline_len_m)
-            v_k = self.sToV_lut(s_k%self.raceline_len_m)
+            v_k = table.sToV(s_k)
             v_vec.append(v_k)
         t.e("main loop")
 
-        #u_vec = np.array(u_vec)%self.track_length_grid
-        # find ref heading for projection ref points
-        t.s("psi")
-        #der = np.array(splev(u_vec,self.raceline,der=1))
-        s_vec = np.array(s_vec)%self.raceline_len_m
-        der = np.array(splev(s_vec,self.raceline_s,der=1))
-        #heading_k = atan2(der[1],der[0])
-        #heading_vec.append(heading_k)
-        t.e("psi")
         # find ref coordinates for projection ref points
-
         t.s("coord")
-        coord_vec = np.array(splev(s_vec,self.raceline_s)).T
+        s_vec = np.array(s_vec)%self.raceline_len_m
+        coord_vec = table.sToPoint(s_vec)
         t.e("coord")
 
-        t.s("K")
-
-        #norm_curvature = np.linalg.norm(vec_curvature,axis=1)
-        dr = np.array(splev(s_vec,self.raceline_s,der=1))
-        ddr = vec_curvature = np.array(splev(s_vec,self.raceline_s,der=2))
-
-        curvature = 1.0/(_norm(dr)**3/(_norm(dr)**2*_norm(ddr)**2 - np.sum(dr*ddr,axis=0)**2)**0.5)
-
         # curvature needs to be signed to indicate whether signage target angular velocity
-        # a cross product gives right signage for omega, this is indep of track direction since it's calculated based off vehicle orientation
-        cross_curvature = der[0,:]*vec_curvature[1,:]-der[1,:]*vec_curvature[0,:]
-
-        #k_vec.append(norm_curvature)
-        #k_sign_vec.append(cross_curvature)
-        k_vec = curvature
-        k_sign_vec = cross_curvature
-
-
-
-
-        # TODO check dimension
-        k_signed_vec = np.copysign(k_vec,k_sign_vec)
+        # the table stores curvature signed by the cross product of r' and r'', this is indep of track direction
+        t.s("K")
+        k_signed_vec = table.sToCurvature(s_vec)
 
         x,y,heading,vf,vs,omega = state
         e_heading = ((heading - heading0) + pi/2.0 ) % (2*pi) - pi/2.0
@@ -1441,32 +1695,30 @@ class RCPtrack(Track):
             return None,None,False
 
         # calculate s value for projection ref points
-        s0 = self.uToS(u0).item()
-        v0 = self.targetVfromU(u0%self.track_length_grid).item()
-
-        _norm = lambda x:np.linalg.norm(x,axis=0)
-
-        s_vec = [s0]
-        v_vec = [v0]
+        s0 = self.raceline_table.uToS(u0%self.track_length_grid)
+        v0 = self.raceline_table.sToV(s0)
 
-        for k in range(1,p+1):
-            s_k = s_vec[-1] + v_vec[-1] * dt
-            s_vec.append(s_k)
-            # find ref velocity for projection ref points
-            # TODO adjust ref velocity for current vehicle velocity
-
-            # NOTE force v_k to be current velocity
-            #v_k = self.sToV_lut(s_k%self.raceline_len_m)
-            v_k = v0
-            v_vec.append(v_k)
-
-        # find ref heading for projection ref points
-        s_vec = np.array(s_vec)%self.raceline_len_m
+        # NOTE force v_k to be current velocity
+        # TODO adjust ref velocity for current vehicle velocity
+        s_vec = (s0 + v0*dt*np.arange(p+1))%self.raceline_len_m
         # find ref coordinates for projection ref points
-        coord_vec = np.array(splev(s_vec,self.raceline_s)).T
+        coord_vec = self.raceline_table.sToPoint(s_vec)
 
         return coord_vec
 
+    # predictOpponent() for several opponents in one call, uses localTrajectoryBatch() so self.last_u is left untouched
+    # states: (N,3) or longer, opponent vehicle states
+    # u_guess: optional (N,) u of each opponent from the previous call, plays the role of self.last_u
+    #       without it the whole raceline is searched and a pose may snap to a nearby section of the track
+    # return: (N,p+1,2), and (N,) u of each opponent if return_u is True
+    def predictOpponentBatch(self, states, p, dt, u_guess=None, return_u=False):
+        (_,_,_,_,v0,u0,s0) = self.localTrajectoryBatch(states,wheelbase=0.102/2.0,u_guess=u_guess)
+        # NOTE as in predictOpponent(), opponents keep the ref velocity at their current location
+        s_vec = (s0[:,np.newaxis] + v0[:,np.newaxis]*dt*np.arange(p+1)) % self.raceline_len_m
+        if return_u:
+            return self.raceline_table.sToPoint(s_vec),u0
+        return self.raceline_table.sToPoint(s_vec)
+
 
 # conver a world coordinate in meters to canvas coordinate
     def m2canvas(self,coord):
@@ -2,8 +2,19 @@ from car import Car
 from math import atan2,radians,degrees,sin,cos,pi,tan,copysign,asin,acos,isnan,exp,pi
 import numpy as np
 from time import time,sleep
+from threading import Thread,Event,Lock
+from collections import deque
 from timeUtil import execution_timer
 from mppi import MPPI
+from mppi_racecar import MppiRacecarCpu,cullOpponents,COLLISION_RADIUS,COLLISION_WINDOW
+from mppi_pool import MppiRacecarPool
+from noise_pool import NoisePool
+from raceline_index import RacelineIndex
+from frenet_raster import FrenetRaster
+from rollout_models import rollout_models
+from mppi_metrics import MppiMetrics
+from warm_start_library import WarmStartLibrary
+from ethCarSim import ethCarSim
 from scipy.interpolate import splprep, splev,CubicSpline,interp1d
 
 from common import *
@@ -21,7 +32,38 @@ class ctrlMppiWrapper(Car):
         # last_s is the last s such that R(last_s) is closest to vehicle
         # used as a starting point for root finding
         self.last_s = None
+        # same for each opponent, raceline parameter u found in last predictOpponent(), keyed by id(opponent)
+        self.opponent_u = {}
         self.p = execution_timer(True)
+        # cpu only: vehicle model for mppi rollouts, 'kinematic' or 'pacejka', see mppi/rollout_models.py
+        # None to pick in init(), pacejka when running in ethCarSim
+        self.rollout_model = car_setting.get('rollout_model',None)
+        # number of most recent steps kept in mppi sampling diagnostics (ess, cost stats ...), None to disable
+        # recording adds a pass over all samples every step, enable for tuning only
+        self.mppi_metrics_capacity = car_setting.get('mppi_metrics_capacity',None)
+        # async mode: mppi is solved continuously in a background thread against the latest state
+        # ctrlCar() returns immediately with the step of the freshest plan that corresponds to the current time
+        self.async_mode = car_setting.get('async_mode',False)
+        # wall clock time (s) self.state was measured, set by the state update routine in run.py
+        # None if unknown, the time ctrlCar() is called is used instead
+        self.state_time = None
+        # cpu only: number of worker processes to shard samples across, 1 to run in this process
+        # each car starts its own pool, e.g. os.cpu_count() when a single car is controlled with mppi
+        self.cpu_workers = car_setting.get('cpu_workers',1)
+        # cpu only: if set, samples_count is scaled with number of workers
+        self.cpu_samples_per_worker = car_setting.get('cpu_samples_per_worker',None)
+        # cpu only: seed for the pre-generated noise, set for reproducible runs
+        self.noise_seed = car_setting.get('noise_seed',None)
+        # cpu only: wall clock budget (s) for each mppi call, e.g. 0.8*dt
+        # when set, as many of the samples_count samples as time allows are evaluated
+        # None to always evaluate all samples
+        self.mppi_deadline = car_setting.get('mppi_deadline',None)
+        # cpu only: split samples_count into this many rounds, each round resamples around
+        # the mean and variance refined by the previous one (CEM style), 1 for plain mppi
+        # mppi_deadline is ignored when this is more than 1
+        self.mppi_iterations = car_setting.get('mppi_iterations',1)
+        # cpu only: fraction of best samples used to refine the distribution between rounds, None to use mppi weights
+        self.mppi_elite_fraction = car_setting.get('mppi_elite_fraction',None)
         return
 
     # if running on real platform, set sim to None so that default values for car dimension/properties will be used
@@ -43,14 +85,90 @@ class ctrlMppiWrapper(Car):
         #self.noise_cov = np.diag([(1.0/2)**2,radians(30.0/2)**2])
         self.control_limit = np.array([[-self.max_throttle,self.max_throttle],[-radians(27.1),radians(27.1)]])
 
+        # look up s and lateral offset from a precomputed raster in rollout costs
+        # instead of searching for the closest raceline point, the raster is cached next to the track file
+        self.use_frenet_raster = True
         self.prepareDiscretizedRaceline()
 
-        self.mppi = MPPI(self.samples_count,self.horizon_steps,self.state_dim,self.control_dim,self.temperature,self.mppi_dt,self.noise_cov,self.discretized_raceline,cuda=True,cuda_filename="mppi/mppi_racecar.cu")
+        # use cuda if available, otherwise fall back to the vectorized cpu implementation
+        try:
+            import pycuda
+            self.cuda = True
+        except ImportError:
+            print_warning("pycuda not available, running mppi on cpu")
+            self.cuda = False
+
+        if not self.cuda and not (self.cpu_samples_per_worker is None):
+            self.samples_count = self.cpu_samples_per_worker * self.cpu_workers
+        if self.rollout_model is None:
+            self.rollout_model = 'pacejka' if isinstance(sim,ethCarSim) else 'kinematic'
+        if self.cuda and self.rollout_model != 'kinematic':
+            print_warning("cuda kernel only supports kinematic rollout model")
+
+        collision_macros = {"COLLISION_RADIUS":COLLISION_RADIUS,"COLLISION_WINDOW":COLLISION_WINDOW}
+        self.mppi = MPPI(self.samples_count,self.horizon_steps,self.state_dim,self.control_dim,self.temperature,self.mppi_dt,self.noise_cov,self.discretized_raceline,cuda=self.cuda,cuda_filename="mppi/mppi_racecar.cu",frenet_raster=self.frenet_raster,cuda_macros=collision_macros)
+        # bound on ego acceleration magnitude (m/s2) used to cull opponents, see cullOpponents() in mppi_racecar.py
+        self.collision_reach_accel = 20.0
+        self.mppi.opponent_filter = lambda state,opponents: cullOpponents(state,opponents,self.mppi_dt,self.collision_reach_accel)
+        if not self.cuda:
+            rollout_model = rollout_models[self.rollout_model]()
+            if self.cpu_workers > 1:
+                self.mppi.cpu_evaluator = MppiRacecarPool(self.samples_count,self.horizon_steps,self.control_dim,self.state_dim,self.mppi_dt,self.discretized_raceline,worker_count=self.cpu_workers,frenet_raster=self.frenet_raster,rollout_model=rollout_model,slot_count=4)
+            else:
+                self.mppi.cpu_evaluator = MppiRacecarCpu(self.samples_count,self.horizon_steps,self.control_dim,self.state_dim,self.mppi_dt,self.discretized_raceline,frenet_raster=self.frenet_raster,rollout_model=rollout_model)
+            # with a process pool, noise is generated directly in the pool's shared memory
+            noise_buffer = getattr(self.mppi.cpu_evaluator,'epsilon_slots',None)
+            self.mppi.noise_pool = NoisePool(self.samples_count,self.horizon_steps,self.control_dim,self.noise_cov,seed=self.noise_seed,buffer=noise_buffer)
+            self.mppi.deadline = self.mppi_deadline
+            self.mppi.iterations = self.mppi_iterations
+            self.mppi.elite_fraction = self.mppi_elite_fraction
+            if not (self.noise_seed is None):
+                self.mppi.rng = np.random.default_rng(self.noise_seed)
+
+        if self.mppi_metrics_capacity is None:
+            self.mppi.metrics = None
+        else:
+            self.mppi.metrics = MppiMetrics(self.control_dim,self.mppi_metrics_capacity)
+
+        # seed mppi warm start with control sequences converged here on previous laps (and sessions)
+        # after a reset or a jump in s, see mppi/warm_start_library.py, the library is saved next to the track file
+        self.use_warm_start_library = True
+        # a sequence is recorded only after this many consecutive solves since last reset
+        self.warm_start_settle_steps = 10
+        # a change in s (m) larger than this between consecutive solves is treated as a reset
+        self.warm_start_jump = 0.3
+        if self.use_warm_start_library:
+            self.warm_start_library = WarmStartLibrary.fromTrack(self.track,self.horizon_steps,self.control_dim,self.mppi_dt,tag=self.rollout_model)
+        else:
+            self.warm_start_library = None
+        # s of last solve and number of solves since last reset
+        self.warm_start_s = None
+        self.warm_start_age = 0
 
         self.mppi.applyDiscreteDynamics = self.applyDiscreteDynamics
         self.mppi.evaluateStepCost = self.evaluateStepCost
         self.mppi.evaluateTerminalCost = self.evaluateTerminalCost
 
+        # latency compensation: mppi solves from the state predicted at the time the new command takes effect
+        # the measured state is integrated forward with rollout model using commands already sent
+        # on by default on real platform only, in simulation the state is not advanced during the solve
+        self.latency_compensation = sim is None
+        # delay (s) between command leaving ctrlCar() and taking effect on the car, e.g. serial write and actuator response
+        self.actuation_delay = 0.0
+        # fixed delay (s) from state measurement to command taking effect
+        # None to use measured state age + solve time estimate + actuation_delay
+        self.latency = None
+        # running estimate of ctrlCar() solve time (s), exponentially weighted
+        self.solve_time_estimate = None
+        self.solve_time_forget = 0.9
+        # (time sent,throttle,steering) of recent commands
+        self.command_history = deque(maxlen=50)
+        self.latency_model = rollout_models[self.rollout_model]()
+
+        # solver thread for async mode, see __init__()
+        if self.async_mode:
+            self.startAsync()
+
         if (sim is None):
             g = 9.81
             self.m = 0.1667
@@ -85,6 +203,11 @@ class ctrlMppiWrapper(Car):
         self.raceline_headings = heading_vec
         self.raceline_velocity = vv
         self.discretized_raceline = np.vstack([self.raceline_points,self.raceline_headings,vv]).T
+        self.raceline_index = RacelineIndex(self.raceline_points.T)
+        if self.use_frenet_raster:
+            self.frenet_raster = FrenetRaster.fromTrack(self.track)
+        else:
+            self.frenet_raster = None
         return
 
 # given state of the vehicle and an instance of track, provide throttle and steering output
@@ -93,6 +216,7 @@ class ctrlMppiWrapper(Car):
 #   track: track object, can be RCPtrack or skidpad
 #   v_override: If specified, use this as target velocity instead of the optimal value provided by track object
 #   reverse: true if running in opposite direction of raceline init direction
+#   state_time: wall clock time (s) state was measured, for latency compensation, None to use current time
 
 # output:
 #   (throttle,steering,valid,debug) 
@@ -102,13 +226,266 @@ class ctrlMppiWrapper(Car):
 #   valid: bool, if the car can be controlled here, if this is false, then throttle will also be set to 0
 #           This typically happens when vehicle is off track, and track object cannot find a reasonable local raceline
 # debug: a dictionary of objects to be debugged, e.g. {offset, error in v}
-    def ctrlCar(self,state,track,v_override=None,reverse=False):
+    def ctrlCar(self,state,track,v_override=None,reverse=False,state_time=None):
+        if self.async_mode:
+            return self.ctrlCarAsync(state,track,state_time)
         p = self.p
         p.s()
+        t_start = time()
+        if state_time is None:
+            state_time = t_start
         # get an estimate for current distance along raceline
         debug_dict = {'x_ref_r':[],'x_ref_l':[],'x_ref':[],'crosstrack_error':[],'heading_error':[]}
 
+        p.s("prep")
+        state = self.prepareMppiState(state,track,debug_dict)
+        if not (state is None) and self.latency_compensation:
+            state = self.predictState(state,state_time,t_start)
+        t_prep = p.e("prep")
+        if state is None:
+            p.e()
+            return (0,0,False,debug_dict)
+
+        p.s("mppi")
+        self.seedWarmStart(state)
+        uu = self.mppi.control(state.copy(),self.opponent_prediction,self.control_limit)
+        t_mppi = p.e("mppi")
+
+        p.s("debug")
+        ret = self.finishMppiControl(state,uu,debug_dict)
+        t_debug = p.e("debug")
+        # durations are None if timer is disabled
+        if not (t_prep is None):
+            self.updateSolveTime(t_prep+t_mppi+t_debug)
+        self.command_history.append((time(),ret[0],ret[1]))
+        p.e()
+        return ret
+
+    # expected delay (s) from state measurement to the next command taking effect
+    # t_measure: time the state was measured
+    # t_start: time the solve for the next command started, the state has already aged t_start-t_measure by then
+    def expectedLatency(self,t_measure,t_start):
+        if not (self.latency is None):
+            return self.latency
+        age = max(t_start - t_measure,0.0)
+        if self.solve_time_estimate is None:
+            return age + self.actuation_delay
+        return age + self.solve_time_estimate + self.actuation_delay
+
+    def updateSolveTime(self,duration):
+        if self.solve_time_estimate is None:
+            self.solve_time_estimate = duration
+        else:
+            self.solve_time_estimate = self.solve_time_forget*self.solve_time_estimate + (1-self.solve_time_forget)*duration
+        self.p.track("solve time estimate",self.solve_time_estimate)
+        return
 
+    # predict where the car will be when the next command takes effect
+    # state: mppi state (x,dx,y,dy,heading,omega) measured at t_measure
+    # each sent command is assumed to take effect actuation_delay after it was sent and hold until the next one does
+    def predictState(self,state,t_measure,t_start):
+        latency = self.expectedLatency(t_measure,t_start)
+        if latency <= 0 or len(self.command_history) == 0:
+            return state
+        # time each command takes effect
+        t_effect = np.array([entry[0] for entry in self.command_history]) + self.actuation_delay
+        commands = np.array([entry[1:] for entry in self.command_history],dtype=np.float32)
+
+        x = np.array(state,dtype=np.float32)
+        t = t_measure
+        t_end = t_measure + latency
+        while t < t_end:
+            # command in effect at t, the oldest known command if none has taken effect yet
+            i = max(np.searchsorted(t_effect,t,side='right')-1,0)
+            t_next = t_effect[i+1] if i+1 < len(t_effect) else t_end
+            dt = min(t_next,t_end,t+self.mppi_dt) - t
+            if dt <= 0:
+                break
+            self.latency_model.advance(x,commands[i],dt)
+            t += dt
+        self.p.track("latency",latency)
+        return x.astype(np.float64)
+
+    def startAsync(self):
+        # latest state from ctrlCar(), (timestamp,state)
+        self.async_state = None
+        self.async_state_lock = Lock()
+        self.async_new_state = Event()
+        # freshest solved plan, (timestamp of the state it was solved from, control sequence (T,m), debug_dict)
+        # control sequence is None if that state couldn't be solved for
+        self.async_plan = None
+        self.async_plan_lock = Lock()
+        # age (s) of the plan used in last call to ctrlCar()
+        self.plan_age = None
+        self.async_exit_request = Event()
+        self.async_thread = Thread(target=self.asyncSolveLoop,daemon=True)
+        self.async_thread.start()
+        return
+
+    def stopAsync(self):
+        if not self.async_mode:
+            return
+        self.async_exit_request.set()
+        self.async_new_state.set()
+        self.async_thread.join()
+        return
+
+    # stop background solver, noise generation and worker processes, call before exiting
+    def close(self):
+        self.stopAsync()
+        if not (self.mppi.noise_pool is None):
+            self.mppi.noise_pool.close()
+        if hasattr(self.mppi.cpu_evaluator,'close'):
+            self.mppi.cpu_evaluator.close()
+        return
+
+    # background thread, solve mppi whenever a new state is available
+    def asyncSolveLoop(self):
+        if self.cuda:
+            # cuda context is bound to the thread that created it
+            import pycuda.autoinit
+            pycuda.autoinit.context.push()
+
+        # state timestamp of last successful solve, the one self.mppi.old_ref_control was solved for
+        t_solved = None
+        while not self.async_exit_request.isSet():
+            self.async_new_state.wait()
+            self.async_new_state.clear()
+            if self.async_exit_request.isSet():
+                break
+            with self.async_state_lock:
+                t_state,state = self.async_state
+
+            debug_dict = {'x_ref_r':[],'x_ref_l':[],'x_ref':[],'crosstrack_error':[],'heading_error':[]}
+            mppi_state = self.prepareMppiState(state,self.track,debug_dict)
+            if mppi_state is None:
+                # no usable plan for this state, ctrlCarAsync() reports invalid until the next successful solve
+                with self.async_plan_lock:
+                    self.async_plan = (t_state,None,debug_dict)
+                continue
+
+            # warm start: control() shifts the last plan by one step,
+            # shift the rest if more than one mppi step passed since last successful solve
+            if not (t_solved is None):
+                steps = int((t_state - t_solved)/self.mppi_dt)
+                if steps > 1:
+                    old = self.mppi.old_ref_control
+                    steps = min(steps-1,self.horizon_steps)
+                    old[:self.horizon_steps-steps] = old[steps:]
+                    old[self.horizon_steps-steps:] = 0.0
+            self.seedWarmStart(mppi_state)
+
+            uu = self.mppi.control(mppi_state.copy(),self.opponent_prediction,self.control_limit)
+            self.finishMppiControl(mppi_state,uu,debug_dict)
+            t_solved = t_state
+            with self.async_plan_lock:
+                self.async_plan = (t_state,uu,debug_dict)
+
+        if self.cuda:
+            pycuda.autoinit.context.pop()
+        return
+
+    # async counterpart of ctrlCar()
+    # hand latest state to the solver thread, apply the freshest plan with zero-order hold
+    def ctrlCarAsync(self,state,track,state_time=None):
+        p = self.p
+        p.s()
+        now = time()
+        if state_time is None:
+            state_time = now
+        with self.async_state_lock:
+            self.async_state = (state_time,np.array(state))
+        self.async_new_state.set()
+
+        with self.async_plan_lock:
+            plan = self.async_plan
+        if plan is None:
+            # no plan solved yet
+            p.e()
+            return (0,0,False,{'x_ref':[],'plan_age':None})
+
+        t_plan,uu,debug_dict = plan
+        self.plan_age = now - t_plan
+        if uu is None:
+            # solver couldn't handle the latest state
+            debug_dict = dict(debug_dict)
+            debug_dict['plan_age'] = self.plan_age
+            p.e()
+            return (0,0,False,debug_dict)
+        # step of the plan the current time falls in, hold the last step if plan is older than the horizon
+        step = min(int(self.plan_age/self.mppi_dt),self.horizon_steps-1)
+        throttle,steering = uu[step]
+        debug_dict = dict(debug_dict)
+        debug_dict['plan_age'] = self.plan_age
+        p.track("plan age",self.plan_age)
+        p.e()
+        return (throttle,steering,True,debug_dict)
+
+    # settings MPPI.controlBatch() takes from the first car of a batch and applies to all of them
+    # cars with different keys, e.g. a different max_throttle, are solved in separate batches
+    def mppiBatchKey(self):
+        mppi = self.mppi
+        return (self.rollout_model,np.asarray(self.control_limit).tobytes(),np.asarray(mppi.noise_cov).tobytes(),
+                mppi.temperature,mppi.K,mppi.T,mppi.dt,mppi.deadline)
+
+    # solve mppi for several cars in one batched pass, see MPPI.controlBatch()
+    # cars: list of ctrlMppiWrapper, all on the same track
+    #       cars are grouped by mppiBatchKey(), each group is one batch
+    #       each car's car.state (measured at car.state_time) is used
+    # return: list of (throttle,steering,valid,debug), one for each car, same as ctrlCar()
+    @staticmethod
+    def ctrlCarBatch(cars):
+        t_start = time()
+        debug_dicts = []
+        states = []
+        for car in cars:
+            debug_dict = {'x_ref_r':[],'x_ref_l':[],'x_ref':[],'crosstrack_error':[],'heading_error':[]}
+            debug_dicts.append(debug_dict)
+            state = car.prepareMppiState(car.state,car.track,debug_dict)
+            if not (state is None) and car.latency_compensation:
+                state = car.predictState(state,t_start if car.state_time is None else car.state_time,t_start)
+            states.append(state)
+
+        # cars whose local trajectory can't be found are not controlled
+        solve_ids = [i for i in range(len(cars)) if not (states[i] is None)]
+        rets = [(0,0,False,debug_dict) for debug_dict in debug_dicts]
+        if len(solve_ids) == 0:
+            return rets
+
+        # cars are solved together only if they agree on everything the batch shares, see mppiBatchKey()
+        groups = {}
+        for i in solve_ids:
+            cars[i].seedWarmStart(states[i])
+            # iterative refinement is not batched, solve these cars one at a time
+            if cars[i].mppi.iterations > 1:
+                uu = cars[i].mppi.control(states[i].copy(),cars[i].opponent_prediction,cars[i].control_limit)
+                rets[i] = cars[i].finishMppiControl(states[i],uu,debug_dicts[i])
+                continue
+            groups.setdefault(cars[i].mppiBatchKey(),[]).append(i)
+
+        for ids in groups.values():
+            # the first car's solver is shared, each car keeps its own warm start
+            mppi = cars[ids[0]].mppi
+            uus = mppi.controlBatch([states[i] for i in ids],
+                    [cars[i].opponent_prediction for i in ids],
+                    cars[ids[0]].control_limit,
+                    [cars[i].mppi.old_ref_control for i in ids],
+                    metrics=[cars[i].mppi.metrics for i in ids])
+            for i,uu in zip(ids,uus):
+                cars[i].mppi.old_ref_control[:] = uu
+                rets[i] = cars[i].finishMppiControl(states[i],uu,debug_dicts[i])
+
+        # every car waits for the whole batch
+        t_sent = time()
+        for i in solve_ids:
+            cars[i].updateSolveTime(t_sent-t_start)
+            cars[i].command_history.append((t_sent,rets[i][0],rets[i][1]))
+        return rets
+
+    # convert vehicle state to mppi state and predict opponents
+    # state: (x,y,heading,v_forward,v_sideway,omega)
+    # return: mppi state (x,dx,y,dy,heading,omega), None if the car can't be controlled
+    def prepareMppiState(self,state,track,debug_dict):
         try:
             self.predictOpponent()
             debug_dict['opponent'] = self.opponent_prediction
@@ -118,20 +495,16 @@ class ctrlMppiWrapper(Car):
         #e_cross, e_heading, v_ref, k_ref, coord_ref, valid = track.getRefPoint(state, 3, 0.01, reverse=reverse)
         #debug_dict['crosstrack_error'] = e_cross
         #debug_dict['heading_error'] = e_heading
-        p.s("local traj")
         if self.last_s is None:
             retval = track.localTrajectory(state,wheelbase=0.102/2.0,return_u=True)
             if retval is None:
                 print_warning("localTrajectory returned None")
-                ret =  (0,0,False,debug_dict)
-                return ret
+                return None
             else:
                 # parse return value from localTrajectory
                 (local_ctrl_pnt,offset,orientation,curvature,v_target,u0) = retval
                 self.last_s = track.uToS(u0).item()
-        p.e("local traj")
 
-        p.s("prep")
         s0 = self.last_s
         # vehicle state
         # vf: forward positive
@@ -141,22 +514,53 @@ class ctrlMppiWrapper(Car):
         dy = vf*sin(heading) + vs*cos(heading)
 
         self.states = np.array([x,dx,y,dy,heading,omega])
-        state = np.array([x,dx,y,dy,heading,omega])
+        return np.array([x,dx,y,dy,heading,omega])
+
+    # s along raceline of mppi state (x,dx,y,dy,heading,omega)
+    def raceS(self,state):
+        if not (self.frenet_raster is None):
+            s,_,_ = self.frenet_raster.query(state[0],state[2])
+            return float(s)
+        return self.ss[self.findClosestIds(state)]
+
+    # after a reset (no previous plan, or s jumped) replace mppi warm start with the library entry nearest to current s
+    # call right before mppi.control()
+    def seedWarmStart(self,state):
+        if self.warm_start_library is None:
+            return
+        s = self.raceS(state)
+        reset = not np.any(self.mppi.old_ref_control)
+        if not (self.warm_start_s is None):
+            half = self.track.raceline_len_m/2
+            ds = (s - self.warm_start_s + half)%self.track.raceline_len_m - half
+            reset = reset or abs(ds) > self.warm_start_jump
+        self.warm_start_s = s
+        if not reset:
+            self.warm_start_age += 1
+            return
+        self.warm_start_age = 0
+        uu = self.warm_start_library.lookup(s)
+        if uu is None:
+            return
+        # control() shifts the warm start by one step before solving
+        old = self.mppi.old_ref_control
+        old[1:] = uu[:-1]
+        old[0] = uu[0]
+        return
 
-        ref_control = np.zeros([self.horizon_steps,self.control_dim])
-        p.e("prep")
+    # uu: control sequence synthesized by mppi
+    # return: (throttle,steering,valid,debug)
+    def finishMppiControl(self,state,uu,debug_dict):
+        if not (self.warm_start_library is None) and self.warm_start_age >= self.warm_start_settle_steps:
+            self.warm_start_library.record(self.warm_start_s,uu)
 
-        p.s("mppi")
-        uu = self.mppi.control(state.copy(),self.opponent_prediction,self.control_limit)
         control = uu[0]
         throttle = control[0]
         steering = control[1]
-        p.e("mppi")
 
         # DEBUG
         # simulate where mppi think where the car will end up with
         # with synthesized control sequence
-        p.s("debug")
         sim_state = state.copy()
         for i in range(self.horizon_steps):
             sim_state = self.applyDiscreteDynamics(sim_state,uu[i],self.mppi_dt)
@@ -167,16 +571,17 @@ class ctrlMppiWrapper(Car):
         # per ji's request, show 100 sampled trajectory, randomly selected
         
 
-        ret =  (throttle,steering,True,debug_dict)
-        p.e("debug")
-        p.e()
-        return ret
+        return (throttle,steering,True,debug_dict)
 
 
     def evaluateStepCost(self,state,control):
         heading = state[4]
         # calculate cost
         # cost = -reward + penalty
+        if not (self.frenet_raster is None):
+            _,offset,_ = self.frenet_raster.query(state[0],state[2])
+            return abs(float(offset))*0.5*10
+
         #ids0 = self.findClosestIds(x0)
         ids = self.findClosestIds(state)
 
@@ -192,31 +597,27 @@ class ctrlMppiWrapper(Car):
         # FIXME
         #return 0.0
 
+    # state: a single state or an array of states with shape (...,6), e.g. (K,T,6) rollouts
     def findClosestIds(self,state):
-        x = state[0]
-        y = state[2]
-        dx = x - self.raceline_points[0]
-        dy = y - self.raceline_points[1]
-
-        dist2 = dx*dx + dy*dy
-        idx = np.argmin(dist2)
+        state = np.asarray(state)
+        idx,_ = self.raceline_index.query(state[...,0],state[...,2])
+        if idx.ndim == 0:
+            return idx.item()
         return idx
 
     def evaluateTerminalCost(self,state,x0):
         heading = state[4]
         # calculate cost
         # cost = -reward + penalty
-        ids0 = self.findClosestIds(x0)
-        ids = self.findClosestIds(state)
-
-        # reward is progress along centerline
-        cost_real = - ( self.ss[ids] - self.ss[ids0] )
+        # s along raceline of start and end state, same value from frenet raster or closest discretized point
+        s0 = self.raceS(x0)
+        s1 = self.raceS(state)
+
+        # reward is progress along raceline, wrapped so crossing the start line doesn't count as a lap
+        half = self.track.raceline_len_m/2
+        progress = (s1 - s0 + half)%self.track.raceline_len_m - half
+        cost_real = -progress
         #print("real = %.4f"%(cost_real))
-        # instead of actual progress length, can we approximate progress with index to self.ss ?
-        # 0.01 is to roughly convert indices difference into path length difference in meter
-        cost_approx = -((ids - ids0 + self.discretized_raceline_len)%self.discretized_raceline_len)*0.01
-        #print("approx = %.4f"%(cost_approx))
-        #print((cost_approx - cost_real)/cost_real)
 
         # sanity check, 0.5*0.1m offset equivalent to 0.1 rad(5deg) heading error
         # 10cm progress equivalent to 0.1 rad error
@@ -280,8 +681,17 @@ class ctrlMppiWrapper(Car):
 
     def predictOpponent(self):
         self.opponent_prediction = []
-        for opponent in self.opponents:
-            traj = self.track.predictOpponent(opponent.state, self.horizon_steps, self.mppi_dt)
-            self.opponent_prediction.append(traj)
+        if len(self.opponents) == 0:
+            return
+        # batched and stateless, doesn't disturb the ego car's projection state in track.last_u
+        states = np.array([opponent.state[:3] for opponent in self.opponents])
+        # search near each opponent's last u, the whole raceline only when an opponent is seen for the first time
+        if all([id(opponent) in self.opponent_u for opponent in self.opponents]):
+            u_guess = [self.opponent_u[id(opponent)] for opponent in self.opponents]
+        else:
+            u_guess = None
+        trajs,u = self.track.predictOpponentBatch(states, self.horizon_steps, self.mppi_dt, u_guess=u_guess, return_u=True)
+        self.opponent_u = {id(opponent):u[i] for i,opponent in enumerate(self.opponents)}
+        self.opponent_prediction = list(trajs)
 
         
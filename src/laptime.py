@@ -7,33 +7,102 @@ from PIL import Image
 import cv2
 import matplotlib.pyplot as plt
 import sys
+from multiprocessing import Pool
 
-#make a gif of the optimization process
+#make a gif of the optimization process, one frame per accepted iterate
 saveGif = True
 gifimages = []
 laptime_vec = []
 
+# evaluate laptime across a process pool
+# the finite difference gradient for SLSQP is computed as one batch of offset vectors, one per worker task
+parallel = True
+# number of worker processes, None to use all cores
+workers = None
+# perturbation for finite difference gradient
+fd_step = 1e-4
+
+# build the track used for evaluating laptime, headless so speed profile generation never plots
+def prepareTrack(descrip,track_size,scale):
+    track_obj = RCPtrack()
+    track_obj.headless = True
+    track_obj.initTrack(descrip,track_size,scale=scale)
+    return track_obj
+
 # given control offset, get laptime
+def calcLaptime(ctrl_offset,track_obj,start_grid,start_dir,start_seqno):
+    track_obj.initRaceline(start_grid,start_dir,start_seqno,offset=ctrl_offset)
+    track_obj.generateSpeedProfile()
+    return track_obj.calcLaptime()
+
 count = 0
 def getLaptime(ctrl_offset,track_obj,start_grid,start_dir,start_seqno):
-    global saveGif,gifimages,img_track,count
+    global count
     count += 1
-    laptime = track_obj.initRaceline(start_grid,start_dir,start_seqno,offset=ctrl_offset)
+    laptime = calcLaptime(ctrl_offset,track_obj,start_grid,start_dir,start_seqno)
     laptime_vec.append(laptime)
     sys.stdout.write('.')
     sys.stdout.flush()
-    if saveGif:
-        img_track_raceline = mk103.drawRaceline(img=img_track.copy())
-        gifimages.append(Image.fromarray(cv2.cvtColor(img_track_raceline,cv2.COLOR_BGR2RGB)))
-        #plt.imshow(img_track_raceline)
-        #plt.show()
     return laptime
 
+# each pool worker holds its own preloaded track
+worker_track = None
+def initWorker(descrip,track_size,scale):
+    global worker_track
+    worker_track = prepareTrack(descrip,track_size,scale)
+
+def workerLaptime(args):
+    ctrl_offset,start_grid,start_dir,start_seqno = args
+    return calcLaptime(ctrl_offset,worker_track,start_grid,start_dir,start_seqno)
+
+# laptime and its forward difference gradient, evaluated as one batch across the pool
+# SLSQP asks for fun(x) and jac(x) separately at the same x, the batch result is cached for both
+class ParallelLaptime:
+    def __init__(self,pool,start_grid,start_dir,start_seqno):
+        self.pool = pool
+        self.start = (start_grid,start_dir,start_seqno)
+        self.x = None
+        self.laptime = None
+        self.grad = None
+        return
+
+    def evaluate(self,x):
+        global count
+        x = np.array(x,dtype=np.float64)
+        if not (self.x is None) and np.array_equal(x,self.x):
+            return
+        batch = [x] + [x + fd_step*np.eye(x.shape[0])[i] for i in range(x.shape[0])]
+        laptimes = np.array(self.pool.map(workerLaptime,[(offset,)+self.start for offset in batch]))
+        count += len(batch)
+        self.x = x
+        self.laptime = laptimes[0]
+        self.grad = (laptimes[1:] - laptimes[0])/fd_step
+        laptime_vec.append(self.laptime)
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        return
+
+    def fun(self,x):
+        self.evaluate(x)
+        return self.laptime
+
+    def jac(self,x):
+        self.evaluate(x)
+        return self.grad
+
+# called by the optimizer once per accepted iterate
+def captureFrame(xk):
+    if not saveGif:
+        return
+    calcLaptime(xk,mk103,start_grid,start_dir,start_seqno)
+    img_track_raceline = mk103.drawRaceline(img=img_track.copy())
+    gifimages.append(Image.fromarray(cv2.cvtColor(img_track_raceline,cv2.COLOR_BGR2RGB)))
+    #plt.imshow(img_track_raceline)
+    #plt.show()
+    return
 
-if __name__ == "__main__":
-    # initialize instance
-    mk103 = RCPtrack()
 
+if __name__ == "__main__":
     # define track
 
     # Reduced "L" Track
@@ -82,7 +151,8 @@ if __name__ == "__main__":
 
     # initialize track
     track_len = len(descrip)
-    mk103.initTrack(descrip,track_size,scale=0.565)
+    scale = 0.565
+    mk103 = prepareTrack(descrip,track_size,scale)
     start_grid = (3,3)
     start_dir = 'd'
     start_seqno = 10
@@ -113,8 +183,14 @@ if __name__ == "__main__":
     bnds = tuple([(-max_offset,max_offset) for i in range(track_len)])
     #bnds = ((-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset),(-max_offset,max_offset))
 
+    captureFrame(adjustment)
     #res = minimize(getLaptime,adjustment,args=(mk103),method='COBYLA',bounds=bnds,constraints=cons)
-    res = minimize(getLaptime,adjustment,args=(mk103,start_grid,start_dir,start_seqno),method='SLSQP',bounds=bnds,constraints=cons)
+    if parallel:
+        with Pool(workers,initializer=initWorker,initargs=(descrip,track_size,scale)) as pool:
+            objective = ParallelLaptime(pool,start_grid,start_dir,start_seqno)
+            res = minimize(objective.fun,adjustment,jac=objective.jac,method='SLSQP',bounds=bnds,constraints=cons,callback=captureFrame)
+    else:
+        res = minimize(getLaptime,adjustment,args=(mk103,start_grid,start_dir,start_seqno),method='SLSQP',bounds=bnds,constraints=cons,callback=captureFrame)
     print(res)
     adjustment = res.x
     print(res.x)
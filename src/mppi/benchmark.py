@@ -0,0 +1,332 @@
+# benchmark MPPI backends on the toy systems in this folder and on the racecar
+# every (system, backend, K, T) combination is run closed loop for a few steps
+# wall time per solve, samples/s, memory and achieved cost are written to a json file
+# usage: python benchmark.py [output.json]
+# compare outputs from before and after a change to catch regressions
+import os
+import sys
+import json
+import platform
+import resource
+import tracemalloc
+import subprocess
+from time import perf_counter,strftime
+import numpy as np
+base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../')
+sys.path.append(base_dir)
+from common import *
+from mppi import MPPI
+from mppi_racecar import MppiRacecarCpu,COLLISION_RADIUS,COLLISION_WINDOW
+from mppi_pool import MppiRacecarPool
+from rollout_models import KinematicModel
+
+# grid and run length
+samples_grid = [256,1024,4096]
+horizon_grid = [10,20,40]
+# closed loop steps per run, the first solve is warm up and not timed
+steps = 20
+# per-sample python backend is only run up to this many rollout steps (K*T) per solve
+serial_max_work = 1024*20
+
+# a system provides dynamics and cost that work on a single state (STATE_DIM,) or a batch (...,STATE_DIM)
+# advance() returns the next state, step_cost() and terminal_cost() return cost with the batch shape
+
+# InvertedPendulum in invertedPendulum.py, swing up from horizontal
+class PendulumSystem:
+    name = 'pendulum'
+    def __init__(self):
+        from invertedPendulum import InvertedPendulum
+        sim = InvertedPendulum()
+        self.m,self.L,self.g = sim.m,sim.L,sim.g
+        self.state_dim = 2
+        self.control_dim = 1
+        self.dt = 0.02
+        self.x0 = np.array([np.pi/2,0.0])
+        self.noise_cov = np.eye(1)*10.0**2
+        self.control_limit = [[-50,50]]
+        self.temperature = 1.0
+
+    def advance(self,x,u,dt):
+        x = np.array(x,dtype=np.float32)
+        theta = x[...,0] + x[...,1]*dt
+        theta = (theta + np.pi) % (2*np.pi) - np.pi
+        x[...,0] = theta
+        x[...,1] += (u[...,0] - self.m*self.g*self.L*np.sin(theta))*dt
+        return x
+
+    def step_cost(self,x,u):
+        # upright at theta = pi
+        return ((x[...,0] - np.pi + np.pi)%(2*np.pi) - np.pi)**2 + 0.1*x[...,1]**2
+
+    def terminal_cost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
+
+# Box in dampedBox.py, hold position at 1
+class DampedBoxSystem:
+    name = 'damped_box'
+    def __init__(self):
+        # dampedBox.py also imports the mpc module
+        from dampedBox import Box
+        sim = Box()
+        self.A = sim.A.astype(np.float32)
+        self.B = sim.B.astype(np.float32)
+        self.state_dim = 2
+        self.control_dim = 1
+        self.dt = 0.03
+        self.x0 = np.array([0.0,0.0])
+        self.noise_cov = np.eye(1)*5.0**2
+        self.control_limit = [[-100,100]]
+        self.temperature = 1.0
+
+    def advance(self,x,u,dt):
+        x = np.array(x,dtype=np.float32)
+        return x + (x @ self.A.T + u @ self.B.T)*dt
+
+    def step_cost(self,x,u):
+        return (x[...,0] - 1.0)**2
+
+    def terminal_cost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
+
+# dualMass in dualMass.py, move masses to 1 and 3
+class DualMassSystem:
+    name = 'dual_mass'
+    def __init__(self):
+        from dualMass import dualMass
+        sim = dualMass()
+        self.m1,self.m2,self.k1,self.k2,self.c1,self.c2 = sim.m1,sim.m2,sim.k1,sim.k2,sim.c1,sim.c2
+        self.state_dim = 4
+        self.control_dim = 2
+        self.dt = 0.3
+        self.x0 = np.zeros(4)
+        self.noise_cov = np.eye(2)*2.0**2
+        self.control_limit = [[-50,50]]*2
+        self.temperature = 1.0
+        self.target = np.array([1,0,3,0],dtype=np.float32)
+        self.weights = np.array([1,0.1,1,0.1],dtype=np.float32)**2
+
+    def advance(self,x,u,dt):
+        x = np.array(x,dtype=np.float32)
+        x1,dx1,x2,dx2 = x[...,0],x[...,1],x[...,2],x[...,3]
+        ddx1 = -(self.k1*x1 + self.c1*dx1 + self.k2*(x1-x2) + self.c2*(dx1-dx2) - u[...,0])/self.m1
+        ddx2 = -(self.k2*(x2-x1) + self.c2*(dx2-dx1) - u[...,1])/self.m2
+        return np.stack([x1+dx1*dt,dx1+ddx1*dt,x2+dx2*dt,dx2+ddx2*dt],axis=-1)
+
+    def step_cost(self,x,u):
+        return np.sum((x - self.target)**2*self.weights,axis=-1)
+
+    def terminal_cost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
+
+# Model in mppiJisModel.py, discrete double integrator to goal
+class JisModelSystem:
+    name = 'jis_model'
+    def __init__(self):
+        from mppiJisModel import Model
+        sim = Model()
+        self.A,self.B,self.Q,self.R = sim.A,sim.B,sim.Q,sim.R
+        self.x_goal = sim.x_goal
+        self.state_dim = sim.state_dim
+        self.control_dim = sim.control_dim
+        self.dt = sim.dt
+        self.x0 = np.array(sim.x,dtype=np.float64)
+        self.noise_cov = sim.noise_cov
+        self.control_limit = [[-1,1]]*2
+        self.temperature = sim.temperature
+
+    def advance(self,x,u,dt):
+        x = np.array(x,dtype=np.float32)
+        return x @ self.A.T + u @ self.B.T
+
+    def step_cost(self,x,u):
+        e = x - self.x_goal
+        return np.sum((e @ self.Q)*e,axis=-1) + np.sum((u @ self.R)*u,axis=-1)
+
+    def terminal_cost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
+
+# racecar on a synthetic elliptic raceline with MppiRacecarCpu cost and kinematic model
+class RacecarSystem:
+    name = 'racecar'
+    def __init__(self):
+        self.state_dim = 6
+        self.control_dim = 2
+        self.dt = 0.03
+        max_throttle = 0.55
+        self.noise_cov = np.diag([(max_throttle/2)**2,np.radians(40.0/2)**2])
+        self.control_limit = [[-max_throttle,max_throttle],[-np.radians(27.1),np.radians(27.1)]]
+        self.temperature = 1.0
+
+        # (RACELINE_LEN,4), x,y,heading,ref velocity, first and last point coincide
+        angle = np.linspace(0,2*np.pi,1024)
+        x = 1.5*np.cos(angle)
+        y = 1.0*np.sin(angle)
+        heading = np.arctan2(1.0*np.cos(angle),-1.5*np.sin(angle))
+        self.discretized_raceline = np.vstack([x,y,heading,np.full_like(angle,1.5)]).T
+        self.x0 = np.array([1.5,0.0,0.0,1.0,np.pi/2,0.0])
+        self.model = KinematicModel()
+        # cost only, sample count is irrelevant
+        self.cost_evaluator = MppiRacecarCpu(1,1,self.control_dim,self.state_dim,self.dt,self.discretized_raceline)
+
+    def advance(self,x,u,dt):
+        x = np.array(x,dtype=np.float32)
+        return self.model.advance(x,np.asarray(u,dtype=np.float32),dt)
+
+    def step_cost(self,x,u):
+        return self.cost_evaluator.evaluateStepCost(x,u)
+
+    def terminal_cost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
+
+# vectorized cpu_evaluator for a toy system, same interface as MppiRacecarCpu.evaluateControlSequence()
+class SystemEvaluator:
+    def __init__(self,system,horizon_steps):
+        self.system = system
+        self.T = horizon_steps
+
+    def evaluateControlSequence(self,x0,ref_control,limits,epsilon,opponents_prediction):
+        limits = np.array(limits,dtype=np.float32).reshape(-1,2)
+        control = np.clip(ref_control + epsilon,limits[:,0],limits[:,1])
+        np.subtract(control,ref_control,out=epsilon)
+        x0 = np.array(x0,dtype=np.float32)
+        x = np.repeat(x0[np.newaxis],epsilon.shape[0],axis=0)
+        cost = np.zeros(epsilon.shape[0],dtype=np.float32)
+        for i in range(self.T):
+            u = control[:,i,:]
+            x = self.system.advance(x,u,self.system.dt)
+            cost += self.system.step_cost(x,u)
+        cost += self.system.terminal_cost(x,x0)
+        return cost
+
+# build MPPI for system on backend
+# return: mppi, cleanup function
+def makeSolver(system,backend,K,T):
+    is_racecar = isinstance(system,RacecarSystem)
+    raceline = system.discretized_raceline if is_racecar else np.zeros((1,4))
+    if backend == 'cuda':
+        collision_macros = {"COLLISION_RADIUS":COLLISION_RADIUS,"COLLISION_WINDOW":COLLISION_WINDOW}
+        mppi = MPPI(K,T,system.state_dim,system.control_dim,system.temperature,system.dt,system.noise_cov,raceline,cuda=True,cuda_filename=os.path.join(os.path.dirname(os.path.abspath(__file__)),"mppi_racecar.cu"),cuda_macros=collision_macros)
+    else:
+        mppi = MPPI(K,T,system.state_dim,system.control_dim,system.temperature,system.dt,system.noise_cov,raceline)
+    mppi.rng = np.random.default_rng(0)
+    # per-step diagnostics are not part of the measurement
+    mppi.metrics = None
+    cleanup = lambda : None
+
+    if backend == 'serial':
+        mppi.applyDiscreteDynamics = system.advance
+        mppi.evaluateStepCost = system.step_cost
+        mppi.evaluateTerminalCost = system.terminal_cost
+    elif backend == 'vectorized':
+        if is_racecar:
+            mppi.cpu_evaluator = MppiRacecarCpu(K,T,system.control_dim,system.state_dim,system.dt,raceline)
+        else:
+            mppi.cpu_evaluator = SystemEvaluator(system,T)
+    elif backend == 'pool':
+        mppi.cpu_evaluator = MppiRacecarPool(K,T,system.control_dim,system.state_dim,system.dt,raceline)
+        cleanup = mppi.cpu_evaluator.close
+    return mppi,cleanup
+
+# backends system can run on, and reason for each skipped one
+def availableBackends(system):
+    backends = ['serial','vectorized']
+    skipped = {}
+    if isinstance(system,RacecarSystem):
+        backends.append('pool')
+        try:
+            import pycuda
+            backends.append('cuda')
+        except ImportError:
+            skipped['cuda'] = "pycuda not available"
+    else:
+        skipped['pool'] = "racecar only"
+        skipped['cuda'] = "racecar only"
+    return backends,skipped
+
+def runOne(system,backend,K,T):
+    tracemalloc.start()
+    mppi,cleanup = makeSolver(system,backend,K,T)
+    setup_alloc = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    x = np.array(system.x0,dtype=np.float32)
+    solve_time = []
+    achieved_cost = 0.0
+    for i in range(steps):
+        t0 = perf_counter()
+        uu = mppi.control(x.copy(),[],system.control_limit)
+        if i > 0:
+            solve_time.append(perf_counter() - t0)
+        u = np.array(uu[0],dtype=np.float32)
+        x = system.advance(x,u,system.dt)
+        achieved_cost += float(system.step_cost(x,u))
+
+    # allocation peak of a single solve, measured separately since tracing slows down the solve
+    tracemalloc.start()
+    mppi.control(x.copy(),[],system.control_limit)
+    solve_peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    cleanup()
+
+    solve_time = np.array(solve_time)
+    median = float(np.median(solve_time))
+    return {
+        'system':system.name, 'backend':backend, 'K':K, 'T':T,
+        'solves':len(solve_time),
+        'time_mean_s':float(np.mean(solve_time)),
+        'time_median_s':median,
+        'time_p95_s':float(np.percentile(solve_time,95)),
+        'samples_per_s':K/median,
+        'setup_alloc_mb':setup_alloc/1e6,
+        'solve_peak_alloc_mb':solve_peak_alloc/1e6,
+        'max_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3,
+        'achieved_cost':achieved_cost,
+        'finite':bool(np.isfinite(achieved_cost)),
+        }
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def runBenchmark():
+    results = []
+    skipped = []
+    for system_class in [PendulumSystem,DampedBoxSystem,DualMassSystem,JisModelSystem,RacecarSystem]:
+        try:
+            system = system_class()
+        except ImportError as e:
+            print_warning("skipping %s: %s"%(system_class.name,e))
+            skipped.append({'system':system_class.name,'reason':str(e)})
+            continue
+        backends,skipped_backends = availableBackends(system)
+        for backend,reason in skipped_backends.items():
+            skipped.append({'system':system.name,'backend':backend,'reason':reason})
+        for backend in backends:
+            for K in samples_grid:
+                for T in horizon_grid:
+                    if backend == 'serial' and K*T > serial_max_work:
+                        skipped.append({'system':system.name,'backend':backend,'K':K,'T':T,'reason':"exceeds serial_max_work"})
+                        continue
+                    result = runOne(system,backend,K,T)
+                    print_info("%-10s %-10s K=%-5d T=%-3d %8.2f ms %10.0f samples/s cost %.4g"%(system.name,backend,K,T,result['time_median_s']*1e3,result['samples_per_s'],result['achieved_cost']))
+                    results.append(result)
+
+    meta = {
+        'time':strftime("%Y-%m-%d %H:%M:%S"),
+        'commit':gitCommit(),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'platform':platform.platform(),
+        'cpu_count':os.cpu_count(),
+        'steps':steps,
+        }
+    return {'meta':meta,'results':results,'skipped':skipped}
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else "mppi_benchmark.json"
+    report = runBenchmark()
+    with open(filename,'w') as f:
+        json.dump(report,f,indent=2)
+    print_ok("benchmark results saved at "+filename)
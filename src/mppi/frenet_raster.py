@@ -0,0 +1,163 @@
+# precomputed frenet frame raster of the area around the raceline
+# each grid node stores arc length s of the closest raceline point, signed lateral offset (left positive)
+# and raceline heading at s, so rollout costs only need an O(1) bilinear lookup instead of a closest point search
+# where neighbouring nodes belong to different sections of the raceline (across the medial axis between two
+# close sections) there is nothing meaningful to interpolate, the lookup falls back to the nearest node
+# layout of self.table is (nx,ny,3), 0:s, 1:lateral offset, 2:heading, same as what mppi_racecar.cu expects
+import os
+import hashlib
+import numpy as np
+from scipy.interpolate import splev
+from raceline_index import RacelineIndex
+from common import *
+
+class FrenetRaster:
+    # origin: (x,y) of node (0,0), in meter
+    # cell_size: distance between adjacent nodes, in meter
+    # table: (nx,ny,3) float32
+    # raceline_len_m: total length of raceline, s wraps around at this value
+    def __init__(self,origin,cell_size,table,raceline_len_m):
+        self.origin = np.array(origin,dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.table = np.ascontiguousarray(table,dtype=np.float32)
+        self.grid_shape = self.table.shape[:2]
+        self.raceline_len_m = float(raceline_len_m)
+        # corners of a cell whose s differ by more than this (m) are on different sections of the raceline
+        # s changes by about cell_size between adjacent nodes, more on the inside of turns
+        self.max_ds = 10*self.cell_size
+        return
+
+    # build raster from RCPtrack.raceline_s, or load it from cache
+    # cache: cache to a file next to the track file (RCPtrack.raceline_filename), if the track was loaded from one
+    @staticmethod
+    def fromTrack(track,cell_size=0.01,margin=0.5,cache=True):
+        filename = None
+        track_filename = getattr(track,'raceline_filename',None)
+        if cache and not (track_filename is None):
+            key = FrenetRaster.cacheKey(track.raceline_s,track.raceline_len_m,cell_size,margin)
+            filename = os.path.splitext(track_filename)[0] + "_frenet_%s.npz"%(key)
+            if os.path.isfile(filename):
+                print_info("loading frenet raster from "+filename)
+                return FrenetRaster.load(filename)
+
+        print_info("building frenet raster ...")
+        raster = FrenetRaster.build(track.raceline_s,track.raceline_len_m,cell_size,margin)
+        if not (filename is None):
+            raster.save(filename)
+            print_ok("frenet raster saved at "+filename)
+        return raster
+
+    # hash of everything the raster depends on
+    @staticmethod
+    def cacheKey(raceline_s,raceline_len_m,cell_size,margin):
+        h = hashlib.sha1()
+        t,c,k = raceline_s
+        h.update(np.asarray(t,dtype=np.float64).tobytes())
+        for coeff in c:
+            h.update(np.asarray(coeff,dtype=np.float64).tobytes())
+        h.update(np.array([k,raceline_len_m,cell_size,margin],dtype=np.float64).tobytes())
+        return h.hexdigest()[:10]
+
+    # raceline_s: spline of raceline parameterized by s, see RCPtrack.reconstructRaceline()
+    @staticmethod
+    def build(raceline_s,raceline_len_m,cell_size=0.01,margin=0.5):
+        # densely sampled raceline, closest sample is refined with a projection step below
+        ds = cell_size/4
+        ss = np.arange(0,raceline_len_m,ds)
+        points = np.array(splev(ss,raceline_s)).T
+
+        origin = points.min(axis=0) - margin
+        upper = points.max(axis=0) + margin
+        nx,ny = (np.ceil((upper-origin)/cell_size).astype(int) + 1)
+        gx,gy = np.meshgrid(origin[0]+np.arange(nx)*cell_size,origin[1]+np.arange(ny)*cell_size,indexing='ij')
+        gx = gx.flatten()
+        gy = gy.flatten()
+
+        index = RacelineIndex(points,cell_size=max(0.05,cell_size),margin=margin+cell_size)
+        idx,_ = index.query(gx,gy)
+        s = ss[idx]
+
+        # raceline_s is parameterized by arc length so the derivative is the unit tangent
+        # one projection step onto the tangent, limited to half a sample spacing
+        for i in range(2):
+            rx,ry = splev(s%raceline_len_m,raceline_s)
+            tx,ty = splev(s%raceline_len_m,raceline_s,der=1)
+            step = ((gx-rx)*tx + (gy-ry)*ty)/(tx*tx+ty*ty)
+            s = s + np.clip(step,-ds/2,ds/2)
+        s = s%raceline_len_m
+
+        rx,ry = splev(s,raceline_s)
+        tx,ty = splev(s,raceline_s,der=1)
+        norm = np.sqrt(tx*tx+ty*ty)
+        # left positive
+        offset = (tx*(gy-ry) - ty*(gx-rx))/norm
+        heading = np.arctan2(ty,tx)
+
+        table = np.stack([s,offset,heading],axis=-1).reshape(nx,ny,3)
+        return FrenetRaster(origin,cell_size,table,raceline_len_m)
+
+    def save(self,filename):
+        np.savez(filename,origin=self.origin,cell_size=self.cell_size,table=self.table,raceline_len_m=self.raceline_len_m)
+        return
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        return FrenetRaster(data['origin'],data['cell_size'].item(),data['table'],data['raceline_len_m'].item())
+
+    # bilinear lookup
+    # x,y: array of any shape, in meter, queries outside the raster are clamped to its edge
+    # return: s, lateral offset, heading, each same shape as x
+    def query(self,x,y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        dtype = np.result_type(x.dtype,np.float32)
+        nx,ny = self.grid_shape
+        fx = np.clip((x-self.origin[0])/self.cell_size,0,nx-1.001).astype(dtype)
+        fy = np.clip((y-self.origin[1])/self.cell_size,0,ny-1.001).astype(dtype)
+        ix = fx.astype(np.int64)
+        iy = fy.astype(np.int64)
+        tx = fx - ix
+        ty = fy - iy
+
+        # corners, (...,3)
+        v00 = self.table[ix,iy]
+        v10 = self.table[ix+1,iy]
+        v01 = self.table[ix,iy+1]
+        v11 = self.table[ix+1,iy+1]
+
+        # s is periodic, unwrap corners relative to v00
+        s00 = v00[...,0]
+        s10 = s00 + self._wrappedDiff(v10[...,0],s00,self.raceline_len_m)
+        s01 = s00 + self._wrappedDiff(v01[...,0],s00,self.raceline_len_m)
+        s11 = s00 + self._wrappedDiff(v11[...,0],s00,self.raceline_len_m)
+        s = self._interpolate(s00,s10,s01,s11,tx,ty)%self.raceline_len_m
+        offset = self._interpolate(v00[...,1],v10[...,1],v01[...,1],v11[...,1],tx,ty)
+        heading = self._interpolateWrapped(v00[...,2],v10[...,2],v01[...,2],v11[...,2],tx,ty,2*np.pi)
+        # keep heading in (-pi,pi]
+        heading = np.where(heading > np.pi,heading-2*np.pi,heading)
+
+        # corners on different sections of the raceline, use the nearest node
+        # interpolating would give an s in between the sections and an offset close to 0
+        jump = np.maximum(np.maximum(np.abs(s10-s00),np.abs(s01-s00)),np.abs(s11-s00)) > self.max_ds
+        if np.any(jump):
+            nearest = self.table[ix+(tx >= 0.5),iy+(ty >= 0.5)]
+            s = np.where(jump,nearest[...,0],s)
+            offset = np.where(jump,nearest[...,1],offset)
+            heading = np.where(jump,nearest[...,2],heading)
+        return s,offset,heading
+
+    # a-b wrapped to [-period/2,period/2)
+    def _wrappedDiff(self,a,b,period):
+        half = period/2
+        return (a - b + half)%period - half
+
+    def _interpolate(self,v00,v10,v01,v11,tx,ty):
+        return (v00*(1-tx) + v10*tx)*(1-ty) + (v01*(1-tx) + v11*tx)*ty
+
+    # interpolate a periodic quantity, corners are unwrapped relative to v00 first
+    def _interpolateWrapped(self,v00,v10,v01,v11,tx,ty,period):
+        v10 = v00 + self._wrappedDiff(v10,v00,period)
+        v01 = v00 + self._wrappedDiff(v01,v00,period)
+        v11 = v00 + self._wrappedDiff(v11,v00,period)
+        return self._interpolate(v00,v10,v01,v11,tx,ty)%period
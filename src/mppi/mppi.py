@@ -11,7 +11,9 @@ from common import *
 # Model Predictive Path Integral
 
 class MPPI:
-    def __init__(self,samples_count, horizon_steps, state_dim, control_dim, temperature,dt,noise_cov,discretized_raceline,cuda=False,cuda_filename=None):
+    # frenet_raster: optional FrenetRaster (frenet_raster.py), used by the cuda kernel for cost lookup
+    # cuda_macros: extra constants substituted into the cuda source, e.g. collision parameters of mppi_racecar.cu
+    def __init__(self,samples_count, horizon_steps, state_dim, control_dim, temperature,dt,noise_cov,discretized_raceline,cuda=False,cuda_filename=None,frenet_raster=None,cuda_macros=None):
         self.K = samples_count
 
         self.T = horizon_steps
@@ -26,6 +28,79 @@ class MPPI:
         self.cuda = cuda
 
         self.old_ref_control = np.zeros([self.T,self.m],dtype=np.float32)
+
+        # persistent buffers reused by every call to control(), all float32
+        # MppiRacecarCpu keeps its own rollout buffers, what remains allocated per call are
+        # the per step temporaries inside the rollout model and cost functions
+        self.ref_control = np.zeros([self.T,self.m],dtype=np.float32)
+        self.epsilon = np.zeros([self.K,self.T,self.m],dtype=np.float32)
+        self.cost = np.zeros(self.K,dtype=np.float32)
+        self.weights = np.zeros(self.K,dtype=np.float32)
+        self.control_update = np.zeros(self.T*self.m,dtype=np.float32)
+        self.x0 = np.zeros(self.state_dim,dtype=np.float32)
+        self.limits = np.zeros(self.m*2,dtype=np.float32)
+        # kernel generate_random_normal() reads CONTROL_DIM*2 scales
+        self.scales = np.zeros(self.m*2,dtype=np.float32)
+        # optional callable (state,opponents_prediction) -> opponents_prediction
+        # drops opponents that can't affect the cost from ego state, e.g. cullOpponents() in mppi_racecar.py
+        self.opponent_filter = None
+        # (opponent_count,T+1,2), grown when more opponents are seen, see prepareOpponents()
+        self.opponents_buffer = np.zeros([0,self.T+1,2],dtype=np.float32)
+        # control before adding ref_control, per-sample cpu path only, allocated on first use
+        self.control_vec = None
+        # buffers used by controlBatch(), grown to the number of cars in prepareBatchBuffers()
+        self.batch_ref_control = np.zeros([0,self.T,self.m],dtype=np.float32)
+        self.batch_epsilon = np.zeros([0,self.K,self.T,self.m],dtype=np.float32)
+        self.batch_cost = np.zeros([0,self.K],dtype=np.float32)
+        self.batch_collision_cost = np.zeros([0,self.K],dtype=np.float32)
+        self.batch_weights = np.zeros([0,self.K],dtype=np.float32)
+        # noise of the last call, usually self.epsilon or a NoisePool slot
+        self.rand_vals = self.epsilon
+        self.rng = np.random.default_rng()
+        # optional batched evaluator for the cpu path, e.g. MppiRacecarCpu in mppi_racecar.py
+        # if not set, the cpu path falls back to per-sample applyDiscreteDynamics/evaluateStepCost
+        self.cpu_evaluator = None
+        # optional NoisePool (noise_pool.py) supplying pre-generated noise for the cpu path
+        self.noise_pool = None
+
+        # anytime mode, cpu_evaluator path only
+        # wall clock budget in seconds for each call to control(), None to always evaluate all K samples
+        # when set, samples are evaluated in batches until the deadline
+        # and control is synthesized from whatever samples are finished
+        self.deadline = None
+        # number of batches the deadline is divided into, tuned online in tuneBatchCount()
+        self.batch_count = 8
+        self.min_batch_count = 1
+        self.max_batch_count = 64
+        # exponentially weighted sums for fitting batch time = overhead + time_per_sample * batch_size
+        # [weight, sum(size), sum(time), sum(size^2), sum(size*time)]
+        self.batch_time_stats = np.zeros(5)
+        self.batch_time_forget = 0.95
+        # the first batch includes one-off warm up (e.g. worker processes starting), leave it out of the fit
+        self.batch_time_warmup = True
+        # samples evaluated in last call to control()
+        self.samples_evaluated = self.K
+
+        # iterative (CEM style) mode, cpu_evaluator path only, see refineIteratively()
+        # number of sampling rounds the K samples are split into, 1 for standard single update MPPI
+        self.iterations = 1
+        # fraction of samples in each round used to estimate mean and variance with equal weights
+        # None to use the MPPI importance weights instead
+        self.elite_fraction = None
+        # new std = smoothing*old std + (1-smoothing)*estimated std
+        self.covariance_smoothing = 0.5
+        # std is kept above this fraction of the std given by noise_cov
+        self.min_std_ratio = 0.1
+        # mean sample cost of each round in last call to control()
+        self.iteration_costs = []
+
+        # per-step diagnostics (effective sample size, cost stats, ...), an MppiMetrics (mppi_metrics.py)
+        # None to skip, off by default since recording adds a pass over all samples every step
+        self.metrics = None
+        # sum of total and collision cost over samples evaluated in current call to control()
+        # collision cost is reported by cpu_evaluator, nan if not available
+        self.sample_cost_sum = 0.0
+        self.collision_cost_sum = np.nan
         if cuda:
             self.curand_kernel_n = 1024
             print_info("loading cuda module ...")
@@ -42,6 +117,13 @@ class MPPI:
             cuda_code_macros = {"SAMPLE_COUNT":self.K, "HORIZON":self.T, "CONTROL_DIM":self.m,"STATE_DIM":self.state_dim,"RACELINE_LEN":discretized_raceline.shape[0],"TEMPERATURE":self.temperature,"DT":dt}
             # add curand related config
             cuda_code_macros = cuda_code_macros | {"CURAND_KERNEL_N":self.curand_kernel_n}
+            if not (cuda_macros is None):
+                cuda_code_macros = cuda_code_macros | cuda_macros
+            # add frenet raster config, placeholders if not used
+            if frenet_raster is None:
+                cuda_code_macros = cuda_code_macros | {"USE_FRENET_RASTER":0,"FRENET_NX":2,"FRENET_NY":2,"FRENET_ORIGIN_X":0.0,"FRENET_ORIGIN_Y":0.0,"FRENET_CELL_SIZE":1.0,"FRENET_MAX_DS":1.0,"RACELINE_LEN_M":1.0}
+            else:
+                cuda_code_macros = cuda_code_macros | {"USE_FRENET_RASTER":1,"FRENET_NX":frenet_raster.grid_shape[0],"FRENET_NY":frenet_raster.grid_shape[1],"FRENET_ORIGIN_X":frenet_raster.origin[0],"FRENET_ORIGIN_Y":frenet_raster.origin[1],"FRENET_CELL_SIZE":frenet_raster.cell_size,"FRENET_MAX_DS":frenet_raster.max_ds,"RACELINE_LEN_M":frenet_raster.raceline_len_m}
 
             mod = SourceModule(code % cuda_code_macros, no_extern_c=True)
 
@@ -63,8 +145,9 @@ class MPPI:
             self.cuda_init_curand_kernel(seed,block=(1024,1,1),grid=(1,1,1))
 
             #device_rand_vals = gpuarray.zeros(K*T*m, dtype=np.float32)
-            self.rand_vals = np.zeros(self.K*self.T*self.m, dtype=np.float32)
-            self.device_rand_vals = drv.to_device(self.rand_vals)
+            self.device_rand_vals = drv.to_device(self.epsilon)
+            self.device_limits = drv.to_device(self.limits)
+            self.device_scales = drv.to_device(self.scales)
 
             print_info("registers used each kernel in eval_ctrl= %d"%self.cuda_evaluate_control_sequence.num_regs)
             assert int(self.cuda_evaluate_control_sequence.num_regs * self.cuda_block_size[0]) <= 65536
@@ -74,6 +157,12 @@ class MPPI:
             self.discretized_raceline = discretized_raceline.astype(np.float32)
             self.discretized_raceline = self.discretized_raceline.flatten()
 
+            # raster doesn't change, transfer it only once
+            if frenet_raster is None:
+                self.device_frenet = np.uint64(0)
+            else:
+                self.device_frenet = drv.to_device(frenet_raster.table.flatten())
+
             sleep(1)
 
         return
@@ -92,6 +181,7 @@ class MPPI:
             cuda = self.cuda
         p = self.p
         p.s()
+        t_start = time()
         opponent_count = len(opponents_prediction)
         opponent_count = np.int32(opponent_count)
 
@@ -102,7 +192,11 @@ class MPPI:
         # start from zero 
         #ref_control = np.zeros([self.T,self.m])
         #ref_control = self.old_ref_control
-        ref_control = np.vstack([self.old_ref_control[1:,:],np.zeros([1,self.m],dtype=np.float32)])
+        # warm start, last solution shifted by one step
+        ref_control = self.ref_control
+        ref_control[:-1] = self.old_ref_control[1:]
+        ref_control[-1] = 0.0
+        self.samples_evaluated = self.K
 
         if (cuda):
             # NVIDIA YES !!!
@@ -111,65 +205,101 @@ class MPPI:
             p.s("prep ref ctrl")
             # assemble limites
             #limits = np.array([-1,1,-2,2],dtype=np.float32)
-            control_limit = np.array(control_limit,dtype=np.float32).flatten()
-            device_limits = drv.to_device(control_limit)
+            self.limits[:] = np.ravel(control_limit)
+            drv.memcpy_htod(self.device_limits,self.limits)
 
-            scales = np.array([np.sqrt(noise_cov[0,0]),np.sqrt(noise_cov[1,1])],dtype=np.float32)
-            device_scales = drv.to_device(scales)
+            self.scales[:self.m] = np.sqrt(np.diag(noise_cov))
+            drv.memcpy_htod(self.device_scales,self.scales)
 
-            self.cuda_generate_random_var(self.device_rand_vals,device_scales,block=(self.curand_kernel_n,1,1),grid=(1,1,1))
+            self.cuda_generate_random_var(self.device_rand_vals,self.device_scales,block=(self.curand_kernel_n,1,1),grid=(1,1,1))
 
             p.e("prep ref ctrl")
 
             p.s("cuda sim")
-            cost = np.zeros([self.K]).astype(np.float32)
+            cost = self.cost
             # we leave the entry point in api for possible future modification
-            x0 = state.copy()
-            x0 = x0.astype(np.float32)
-            # reference control, in standard mppi this should be zero
-            ref_control = ref_control.astype(np.float32)
-            ref_control = ref_control.flatten()
+            x0 = self.x0
+            x0[:] = state
 
             # opponent position
-            opponents_prediction = np.array(opponents_prediction).astype(np.float32)
             # shape: opponent_count, prediction_steps, 2(x,y)
-            if opponents_prediction.shape[0] > 0:
-                assert opponents_prediction.shape[1] == self.T+1
-            opponents_prediction = opponents_prediction.flatten()
+            opponents_prediction = self.prepareOpponents(opponents_prediction,state)
+            opponent_count = np.int32(opponents_prediction.shape[0])
 
-            memCount = cost.size*cost.itemsize + x0.size*x0.itemsize + ref_control.size*ref_control.itemsize + self.rand_vals.size*self.rand_vals.itemsize + opponents_prediction.size*opponents_prediction.itemsize
+            memCount = cost.size*cost.itemsize + x0.size*x0.itemsize + ref_control.size*ref_control.itemsize + self.epsilon.size*self.epsilon.itemsize + opponents_prediction.size*opponents_prediction.itemsize
             assert np.sum(memCount)<8370061312
             #print("x0")
             #print(x0)
             if (opponent_count == 0):
                 self.cuda_evaluate_control_sequence( 
-                        drv.Out(cost),drv.In(x0),drv.In(ref_control),device_limits, self.device_rand_vals,drv.In(self.discretized_raceline), np.uint64(0),opponent_count,
+                        drv.Out(cost),drv.In(x0),drv.In(ref_control),self.device_limits, self.device_rand_vals,drv.In(self.discretized_raceline), np.uint64(0),opponent_count, self.device_frenet,
                         block=self.cuda_block_size, grid=self.cuda_grid_size)
             else:
                 self.cuda_evaluate_control_sequence( 
-                        drv.Out(cost),drv.In(x0),drv.In(ref_control),device_limits, self.device_rand_vals,drv.In(self.discretized_raceline), drv.In(opponents_prediction),opponent_count,
+                        drv.Out(cost),drv.In(x0),drv.In(ref_control),self.device_limits, self.device_rand_vals,drv.In(self.discretized_raceline), drv.In(opponents_prediction),opponent_count, self.device_frenet,
                         block=self.cuda_block_size, grid=self.cuda_grid_size)
 
             # NOTE rand_vals is updated to respect control limits
-            self.rand_vals = drv.from_device(self.device_rand_vals,shape=(self.K*self.T*self.m,), dtype=np.float32)
+            drv.memcpy_dtoh(self.epsilon,self.device_rand_vals)
+            self.rand_vals = self.epsilon
             S_vec = cost
             p.e("cuda sim")
+        elif self.cpu_evaluator is not None and self.iterations > 1:
+            p.s("cpu sim")
+            self.resetCostSum()
+            opponents_prediction = self.prepareOpponents(opponents_prediction,state)
+            S_vec = self.refineIteratively(state,ref_control,control_limit,opponents_prediction,noise_cov)
+            self.samples_evaluated = S_vec.shape[0]
+            p.e("cpu sim")
+        elif self.cpu_evaluator is not None:
+            # vectorized cpu implementation, all samples are evaluated together
+            p.s("prep epsilon")
+            if self.noise_pool is None:
+                # same as generate_random_normal() in cuda, independent noise for each control dim
+                self.rng.standard_normal(out=self.epsilon,dtype=np.float32)
+                self.epsilon *= np.sqrt(np.diag(noise_cov)).astype(np.float32)
+                self.rand_vals = self.epsilon
+            else:
+                # view into the pool's ring buffer, valid until next call
+                self.rand_vals = self.noise_pool.get(noise_cov)
+            p.e("prep epsilon")
+
+            p.s("cpu sim")
+            self.resetCostSum()
+            opponents_prediction = self.prepareOpponents(opponents_prediction,state)
+            # NOTE rand_vals is updated to respect control limits
+            if self.deadline is None:
+                S_vec = self.evaluateSamples(state,ref_control,control_limit,self.rand_vals,opponents_prediction)
+            else:
+                # only the finished samples take part in the weighted average
+                evaluate = lambda k0,k1: self.evaluateSamples(state,ref_control,control_limit,self.rand_vals[k0:k1],opponents_prediction)
+                S_vec = self.evaluateAnytime(evaluate,self.cost,t_start)
+            self.samples_evaluated = S_vec.shape[0]
+            p.track("samples per step",self.samples_evaluated)
+            p.e("cpu sim")
         else:
             p.s("prep epsilon")
-            self.rand_vals = np.random.multivariate_normal([0.0]*self.m, self.noise_cov, size=(self.K,self.T))
+            # noise ~ N(0,self.noise_cov), epsilon = z @ L.T
+            self.rng.standard_normal(out=self.epsilon,dtype=np.float32)
+            L = np.linalg.cholesky(self.noise_cov).astype(np.float32)
+            if np.count_nonzero(L - np.diag(np.diag(L))) == 0:
+                self.epsilon *= np.diag(L)
+            else:
+                self.epsilon[:] = self.epsilon @ L.T
+            self.rand_vals = self.epsilon
 
             p.e("prep epsilon")
             # assemble control, ref_control is broadcasted along axis 0 (K)
-            control_vec = np.zeros([self.K,self.T,self.m])
-            for i in range(self.m):
-                control_vec[:,:,i] = ref_control[:,i]
-                control_vec[:,:,i] += np.clip(self.rand_vals[:,:,i],control_limit[i,0],control_limit[i,1])
+            if self.control_vec is None:
+                self.control_vec = np.zeros([self.K,self.T,self.m],dtype=np.float32)
+            control_vec = self.control_vec
+            control_limit = np.array(control_limit).reshape(self.m,2)
+            np.clip(self.rand_vals,control_limit[:,0],control_limit[:,1],out=control_vec)
+            control_vec += ref_control
 
-            # NOTE which is better
-            clipped_epsilon_vec = control_vec - ref_control
             p.s("cpu sim")
             # cost value for each simulation
-            S_vec = []
+            S_vec = self.cost
             # spawn k simulations
             x0 = state.copy()
             for k in range(self.K):
@@ -188,27 +318,31 @@ class MPPI:
                 #print(np.abs(terminal_S)/(np.abs(S)))
                 S += terminal_S
 
-                S_vec.append(S)
+                S_vec[k] = S
             p.e("cpu sim")
 
         p.s("post")
+        # only the first n samples are evaluated in anytime mode
+        n = self.samples_evaluated
         # Calculate statistics of cost function
-        S_vec = np.array(S_vec)
         beta = np.min(S_vec)
 
         # calculate weights
-        weights = np.exp(- (S_vec - beta)/self.temperature)
-        weights = weights / np.sum(weights)
+        weights = self.weights[:n]
+        np.subtract(S_vec,beta,out=weights)
+        weights *= -1.0/self.temperature
+        np.exp(weights,out=weights)
+        weights /= np.sum(weights)
         #print("best cost %.2f, max weight %.2f"%(beta,np.max(weights)))
 
 
         # synthesize control signal
-        self.rand_vals = self.rand_vals.reshape([self.K,self.T,self.m])
-        ref_control = ref_control.reshape([self.T,self.m])
-        for t in range(self.T):
-            for i in range(self.m):
-                ref_control[t,i] = ref_control[t,i] + np.sum(weights * self.rand_vals[:,t,i])
-        self.old_ref_control = ref_control.copy()
+        # ref_control + weighted sum of epsilon over samples
+        np.matmul(weights,self.rand_vals[:n].reshape(n,-1),out=self.control_update)
+        np.add(ref_control,self.control_update.reshape(self.T,self.m),out=self.old_ref_control)
+        if not (self.metrics is None):
+            self.recordMetrics(S_vec,weights,ref_control,self.rand_vals[:n],control_limit)
+        ref_control = self.old_ref_control
         p.e("post")
 
         # evaluate performance of synthesized control
@@ -223,9 +357,305 @@ class MPPI:
 
         #return ref_control[0]
         p.e()
-        if isnan(ref_control[0,1]):
+        if np.any(np.isnan(ref_control[0])):
             print("error")
-        return ref_control
+        # self.old_ref_control is shifted and overwritten in place by the next call, hand out a copy
+        return ref_control.copy()
+
+    # evaluate samples with self.cpu_evaluator, same arguments as its evaluateControlSequence()
+    # keeps track of total and collision cost for self.metrics
+    def evaluateSamples(self,state,ref_control,control_limit,epsilon,opponents_prediction):
+        cost = self.cpu_evaluator.evaluateControlSequence(state,ref_control,control_limit,epsilon,opponents_prediction)
+        if not (self.metrics is None):
+            self.sample_cost_sum += np.sum(cost,dtype=np.float64)
+            collision_cost = getattr(self.cpu_evaluator,'last_collision_cost',None)
+            if collision_cost is None:
+                self.collision_cost_sum = np.nan
+            else:
+                self.collision_cost_sum += np.sum(collision_cost,dtype=np.float64)
+        return cost
+
+    # batched counterpart of evaluateSamples(), see cpu_evaluator.evaluateControlSequenceBatch()
+    # collision_cost: (N,samples) collision part of the cost is written here, nan if cpu_evaluator doesn't report it
+    def evaluateSamplesBatch(self,states,ref_control,control_limit,epsilon,opponents_prediction,collision_cost):
+        cost = self.cpu_evaluator.evaluateControlSequenceBatch(states,ref_control,control_limit,epsilon,opponents_prediction)
+        collision = getattr(self.cpu_evaluator,'last_collision_cost',None)
+        collision_cost[:] = np.nan if collision is None else collision
+        return cost
+
+    def resetCostSum(self):
+        self.sample_cost_sum = 0.0
+        self.collision_cost_sum = 0.0 if hasattr(self.cpu_evaluator,'last_collision_cost') else np.nan
+        return
+
+    # S_vec, weights: (n,) cost and normalized weights of evaluated samples
+    # ref_control: (T,m) control the samples were drawn around
+    # epsilon: (n,T,m) noise of evaluated samples, clipped to respect control limits
+    def recordMetrics(self,S_vec,weights,ref_control,epsilon,control_limit):
+        n = S_vec.shape[0]
+        control = np.add(epsilon,ref_control,out=self.controlBuffer()[:n])
+        if self.sample_cost_sum > 0:
+            collision_share = self.collision_cost_sum/self.sample_cost_sum
+        else:
+            collision_share = np.nan
+        self.metrics.record(S_vec,weights,control,control_limit,collision_share)
+        # cuda and per-sample paths don't report collision cost
+        self.collision_cost_sum = np.nan
+        return
+
+    # (K,T,m) scratch for control of all samples
+    def controlBuffer(self):
+        if self.control_vec is None:
+            self.control_vec = np.zeros([self.K,self.T,self.m],dtype=np.float32)
+        return self.control_vec
+
+    # copy opponents_prediction into self.opponents_buffer
+    # state: if given, opponents are passed through self.opponent_filter
+    # return: (opponent_count,T+1,2) view into the buffer, or a culled copy
+    def prepareOpponents(self,opponents_prediction,state=None):
+        count = len(opponents_prediction)
+        if count > self.opponents_buffer.shape[0]:
+            self.opponents_buffer = np.zeros([count,self.T+1,2],dtype=np.float32)
+        buf = self.opponents_buffer[:count]
+        for i in range(count):
+            buf[i] = opponents_prediction[i]
+        if not (state is None) and count > 0 and not (self.opponent_filter is None):
+            buf = self.opponent_filter(np.asarray(state,dtype=np.float32),buf)
+            self.p.track("active opponents",buf.shape[0])
+        return buf
+
+    # solve for several cars in one pass, e.g. all mppi controlled cars on track
+    # each car has its own state, opponents and warm start, they share K, T, limits and the raceline
+    # states: (N,state_dim)
+    # opponents_prediction: list of N, each in the same format as in control()
+    # old_ref_controls: (N,T,m), last control sequence synthesized for each car, used as warm start
+    # return: (N,T,m) synthesized control sequences, caller should keep them as next old_ref_controls
+    # metrics: list of N MppiMetrics (or None) each car's diagnostics are recorded in, default to self.metrics for all
+    # noise comes from self.noise_pool (one slot per car, up to its slot_count cars) or self.rng
+    # self.deadline applies to the whole batch
+    # NOTE self.old_ref_control is not used, self.iterations is ignored
+    def controlBatch(self,states,opponents_prediction,control_limit,old_ref_controls,noise_cov=None,metrics=None):
+        if noise_cov is None:
+            noise_cov = self.noise_cov
+        car_count = len(states)
+
+        # only a batched cpu evaluator can evaluate all cars at once, solve one car at a time otherwise
+        if self.cuda or not hasattr(self.cpu_evaluator,"evaluateControlSequenceBatch"):
+            ref_controls = np.zeros([car_count,self.T,self.m],dtype=np.float32)
+            own_metrics = self.metrics
+            for i in range(car_count):
+                self.old_ref_control[:] = old_ref_controls[i]
+                if not (metrics is None):
+                    self.metrics = metrics[i]
+                ref_controls[i] = self.control(states[i],opponents_prediction[i],control_limit,noise_cov=noise_cov)
+            self.metrics = own_metrics
+            return ref_controls
+
+        p = self.p
+        p.s()
+        t_start = time()
+        self.prepareBatchBuffers(car_count)
+        # warm start, last solution of each car shifted by one step
+        ref_control = self.batch_ref_control[:car_count]
+        for i in range(car_count):
+            ref_control[i,:-1] = old_ref_controls[i][1:]
+            ref_control[i,-1] = 0.0
+
+        p.s("prep epsilon")
+        # list of (K,T,m) noise, one for each car
+        if self.noise_pool is None or car_count > self.noise_pool.slot_count:
+            # same as the single car cpu path, independent noise for each control dim
+            rand_vals = self.batch_epsilon[:car_count]
+            self.rng.standard_normal(out=rand_vals,dtype=np.float32)
+            rand_vals *= np.sqrt(np.diag(noise_cov)).astype(np.float32)
+            rand_vals = list(rand_vals)
+        else:
+            # one slot for each car, handed to the evaluator without a copy
+            rand_vals = self.noise_pool.getBatch(car_count,noise_cov)
+        p.e("prep epsilon")
+
+        p.s("cpu sim")
+        states = np.array(states,dtype=np.float32).reshape(car_count,self.state_dim)
+        opponents_prediction = [np.array(opp,dtype=np.float32).reshape(-1,self.T+1,2) for opp in opponents_prediction]
+        if not (self.opponent_filter is None):
+            opponents_prediction = [self.opponent_filter(states[i],opponents_prediction[i]) for i in range(car_count)]
+        collision_cost = self.batch_collision_cost[:car_count]
+        # NOTE rand_vals is updated to respect control limits
+        evaluate = lambda k0,k1: self.evaluateSamplesBatch(states,ref_control,control_limit,[eps[k0:k1] for eps in rand_vals],opponents_prediction,collision_cost[:,k0:k1])
+        if self.deadline is None:
+            S_vec = evaluate(0,self.K)
+        else:
+            # only the finished samples take part in the weighted average
+            S_vec = self.evaluateAnytime(evaluate,self.batch_cost[:car_count],t_start)
+        n = S_vec.shape[1]
+        self.samples_evaluated = n
+        p.track("samples per step",S_vec.size)
+        p.e("cpu sim")
+
+        p.s("post")
+        # weights for each car's samples
+        weights = self.batch_weights[:car_count,:n]
+        np.subtract(S_vec,np.min(S_vec,axis=1,keepdims=True),out=weights)
+        weights *= -1.0/self.temperature
+        np.exp(weights,out=weights)
+        weights /= np.sum(weights,axis=1,keepdims=True)
+        if metrics is None:
+            metrics = [self.metrics]*car_count
+        for i in range(car_count):
+            if not (metrics[i] is None):
+                collision_share = np.sum(collision_cost[i,:n],dtype=np.float64)/np.sum(S_vec[i],dtype=np.float64)
+                control = np.add(rand_vals[i][:n],ref_control[i],out=self.controlBuffer()[:n])
+                metrics[i].record(S_vec[i],weights[i],control,control_limit,collision_share)
+        for i in range(car_count):
+            ref_control[i] += np.einsum('k,ktm->tm',weights[i],rand_vals[i][:n])
+        p.e("post")
+        p.e()
+        # buffers are reused by the next call
+        return ref_control.copy()
+
+    # make sure buffers used by controlBatch() can hold car_count cars
+    def prepareBatchBuffers(self,car_count):
+        if self.batch_epsilon.shape[0] >= car_count:
+            return
+        self.batch_ref_control = np.zeros([car_count,self.T,self.m],dtype=np.float32)
+        self.batch_epsilon = np.zeros([car_count,self.K,self.T,self.m],dtype=np.float32)
+        self.batch_cost = np.zeros([car_count,self.K],dtype=np.float32)
+        self.batch_collision_cost = np.zeros([car_count,self.K],dtype=np.float32)
+        self.batch_weights = np.zeros([car_count,self.K],dtype=np.float32)
+        return
+
+    # CEM style refinement under the same rollout budget
+    # the K samples are split into self.iterations rounds, each round samples around the mean
+    # and diagonal (per step, per control dim) std estimated from the weighted or elite samples of the previous round
+    # all but the last round are handled here, ref_control is updated IN PLACE to the refined mean
+    # noise is drawn from self.rng, self.noise_pool and self.deadline are not used
+    # return: cost of the last round, its noise is self.rand_vals
+    def refineIteratively(self,state,ref_control,control_limit,opponents_prediction,noise_cov):
+        p = self.p
+        std = np.empty([self.T,self.m],dtype=np.float32)
+        std[:] = np.sqrt(np.diag(noise_cov))
+        min_std = std*self.min_std_ratio
+        bounds = np.linspace(0,self.K,self.iterations+1).astype(int)
+        self.iteration_costs = []
+        for i in range(self.iterations):
+            k = bounds[i+1] - bounds[i]
+            epsilon = self.epsilon[:k]
+            self.rng.standard_normal(out=epsilon,dtype=np.float32)
+            epsilon *= std
+            # NOTE epsilon is updated to respect control limits
+            cost = self.evaluateSamples(state,ref_control,control_limit,epsilon,opponents_prediction)
+
+            # report how much each round improves over the first
+            self.iteration_costs.append(float(np.mean(cost)))
+            p.track("iteration %d mean cost"%(i),self.iteration_costs[-1])
+            if i > 0:
+                p.track("iteration %d improvement"%(i),self.iteration_costs[0]-self.iteration_costs[-1])
+
+            if i == self.iterations-1:
+                self.rand_vals = epsilon
+                return cost
+
+            weights = self.sampleWeights(cost)
+            mean = np.tensordot(weights,epsilon,axes=1)
+            var = np.tensordot(weights,(epsilon-mean)**2,axes=1)
+            ref_control += mean
+            std *= self.covariance_smoothing
+            std += (1-self.covariance_smoothing)*np.maximum(np.sqrt(var),min_std)
+        return
+
+    # weights for re-estimating sampling distribution in refineIteratively()
+    # cost: (k,)
+    # return: (k,) weights summing to 1
+    def sampleWeights(self,cost):
+        if self.elite_fraction is None:
+            weights = np.exp(-(cost - np.min(cost))/self.temperature)
+        else:
+            elite_count = max(1,int(cost.shape[0]*self.elite_fraction))
+            elites = np.argpartition(cost,elite_count-1)[:elite_count]
+            weights = np.zeros_like(cost)
+            weights[elites] = 1.0
+        return weights/np.sum(weights)
+
+    # evaluate samples in batches until self.deadline is reached
+    # the first batch is always evaluated, later batches only if they are expected to finish in time
+    # evaluate(k0,k1): evaluate samples k0..k1, return their cost, (...,k1-k0)
+    # cost: (...,K) buffer the cost of finished samples is written to
+    # t_start: time() at which the deadline started counting
+    # return: cost of finished samples, cost[...,:n], these are the first n samples
+    def evaluateAnytime(self,evaluate,cost,t_start):
+        p = self.p
+        deadline = t_start + self.deadline
+        overhead,time_per_sample = self.fitBatchTime()
+        if time_per_sample is None:
+            batch_size = ceil(self.K/self.batch_count)
+        else:
+            # samples expected to fit in the remaining time
+            expected = (deadline - time() - self.batch_count*overhead)/time_per_sample
+            batch_size = ceil(expected/self.batch_count)
+        batch_size = int(np.clip(batch_size,1,self.K))
+
+        n = 0
+        batches = 0
+        overshoot = False
+        while n < self.K:
+            size = min(batch_size,self.K-n)
+            if n > 0 and not (time_per_sample is None):
+                if time() + overhead + time_per_sample*size > deadline:
+                    break
+            t0 = time()
+            cost[...,n:n+size] = evaluate(n,n+size)
+            self.updateBatchTime(size,time()-t0)
+            overhead,time_per_sample = self.fitBatchTime()
+            n += size
+            batches += 1
+            if time() > deadline:
+                overshoot = True
+                break
+
+        p.track("batches per step",batches)
+        self.tuneBatchCount(overshoot)
+        return cost[...,:n]
+
+    def updateBatchTime(self,size,duration):
+        if self.batch_time_warmup:
+            self.batch_time_warmup = False
+            return
+        self.batch_time_stats *= self.batch_time_forget
+        self.batch_time_stats += [1.0,size,duration,size*size,size*duration]
+        return
+
+    # least squares fit of batch time = overhead + time_per_sample * batch_size
+    # return: overhead, time_per_sample, (None,None) if no batch has been timed yet
+    def fitBatchTime(self):
+        w,sb,st,sbb,sbt = self.batch_time_stats
+        if w == 0:
+            return None,None
+        var = sbb*w - sb*sb
+        # batch sizes too similar to separate fixed overhead from per sample cost
+        if var < 1e-6*sbb*w:
+            return 0.0,st/sb
+        time_per_sample = (sbt*w - sb*st)/var
+        overhead = (st - time_per_sample*sb)/w
+        if time_per_sample <= 0:
+            return 0.0,st/sb
+        return max(overhead,0.0),time_per_sample
+
+    # pick number of batches to balance time wasted at the end of the deadline (about half a batch)
+    # against per batch overhead, i.e. minimize deadline/(2*n) + n*overhead
+    # overshoot: the last call exceeded the deadline, use smaller batches
+    def tuneBatchCount(self,overshoot):
+        overhead,time_per_sample = self.fitBatchTime()
+        if overshoot:
+            self.batch_count += 1
+        elif not (overhead is None) and overhead > 0:
+            best = (self.deadline/(2*overhead))**0.5
+            # move gradually to avoid oscillation
+            if best > self.batch_count:
+                self.batch_count += 1
+            elif best < self.batch_count - 1:
+                self.batch_count -= 1
+        self.batch_count = int(np.clip(self.batch_count,self.min_batch_count,self.max_batch_count))
+        return
 
     # given state, apply MPPI and find control
     # state: current plant state
@@ -0,0 +1,78 @@
+# per-step sampling diagnostics for MPPI, kept in a fixed size ring buffer
+# use these to tell whether temperature, noise_cov and samples_count are sized reasonably
+# ess: effective sample size of the importance weights, 1/sum(w^2), between 1 and samples
+#      ess close to 1 means a single sample dominates (weights degenerate)
+# limit_fraction_i: fraction of (sample,step) entries of control dim i sitting at a control limit
+#      a large value means noise in that dim is mostly wasted on clipping
+# collision_share: share of total sample cost coming from opponent collision cost, nan if unavailable
+import numpy as np
+from common import *
+
+class MppiMetrics:
+    # control_dim: number of control dims, one limit fraction is kept for each
+    # capacity: number of most recent steps kept
+    def __init__(self,control_dim,capacity=1000):
+        self.fields = ['samples','ess','ess_ratio','cost_min','cost_mean','cost_max'] + ['limit_fraction_%d'%(i) for i in range(control_dim)] + ['collision_share']
+        self.index = {name:i for i,name in enumerate(self.fields)}
+        self.capacity = capacity
+        self.buffer = np.full((capacity,len(self.fields)),np.nan)
+        # total number of steps recorded, including those overwritten
+        self.count = 0
+        # tolerance for deciding a clipped control is at a limit
+        self.limit_tol = 1e-5
+        return
+
+    # cost: (n,) cost of evaluated samples
+    # weights: (n,) normalized weights
+    # control: (n,T,m) clipped control of evaluated samples, None if unavailable
+    # control_limit: [[u0_low,u0_high],[u1_low,u1_high]...]
+    # collision_share: see above
+    def record(self,cost,weights,control,control_limit,collision_share=np.nan):
+        row = self.buffer[self.count % self.capacity]
+        n = cost.shape[0]
+        ess = 1.0/np.dot(weights,weights)
+        row[self.index['samples']] = n
+        row[self.index['ess']] = ess
+        row[self.index['ess_ratio']] = ess/n
+        row[self.index['cost_min']] = np.min(cost)
+        row[self.index['cost_mean']] = np.mean(cost)
+        row[self.index['cost_max']] = np.max(cost)
+        control_limit = np.array(control_limit,dtype=np.float32).reshape(-1,2)
+        for i in range(control_limit.shape[0]):
+            if control is None:
+                row[self.index['limit_fraction_%d'%(i)]] = np.nan
+                continue
+            u = control[...,i]
+            at_limit = np.count_nonzero(u <= control_limit[i,0]+self.limit_tol) + np.count_nonzero(u >= control_limit[i,1]-self.limit_tol)
+            row[self.index['limit_fraction_%d'%(i)]] = at_limit/u.size
+        row[self.index['collision_share']] = collision_share
+        self.count += 1
+        return
+
+    # return: recorded steps in chronological order, (steps,len(self.fields))
+    def history(self):
+        if self.count <= self.capacity:
+            return self.buffer[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate([self.buffer[start:],self.buffer[:start]])
+
+    # print summary of recorded steps, optionally save them
+    # filename: if given, save history and field names with np.savez
+    def dump(self,title="mppi metrics",filename=None):
+        data = self.history()
+        if data.shape[0] == 0:
+            print_info(title+": no step recorded")
+            return data
+        print_info("%s: last %d of %d steps"%(title,data.shape[0],self.count))
+        print("%-20s %10s %10s %10s %10s"%("","mean","min","median","max"))
+        for name in self.fields:
+            col = data[:,self.index[name]]
+            col = col[~np.isnan(col)]
+            if col.shape[0] == 0:
+                print("%-20s %10s"%(name,"n/a"))
+                continue
+            print("%-20s %10.4g %10.4g %10.4g %10.4g"%(name,np.mean(col),np.min(col),np.median(col),np.max(col)))
+        if not (filename is None):
+            np.savez(filename,fields=np.array(self.fields),history=data)
+            print_ok("mppi metrics saved at "+filename)
+        return data
@@ -0,0 +1,200 @@
+# shard MPPI rollouts across a persistent pool of worker processes
+# each call splits the samples evenly, every worker runs MppiRacecarCpu on a contiguous slice
+# several cars can be evaluated in one call, each worker then takes the same slice of every car's samples
+# noise tensors, reference control and discretized raceline live in shared memory
+# only the per-sample cost vector is sent back through the pipe
+# the noise slots can be handed to NoisePool (noise_pool.py) as its ring buffer, so noise is generated in place
+import os
+import atexit
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from mppi_racecar import MppiRacecarCpu
+
+# worker process main loop
+# shm_info: {key:(shm name, shape, dtype)}
+def _poolWorker(conn,samples_count,horizon_steps,control_dim,state_dim,dt,shm_info,frenet_raster,rollout_model):
+    shms = {}
+    arrays = {}
+    for key,(name,shape,dtype) in shm_info.items():
+        shms[key] = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape,dtype=dtype,buffer=shms[key].buf)
+
+    evaluator = MppiRacecarCpu(samples_count,horizon_steps,control_dim,state_dim,dt,arrays['raceline'],frenet_raster=frenet_raster,rollout_model=rollout_model)
+    while True:
+        msg = conn.recv()
+        # None is the exit request
+        if msg is None:
+            break
+        # x0: (N,STATE_DIM), car i's noise is in slot slots[i]
+        # k0,k1: range of samples to evaluate in this call
+        x0,limits,opponents_prediction,slots,k0,k1 = msg
+        car_count = x0.shape[0]
+        # views into shared noise tensor, clipped in place by evaluator
+        epsilon = [arrays['epsilon'][j,k0:k1] for j in slots]
+        cost = evaluator.evaluateControlSequenceBatch(x0,arrays['ref_control'][:car_count],limits,epsilon,opponents_prediction)
+        conn.send((cost,evaluator.last_collision_cost))
+
+    epsilon = None
+    arrays = None
+    for shm in shms.values():
+        shm.close()
+    conn.close()
+    return
+
+# drop-in replacement for MppiRacecarCpu, assign to MPPI.cpu_evaluator
+class MppiRacecarPool:
+    # worker_count: number of worker processes, default to number of cpu cores
+    # frenet_raster, rollout_model: see MppiRacecarCpu, a copy is sent to each worker once at startup
+    # slot_count: number of (K,T,m) noise tensors kept in shared memory, see self.epsilon_slots
+    #       this is also the number of cars evaluated together, larger batches are split
+    def __init__(self,samples_count,horizon_steps,control_dim,state_dim,dt,discretized_raceline,worker_count=None,frenet_raster=None,rollout_model=None,slot_count=1):
+        self.K = samples_count
+        self.T = horizon_steps
+        self.m = control_dim
+        self.state_dim = state_dim
+        if worker_count is None:
+            worker_count = os.cpu_count()
+        self.worker_count = max(1,min(worker_count,self.K))
+
+        discretized_raceline = np.array(discretized_raceline,dtype=np.float32).reshape(-1,4)
+        self.shms = {}
+        self.shm_info = {}
+        # callers may generate noise directly into any slot to avoid a copy,
+        # e.g. pass epsilon_slots as buffer to NoisePool
+        self.slot_count = max(1,slot_count)
+        self.epsilon_slots = self._allocate('epsilon',(self.slot_count,self.K,self.T,self.m),np.float32)
+        self.epsilon = self.epsilon_slots[0]
+        self.ref_control = self._allocate('ref_control',(self.slot_count,self.T,self.m),np.float32)
+        self.raceline = self._allocate('raceline',discretized_raceline.shape,np.float32)
+        self.raceline[:] = discretized_raceline
+
+        self.conns = []
+        self.workers = []
+        for i in range(self.worker_count):
+            parent_conn,child_conn = mp.Pipe()
+            worker = mp.Process(target=_poolWorker,args=(child_conn,self.K,self.T,self.m,self.state_dim,dt,self.shm_info,frenet_raster,rollout_model),daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+        # same as MppiRacecarCpu.last_collision_cost
+        self.last_collision_cost = None
+        self.closed = False
+        atexit.register(self.close)
+        return
+
+    def _allocate(self,key,shape,dtype):
+        size = int(np.prod(shape))*np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True,size=max(size,1))
+        self.shms[key] = shm
+        self.shm_info[key] = (shm.name,shape,dtype)
+        return np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+    # epsilon: (N,samples,T,m) or list of N (samples,T,m)
+    # if each car's samples are a contiguous block of one of self.epsilon_slots, all starting at the same sample,
+    # return the slot index of each car and index of the first sample
+    # otherwise return None
+    def _slotOffset(self,epsilon):
+        slots = self.epsilon_slots
+        samples = epsilon[0].shape[0]
+        car_slots = []
+        k0s = set()
+        for eps in epsilon:
+            if eps.dtype != np.float32 or eps.shape[0] != samples or not np.may_share_memory(eps,slots):
+                return None
+            if eps.strides != slots.strides[1:]:
+                return None
+            slot,offset_bytes = divmod(eps.ctypes.data - slots.ctypes.data,slots.strides[0])
+            if offset_bytes % slots.strides[1] != 0:
+                return None
+            k0 = offset_bytes // slots.strides[1]
+            if slot < 0 or slot >= self.slot_count or k0 + samples > self.K or slot in car_slots:
+                return None
+            car_slots.append(slot)
+            k0s.add(k0)
+        if len(k0s) != 1:
+            return None
+        return car_slots,k0s.pop()
+
+    # same interface as MppiRacecarCpu.evaluateControlSequence()
+    # epsilon may hold any number of samples up to K
+    # if epsilon is (a slice of) one of self.epsilon_slots no copy is made
+    def evaluateControlSequence(self,x0,ref_control,limits,epsilon,opponents_prediction):
+        cost = self.evaluateControlSequenceBatch(np.array(x0).reshape(1,-1),np.array(ref_control,dtype=np.float32).reshape(1,self.T,self.m),limits,epsilon[np.newaxis],[opponents_prediction])
+        self.last_collision_cost = self.last_collision_cost[0]
+        return cost[0]
+
+    # same interface as MppiRacecarCpu.evaluateControlSequenceBatch()
+    # epsilon: (N,samples,T,m) or list of N (samples,T,m), samples up to K
+    #       no copy is made if each car's samples are (a slice of) one of self.epsilon_slots,
+    #       e.g. slots from NoisePool.getBatch() on this buffer
+    #       otherwise they are copied in and out of the slots, slot_count cars at a time
+    def evaluateControlSequenceBatch(self,x0,ref_control,limits,epsilon,opponents_prediction):
+        car_count = len(epsilon)
+        samples = epsilon[0].shape[0]
+        x0 = np.array(x0,dtype=np.float32).reshape(car_count,self.state_dim)
+        ref_control = np.array(ref_control,dtype=np.float32).reshape(car_count,self.T,self.m)
+        limits = np.array(limits,dtype=np.float32)
+        opponents_prediction = [np.array(opp,dtype=np.float32).reshape(-1,self.T+1,2) for opp in opponents_prediction]
+
+        located = self._slotOffset(epsilon)
+        if not (located is None):
+            car_slots,k0 = located
+            cost,collision_cost = self._evaluate(x0,ref_control,limits,opponents_prediction,car_slots,k0,k0+samples)
+            self.last_collision_cost = collision_cost
+            return cost
+
+        cost = np.empty((car_count,samples),dtype=np.float32)
+        collision_cost = np.empty((car_count,samples),dtype=np.float32)
+        for i in range(0,car_count,self.slot_count):
+            j = min(i+self.slot_count,car_count)
+            for n in range(j-i):
+                self.epsilon_slots[n,:samples] = epsilon[i+n]
+            cost[i:j],collision_cost[i:j] = self._evaluate(x0[i:j],ref_control[i:j],limits,opponents_prediction[i:j],list(range(j-i)),0,samples)
+            # NOTE epsilon is updated to respect control limits
+            for n in range(j-i):
+                epsilon[i+n][:] = self.epsilon_slots[n,:samples]
+        self.last_collision_cost = collision_cost
+        return cost
+
+    # evaluate samples k0..k1 of cars whose noise is in slots car_slots[0], car_slots[1] ...
+    # return: cost, collision cost, both (N,k1-k0)
+    def _evaluate(self,x0,ref_control,limits,opponents_prediction,car_slots,k0,k1):
+        self.ref_control[:x0.shape[0]] = ref_control
+        # split samples evenly between workers
+        bounds = k0 + np.linspace(0,k1-k0,self.worker_count+1).astype(int)
+        for i,conn in enumerate(self.conns):
+            conn.send((x0,limits,opponents_prediction,car_slots,bounds[i],bounds[i+1]))
+        results = [conn.recv() for conn in self.conns]
+        cost = np.concatenate([result[0] for result in results],axis=1)
+        collision_cost = np.concatenate([result[1] for result in results],axis=1)
+        return cost,collision_cost
+
+    # stop workers and release shared memory
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError,OSError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+        for conn in self.conns:
+            conn.close()
+        # views into shared memory must be released before closing it
+        del self.epsilon,self.epsilon_slots,self.ref_control,self.raceline
+        for shm in self.shms.values():
+            # callers may still hold views (e.g. a NoisePool slot), the mapping then stays until they are gone
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            shm.unlink()
+        return
@@ -21,12 +21,27 @@
 #define TEMPERATURE %(TEMPERATURE)s
 #define DT %(DT)s
 
+// frenet raster, see frenet_raster.py
+// if enabled, closest raceline point and lateral offset are looked up from the raster instead of searched for
+#define USE_FRENET_RASTER %(USE_FRENET_RASTER)s
+#define FRENET_NX %(FRENET_NX)s
+#define FRENET_NY %(FRENET_NY)s
+#define FRENET_ORIGIN_X %(FRENET_ORIGIN_X)s
+#define FRENET_ORIGIN_Y %(FRENET_ORIGIN_Y)s
+#define FRENET_CELL_SIZE %(FRENET_CELL_SIZE)s
+#define FRENET_MAX_DS %(FRENET_MAX_DS)s
+#define RACELINE_LEN_M %(RACELINE_LEN_M)s
+
+// same as COLLISION_RADIUS and COLLISION_WINDOW in mppi_racecar.py
+#define COLLISION_RADIUS %(COLLISION_RADIUS)s
+#define COLLISION_WINDOW %(COLLISION_WINDOW)s
+
 #define PI 3.141592654f
 
 
 
 __device__
-float evaluate_step_cost( float* state, float* u, float in_raceline[][4]);
+float evaluate_step_cost( float* state, float* u, float in_raceline[][4], float* in_frenet);
 __device__
 float evaluate_terminal_cost( float* state,float* x0, float in_raceline[][4]);
 __device__
@@ -45,8 +60,9 @@ extern "C" {
 // in_ref_control: dim horizon*control_dim
 // in_epsilon: dim samples*horizon*control_dim, will be updated so that in_ref_control + in_epsilon respects limits
 // in_raceline is 2d array of size (RACELINE_LEN,4), the first dimension denote different control points, the second denote data, 0:x, 1:y, 2:heading(radian), 3:ref velocity
+// in_frenet: (FRENET_NX,FRENET_NY,3) frenet raster, 0:s, 1:lateral offset, 2:heading, unused if USE_FRENET_RASTER is 0
 __global__
-void evaluate_control_sequence(float* out_cost,float* x0, float* in_ref_control, float* limits, float* in_epsilon, float in_raceline[][4], float opponents_prediction[][HORIZON+1][2],int opponent_count){
+void evaluate_control_sequence(float* out_cost,float* x0, float* in_ref_control, float* limits, float* in_epsilon, float in_raceline[][4], float opponents_prediction[][HORIZON+1][2],int opponent_count, float* in_frenet){
   // get global thread id
   int id = blockIdx.x * blockDim.x + threadIdx.x;
   if (id>=SAMPLE_COUNT){
@@ -96,12 +112,17 @@ void evaluate_control_sequence(float* out_cost,float* x0, float* in_ref_control,
     forward_kinematics(x,u);
 
     // evaluate step cost
-    cost += evaluate_step_cost(x,u,in_raceline);
+    cost += evaluate_step_cost(x,u,in_raceline,in_frenet);
     // cost related to collision avoidance / opponent avoidance
-    // TODO too conservative
+    // only opponent predictions close in time to this step are checked
+    // opponents that can't come close to the ego car are culled on host, see cullOpponents() in mppi_racecar.py
+    int k0 = i+1-COLLISION_WINDOW;
+    k0 = k0<0? 0:k0;
+    int k1 = i+1+COLLISION_WINDOW;
+    k1 = k1>HORIZON? HORIZON:k1;
     for (int j=0; j<opponent_count; j++){
-      for (int k=0; k<HORIZON/2; k++){
-      cost += evaluate_collision_cost(x,opponents_prediction[j][k]);
+      for (int k=k0; k<=k1; k++){
+        cost += evaluate_collision_cost(x,opponents_prediction[j][k]);
       }
     }
 
@@ -152,13 +173,70 @@ void find_closest_id(float* state, float in_raceline[][4], int* ret_idx, float*
 
 }
 
+#if USE_FRENET_RASTER
+// distance between periodic values a-b, wrapped to [-period/2,period/2]
+__device__
+float wrapped_diff(float a, float b, float period){
+  float d = a-b;
+  return d - period*rintf(d/period);
+}
+
+// bilinear lookup in frenet raster, counterpart of FrenetRaster.query() and MppiRacecarCpu.frenetLookup()
+// return index of raceline point at the same s and lateral offset, same meaning as find_closest_id()
+__device__
+void frenet_lookup(float* state, float* in_frenet, int* ret_idx, float* ret_dist){
+  float fx = (state[0]-FRENET_ORIGIN_X)/FRENET_CELL_SIZE;
+  float fy = (state[2]-FRENET_ORIGIN_Y)/FRENET_CELL_SIZE;
+  // clamp to raster edge
+  fx = fminf(fmaxf(fx,0.0f),FRENET_NX-1.001f);
+  fy = fminf(fmaxf(fy,0.0f),FRENET_NY-1.001f);
+  int ix = (int)fx;
+  int iy = (int)fy;
+  float tx = fx-ix;
+  float ty = fy-iy;
+
+  float* v00 = in_frenet + (ix*FRENET_NY + iy)*3;
+  float* v10 = in_frenet + ((ix+1)*FRENET_NY + iy)*3;
+  float* v01 = v00 + 3;
+  float* v11 = v10 + 3;
+
+  // s is periodic, unwrap corners relative to v00
+  float s00 = v00[0];
+  float s10 = s00 + wrapped_diff(v10[0],s00,RACELINE_LEN_M);
+  float s01 = s00 + wrapped_diff(v01[0],s00,RACELINE_LEN_M);
+  float s11 = s00 + wrapped_diff(v11[0],s00,RACELINE_LEN_M);
+  float s = (s00*(1-tx) + s10*tx)*(1-ty) + (s01*(1-tx) + s11*tx)*ty;
+  s = s - floorf(s/RACELINE_LEN_M)*RACELINE_LEN_M;
+
+  float offset = (v00[1]*(1-tx) + v10[1]*tx)*(1-ty) + (v01[1]*(1-tx) + v11[1]*tx)*ty;
+
+  // corners on different sections of the raceline, use the nearest node instead of interpolating
+  float max_ds = fmaxf(fmaxf(fabsf(s10-s00),fabsf(s01-s00)),fabsf(s11-s00));
+  if (max_ds > FRENET_MAX_DS){
+    float* nearest = in_frenet + ((ix+(tx>=0.5f))*FRENET_NY + iy+(ty>=0.5f))*3;
+    s = nearest[0];
+    offset = nearest[1];
+  }
+
+  // first and last point of discretized raceline are both at s=0
+  int idx = __float2int_rn(s*(RACELINE_LEN-1)/RACELINE_LEN_M);
+  *ret_idx = idx < RACELINE_LEN-1? idx:RACELINE_LEN-1;
+  *ret_dist = fabsf(offset);
+  return;
+}
+#endif
+
 __device__
-float evaluate_step_cost( float* state, float* u, float in_raceline[][4]){
+float evaluate_step_cost( float* state, float* u, float in_raceline[][4], float* in_frenet){
   //float heading = state[4];
   int idx;
   float dist;
 
+#if USE_FRENET_RASTER
+  frenet_lookup(state,in_frenet,&idx,&dist);
+#else
   find_closest_id(state,in_raceline,&idx,&dist);
+#endif
 
   // heading cost
   //float cost = dist*0.5 + fabsf(fmodf(in_raceline[idx][2] - heading + PI,2*PI) - PI);
@@ -177,7 +255,7 @@ float evaluate_collision_cost( float* state, float* opponent_pos){
 
   float dx = state[0]-opponent_pos[0];
   float dy = state[2]-opponent_pos[1];
-  float cost = 1.0*(0.1 - sqrtf(dx*dx + dy*dy))*5.0;
+  float cost = 1.0*(COLLISION_RADIUS - sqrtf(dx*dx + dy*dy))*5.0;
 
   return cost>0?cost:0;
 }
@@ -0,0 +1,202 @@
+# vectorized numpy port of mppi_racecar.cu
+# all K samples (of N cars) are advanced together as (N,K,STATE_DIM) arrays
+# IMPORTANT keep this consistent with mppi_racecar.cu, the cost vector should match the cuda kernel
+import numpy as np
+from raceline_index import RacelineIndex
+from rollout_models import KinematicModel
+
+# same as COLLISION_RADIUS and COLLISION_WINDOW in mppi_racecar.cu
+# distance within which an opponent incurs collision cost
+COLLISION_RADIUS = 0.1
+# rollout state at time t is checked against opponent predictions at t-COLLISION_WINDOW*dt ... t+COLLISION_WINDOW*dt
+COLLISION_WINDOW = 1
+
+# range of prediction steps checked at rollout step i (state after i+1 steps), [j0,j1)
+def collisionWindow(i,horizon_steps):
+    return max(0,i+1-COLLISION_WINDOW),min(horizon_steps,i+1+COLLISION_WINDOW)+1
+
+# drop opponents that can't come within COLLISION_RADIUS of the ego car anywhere in the horizon
+# the ego tube is bounded by a disk around x0 growing with time, assuming acceleration magnitude never exceeds reach_accel
+# x0: (STATE_DIM,) ego state
+# opponents_prediction: (opponent_count,HORIZON+1,2)
+# return: predictions of remaining opponents, (remaining_count,HORIZON+1,2)
+def cullOpponents(x0,opponents_prediction,dt,reach_accel):
+    if opponents_prediction.shape[0] == 0:
+        return opponents_prediction
+    horizon_steps = opponents_prediction.shape[1] - 1
+    # latest ego time prediction step j is compared against
+    t = np.minimum(np.arange(horizon_steps+1)+COLLISION_WINDOW,horizon_steps)*dt
+    v0 = np.sqrt(x0[1]*x0[1] + x0[3]*x0[3])
+    reach = v0*t + 0.5*reach_accel*t*t + COLLISION_RADIUS
+    dx = opponents_prediction[:,:,0] - x0[0]
+    dy = opponents_prediction[:,:,1] - x0[2]
+    keep = np.any(dx*dx + dy*dy <= reach*reach,axis=1)
+    return opponents_prediction[keep]
+
+class MppiRacecarCpu:
+    # discretized_raceline: (RACELINE_LEN,4), 0:x, 1:y, 2:heading(radian), 3:ref velocity
+    #       evenly spaced in s, first and last point coincide, as in ctrlMppiWrapper.prepareDiscretizedRaceline()
+    # frenet_raster: optional FrenetRaster (frenet_raster.py), if given lateral offset and s are looked up
+    #       from the raster instead of searching for the closest raceline point
+    # rollout_model: vehicle model used in rollouts, see rollout_models.py, default to KinematicModel as in the kernel
+    def __init__(self,samples_count,horizon_steps,control_dim,state_dim,dt,discretized_raceline,frenet_raster=None,rollout_model=None):
+        self.K = samples_count
+        self.T = horizon_steps
+        self.m = control_dim
+        self.state_dim = state_dim
+        self.dt = np.float32(dt)
+
+        self.discretized_raceline = np.array(discretized_raceline,dtype=np.float32).reshape(-1,4)
+        self.raceline_len = self.discretized_raceline.shape[0]
+        self.raceline_velocity = self.discretized_raceline[:,3].copy()
+        # for nearest raceline point queries
+        self.raceline_index = RacelineIndex(self.discretized_raceline[:,:2])
+        self.frenet_raster = frenet_raster
+        if rollout_model is None:
+            rollout_model = KinematicModel()
+        self.rollout_model = rollout_model
+        # opponent collision part of the cost returned by last evaluate call, same shape as the cost
+        self.last_collision_cost = None
+        # rollout state, control, cost and collision cost buffers reused by every evaluate call, see rolloutBuffers()
+        self.buffers = None
+        return
+
+    # return views of the rollout buffers for car_count cars with samples samples each
+    # buffers are grown to the largest car_count and samples seen (at least K samples) and kept
+    # return: x (N,samples,STATE_DIM), control (N,samples,HORIZON,CONTROL_DIM), cost (N,samples), collision_cost (N,samples)
+    def rolloutBuffers(self,car_count,samples):
+        if self.buffers is None or self.buffers[0].shape[0] < car_count or self.buffers[0].shape[1] < samples:
+            if not (self.buffers is None):
+                car_count_max = max(car_count,self.buffers[0].shape[0])
+                samples_max = max(samples,self.buffers[0].shape[1])
+            else:
+                car_count_max = car_count
+                samples_max = max(samples,self.K)
+            self.buffers = (np.zeros((car_count_max,samples_max,self.state_dim),dtype=np.float32),
+                    np.zeros((car_count_max,samples_max,self.T,self.m),dtype=np.float32),
+                    np.zeros((car_count_max,samples_max),dtype=np.float32),
+                    np.zeros((car_count_max,samples_max),dtype=np.float32))
+        return tuple(buf[:car_count,:samples] for buf in self.buffers)
+
+    # counterpart of evaluate_control_sequence() in mppi_racecar.cu
+    # x0: (STATE_DIM,) initial state
+    # ref_control: (HORIZON,CONTROL_DIM) or flattened
+    # limits: [[u0_low,u0_high],[u1_low,u1_high]...]
+    # epsilon: (samples,HORIZON,CONTROL_DIM) float32, will be updated IN PLACE so that ref_control + epsilon respects limits
+    #       samples is usually K, a subset of samples can be evaluated by passing a slice
+    # opponents_prediction: (opponent_count,HORIZON+1,2) or empty list
+    # return: cost, (samples,) float32, a view into a buffer that the next evaluate call overwrites
+    def evaluateControlSequence(self,x0,ref_control,limits,epsilon,opponents_prediction):
+        ref_control = np.array(ref_control,dtype=np.float32).reshape(1,self.T,self.m)
+        # a batch of one car, epsilon[np.newaxis] is a view so in place update still applies
+        cost = self.evaluateControlSequenceBatch(np.array(x0).reshape(1,-1),ref_control,limits,epsilon[np.newaxis],[opponents_prediction])
+        self.last_collision_cost = self.last_collision_cost[0]
+        return cost[0]
+
+    # evaluate samples for several cars in one pass, each car has its own initial state, ref control and opponents
+    # x0: (N,STATE_DIM)
+    # ref_control: (N,HORIZON,CONTROL_DIM)
+    # limits: [[u0_low,u0_high],[u1_low,u1_high]...], shared by all cars
+    # epsilon: (N,samples,HORIZON,CONTROL_DIM) float32, updated IN PLACE as in evaluateControlSequence()
+    #       or a list of N (samples,HORIZON,CONTROL_DIM) arrays, e.g. slots from NoisePool.getBatch()
+    # opponents_prediction: list of N, each (opponent_count,HORIZON+1,2) or empty list
+    # return: cost, (N,samples) float32, a view into a buffer that the next evaluate call overwrites
+    def evaluateControlSequenceBatch(self,x0,ref_control,limits,epsilon,opponents_prediction):
+        car_count = len(epsilon)
+        samples = epsilon[0].shape[0]
+        limits = np.array(limits,dtype=np.float32).reshape(self.m,2)
+        ref_control = np.array(ref_control,dtype=np.float32).reshape(car_count,1,self.T,self.m)
+        x,control,cost,collision_cost = self.rolloutBuffers(car_count,samples)
+
+        # clip control, then update epsilon to reflect the clipped value
+        for i in range(car_count):
+            np.add(ref_control[i],epsilon[i],out=control[i])
+            np.clip(control[i],limits[:,0],limits[:,1],out=control[i])
+            np.subtract(control[i],ref_control[i],out=epsilon[i])
+
+        x0 = np.array(x0,dtype=np.float32).reshape(car_count,1,self.state_dim)
+        x[:] = x0
+        opponent_pos = self.collectOpponents(opponents_prediction)
+
+        cost[:] = 0.0
+        collision_cost[:] = 0.0
+        for i in range(self.T):
+            u = control[:,:,i,:]
+            # step forward dynamics, update state x in place
+            self.rollout_model.advance(x,u,self.dt)
+            cost += self.evaluateStepCost(x,u)
+            # cost related to collision avoidance / opponent avoidance
+            # only opponent predictions close in time to this step are checked
+            if not (opponent_pos is None):
+                j0,j1 = collisionWindow(i,self.T)
+                collision_cost += self.evaluateCollisionCost(x,opponent_pos[:,:,j0:j1].reshape(car_count,-1,2))
+
+        cost += collision_cost
+        cost += self.evaluateTerminalCost(x,x0)
+        self.last_collision_cost = collision_cost
+        return cost
+
+    # opponents_prediction: list of N, each (opponent_count,HORIZON+1,2) or empty list
+    # return: (N,max_opponent_count,HORIZON+1,2), cars with fewer opponents are padded with far away points
+    #         None if no car has any opponent
+    def collectOpponents(self,opponents_prediction):
+        opponents_prediction = [np.array(opp,dtype=np.float32).reshape(-1,self.T+1,2) for opp in opponents_prediction]
+        max_count = max([opp.shape[0] for opp in opponents_prediction])
+        if max_count == 0:
+            return None
+        opponent_pos = np.full((len(opponents_prediction),max_count,self.T+1,2),1e6,dtype=np.float32)
+        for i,opp in enumerate(opponents_prediction):
+            opponent_pos[i,:opp.shape[0]] = opp
+        return opponent_pos
+
+    # x: (...,STATE_DIM)
+    # return: index of closest raceline point (...), and distance to it
+    # same result as the exhaustive search in find_closest_id() in cuda
+    def findClosestId(self,x):
+        return self.raceline_index.query(x[...,0],x[...,2])
+
+    # x: (...,STATE_DIM)
+    # return: index of raceline point at the same s, and lateral offset, looked up from frenet raster
+    def frenetLookup(self,x):
+        s,offset,_ = self.frenet_raster.query(x[...,0],x[...,2])
+        # first and last point of discretized raceline are both at s=0
+        idx = np.rint(s*((self.raceline_len-1)/self.frenet_raster.raceline_len_m)).astype(np.int64)
+        return np.minimum(idx,self.raceline_len-1),np.abs(offset)
+
+    # x: (N,samples,STATE_DIM), u: (N,samples,CONTROL_DIM)
+    def evaluateStepCost(self,x,u):
+        if self.frenet_raster is None:
+            idx,dist = self.findClosestId(x)
+        else:
+            idx,dist = self.frenetLookup(x)
+        # velocity cost
+        # current velocity - target velocity at closest ref point
+        dv = np.sqrt(x[...,1]*x[...,1] + x[...,3]*x[...,3]) - self.raceline_velocity[idx]
+        cost = dist + 0.1*dv*dv
+        return cost*5.0
+
+    # x: (N,samples,STATE_DIM)
+    # opponent_pos: (N,P,2), positions each car's samples are checked against at this step
+    def evaluateCollisionCost(self,x,opponent_pos):
+        # points outside the bounding box of all samples of a car (grown by collision radius)
+        # can't add cost to any of them, only points inside the box of at least one car are evaluated
+        # this is exact, the result is the same as evaluating every point
+        x_lo = np.min(x[...,0],axis=1,keepdims=True) - COLLISION_RADIUS
+        x_hi = np.max(x[...,0],axis=1,keepdims=True) + COLLISION_RADIUS
+        y_lo = np.min(x[...,2],axis=1,keepdims=True) - COLLISION_RADIUS
+        y_hi = np.max(x[...,2],axis=1,keepdims=True) + COLLISION_RADIUS
+        px = opponent_pos[...,0]
+        py = opponent_pos[...,1]
+        active = np.any((px >= x_lo) & (px <= x_hi) & (py >= y_lo) & (py <= y_hi),axis=0)
+        if not np.any(active):
+            return np.float32(0.0)
+        opponent_pos = opponent_pos[:,active]
+
+        dx = x[...,0,np.newaxis] - opponent_pos[:,np.newaxis,:,0]
+        dy = x[...,2,np.newaxis] - opponent_pos[:,np.newaxis,:,1]
+        cost = 1.0*(COLLISION_RADIUS - np.sqrt(dx*dx + dy*dy))*5.0
+        return np.sum(np.maximum(cost,0.0),axis=-1)
+
+    # NOTE ignoring terminal cost, same as the kernel
+    def evaluateTerminalCost(self,x,x0):
+        return np.zeros(x.shape[:-1],dtype=np.float32)
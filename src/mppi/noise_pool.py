@@ -0,0 +1,145 @@
+# pre-generated gaussian noise for MPPI sampling
+# a background thread fills a ring buffer of (K,T,m) slots with noise ~N(0,noise_cov)
+# get() hands out a view of the next filled slot, no copy is made
+# the slot remains valid (and may be modified in place, e.g. clipped) until the next call to get()
+# getBatch() hands out several slots at once, e.g. one for each car in MPPI.controlBatch()
+import numpy as np
+from threading import Thread,Condition
+
+class NoisePool:
+    # slot_count: number of (K,T,m) noise tensors in the ring buffer, at least 2
+    # seed: if given, the sequence of noise handed out by get() is reproducible
+    #       regardless of the timing of the background thread
+    # threaded: if False, slots are filled in get() instead of a background thread
+    # buffer: optional (slot_count,K,T,m) float32 array to use as the ring buffer, overrides slot_count
+    #       e.g. MppiRacecarPool.epsilon_slots, so noise is generated directly in shared memory
+    def __init__(self,samples_count,horizon_steps,control_dim,noise_cov,slot_count=4,seed=None,threaded=True,buffer=None):
+        self.K = samples_count
+        self.T = horizon_steps
+        self.m = control_dim
+        self.rng = np.random.default_rng(seed)
+
+        if buffer is None:
+            self.slot_count = max(2,slot_count)
+            self.buffer = np.zeros((self.slot_count,self.K,self.T,self.m),dtype=np.float32)
+        else:
+            assert buffer.shape[0] >= 2 and buffer.shape[1:] == (self.K,self.T,self.m) and buffer.dtype == np.float32
+            self.slot_count = buffer.shape[0]
+            self.buffer = buffer
+        # transform applied to unit gaussian noise, noise = z @ L.T
+        self.L = self._choleskyFactor(noise_cov)
+        # transform each slot was generated with
+        self.slot_L = [None]*self.slot_count
+        self.filled = [False]*self.slot_count
+        # next slot to be filled/handed out
+        self.write_idx = 0
+        self.read_idx = 0
+        # slots currently handed out
+        self.used_ids = []
+
+        self.cv = Condition()
+        self.threaded = threaded
+        self.exit_request = False
+        if threaded:
+            self.thread = Thread(target=self._fillLoop,daemon=True)
+            self.thread.start()
+        return
+
+    def _choleskyFactor(self,noise_cov):
+        noise_cov = np.array(noise_cov,dtype=np.float64).reshape(self.m,self.m)
+        return np.linalg.cholesky(noise_cov).astype(np.float32)
+
+    # apply linear transform to noise stored in slot, in place, slot = slot @ L.T
+    def _transform(self,slot,L):
+        if np.count_nonzero(L - np.diag(np.diag(L))) == 0:
+            slot *= np.diag(L)
+        else:
+            slot[:] = slot @ L.T
+        return
+
+    def _fill(self,idx,L):
+        slot = self.buffer[idx]
+        self.rng.standard_normal(out=slot,dtype=np.float32)
+        self._transform(slot,L)
+        self.slot_L[idx] = L
+        return
+
+    def _fillLoop(self):
+        while True:
+            with self.cv:
+                while not self.exit_request and self.filled[self.write_idx]:
+                    self.cv.wait()
+                if self.exit_request:
+                    return
+                idx = self.write_idx
+                L = self.L
+            # slot is neither filled nor in use, safe to write without holding lock
+            self._fill(idx,L)
+            with self.cv:
+                self.filled[idx] = True
+                self.write_idx = (idx+1)%self.slot_count
+                self.cv.notify_all()
+
+    # update covariance of the noise, slots already filled are rescaled when handed out
+    def setNoiseCov(self,noise_cov):
+        L = self._choleskyFactor(noise_cov)
+        with self.cv:
+            self.L = L
+        return
+
+    # get next (K,T,m) noise tensor
+    # noise_cov: if given and different from the current covariance, update covariance first
+    def get(self,noise_cov=None):
+        return self.getBatch(1,noise_cov)[0]
+
+    # get the next count (K,T,m) noise tensors, same as count calls to get()
+    # but all of them remain valid until the next call to get() or getBatch()
+    # count: at most slot_count
+    # return: list of views into the ring buffer, not necessarily adjacent
+    def getBatch(self,count,noise_cov=None):
+        assert count <= self.slot_count
+        if not (noise_cov is None):
+            L = self._choleskyFactor(noise_cov)
+            if not np.array_equal(L,self.L):
+                self.setNoiseCov(noise_cov)
+
+        with self.cv:
+            # release the slots handed out last time
+            if len(self.used_ids) > 0:
+                for idx in self.used_ids:
+                    self.filled[idx] = False
+                self.used_ids = []
+                self.cv.notify_all()
+
+            for i in range(count):
+                idx = self.read_idx
+                if not self.threaded and not self.filled[idx]:
+                    self._fill(idx,self.L)
+                    self.filled[idx] = True
+                while not self.filled[idx]:
+                    self.cv.wait()
+                self.read_idx = (idx+1)%self.slot_count
+                self.used_ids.append(idx)
+            L = self.L
+
+        slots = []
+        for idx in self.used_ids:
+            # noise_cov changed since this slot was filled, rescale in place
+            slot = self.buffer[idx]
+            if not np.array_equal(self.slot_L[idx],L):
+                # noise = z @ L_old.T, we want z @ L.T = noise @ (L @ inv(L_old)).T
+                A = (L.astype(np.float64) @ np.linalg.inv(self.slot_L[idx].astype(np.float64))).astype(np.float32)
+                self._transform(slot,A)
+                self.slot_L[idx] = L
+            slots.append(slot)
+        return slots
+
+    def close(self):
+        with self.cv:
+            self.exit_request = True
+            self.cv.notify_all()
+        if self.threaded:
+            self.thread.join()
+        # release the buffer, it may be shared memory owned by someone else
+        self.buffer = None
+        return
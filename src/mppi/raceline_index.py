@@ -0,0 +1,107 @@
+# spatial index for nearest raceline point queries
+# the area around the raceline is divided into a uniform grid, each cell stores the (few) raceline points
+# that can possibly be the closest point to any location inside that cell
+# a query only needs to search the candidates of the cell the query point falls in
+# the result is identical to a brute force argmin over all raceline points, including across the lap seam
+import numpy as np
+
+class RacelineIndex:
+    # points: (N,2), discretized raceline x,y, in meter
+    # cell_size: side length of a grid cell, in meter
+    # margin: grid extends this much beyond the bounding box of the raceline
+    #         queries outside the grid fall back to brute force search
+    def __init__(self,points,cell_size=0.05,margin=0.5):
+        points = np.array(points,dtype=np.float32).reshape(-1,2)
+        self.raceline_len = points.shape[0]
+        self.px = np.ascontiguousarray(points[:,0])
+        self.py = np.ascontiguousarray(points[:,1])
+
+        self.cell_size = float(cell_size)
+        self.origin = points.min(axis=0).astype(np.float64) - margin
+        upper = points.max(axis=0).astype(np.float64) + margin
+        # (cols along x, rows along y)
+        self.grid_shape = np.ceil((upper-self.origin)/self.cell_size).astype(int)
+        self.candidates = self._buildCandidates(points.astype(np.float64))
+        return
+
+    # for each cell, find all raceline points whose minimum distance to the cell
+    # is no greater than the smallest maximum distance from the cell to any raceline point
+    def _buildCandidates(self,points):
+        nx,ny = self.grid_shape
+        h = self.cell_size
+        ix,iy = np.meshgrid(np.arange(nx),np.arange(ny),indexing='ij')
+        x_lo = (self.origin[0] + ix.flatten()*h)[:,np.newaxis]
+        y_lo = (self.origin[1] + iy.flatten()*h)[:,np.newaxis]
+        x_hi = x_lo + h
+        y_hi = y_lo + h
+
+        cell_candidates = []
+        # process cells in chunks to limit memory usage
+        chunk = 256
+        for i in range(0,x_lo.shape[0],chunk):
+            sl = slice(i,i+chunk)
+            dx_min = np.maximum(np.maximum(x_lo[sl]-points[:,0],points[:,0]-x_hi[sl]),0.0)
+            dy_min = np.maximum(np.maximum(y_lo[sl]-points[:,1],points[:,1]-y_hi[sl]),0.0)
+            d_min = np.sqrt(dx_min**2 + dy_min**2)
+            dx_max = np.maximum(np.abs(points[:,0]-x_lo[sl]),np.abs(points[:,0]-x_hi[sl]))
+            dy_max = np.maximum(np.abs(points[:,1]-y_lo[sl]),np.abs(points[:,1]-y_hi[sl]))
+            d_max = np.sqrt(dx_max**2 + dy_max**2)
+            # small slack to account for float32 rounding in queries
+            bound = np.min(d_max,axis=1,keepdims=True) + 1e-4
+            for mask in (d_min <= bound):
+                cell_candidates.append(np.nonzero(mask)[0])
+
+        # number of candidates in each cell, a query only needs to search up to the largest count among queried cells
+        self.candidate_count = np.array([len(c) for c in cell_candidates],dtype=np.int32)
+        max_count = np.max(self.candidate_count)
+        # pad to a rectangular table, padding repeats the largest candidate index
+        # argmin returns the first occurrence so ties still resolve to the smallest index
+        candidates = np.empty((len(cell_candidates),max_count),dtype=np.int32)
+        for i,c in enumerate(cell_candidates):
+            candidates[i,:len(c)] = c
+            candidates[i,len(c):] = c[-1]
+        return candidates
+
+    # find index of closest raceline point
+    # x,y: array of any shape, in meter
+    # return: idx, dist, same shape as x
+    def query(self,x,y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        shape = x.shape
+        x = x.reshape(-1)
+        y = y.reshape(-1)
+        dtype = np.result_type(x.dtype,np.float32)
+        idx = np.empty(x.shape[0],dtype=np.int64)
+        dist2 = np.empty(x.shape[0],dtype=dtype)
+
+        ix = np.floor((x-self.origin[0])/self.cell_size)
+        iy = np.floor((y-self.origin[1])/self.cell_size)
+        inside = (ix>=0) & (ix<self.grid_shape[0]) & (iy>=0) & (iy<self.grid_shape[1])
+
+        if np.all(inside):
+            sel = slice(None)
+        else:
+            sel = np.nonzero(inside)[0]
+            outside = np.nonzero(~inside)[0]
+            idx[outside],dist2[outside] = self._bruteForce(x[outside],y[outside])
+
+        cells = ix[sel].astype(np.int64)*self.grid_shape[1] + iy[sel].astype(np.int64)
+        width = np.max(self.candidate_count[cells],initial=1)
+        cand = self.candidates[cells,:width]
+        dx = x[sel,np.newaxis] - self.px[cand]
+        dy = y[sel,np.newaxis] - self.py[cand]
+        cand_dist2 = dx*dx + dy*dy
+        best = np.argmin(cand_dist2,axis=1)
+        rows = np.arange(cand.shape[0])
+        idx[sel] = cand[rows,best]
+        dist2[sel] = cand_dist2[rows,best]
+
+        return idx.reshape(shape),np.sqrt(dist2).reshape(shape)
+
+    def _bruteForce(self,x,y):
+        dx = x[:,np.newaxis] - self.px
+        dy = y[:,np.newaxis] - self.py
+        dist2 = dx*dx + dy*dy
+        idx = np.argmin(dist2,axis=1)
+        return idx,dist2[np.arange(x.shape[0]),idx]
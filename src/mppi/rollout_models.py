@@ -0,0 +1,130 @@
+# vehicle models for batched MPPI rollouts on cpu, see MppiRacecarCpu
+# a rollout model provides advance(x,u,dt) that steps all samples forward by dt, updating x IN PLACE
+# x: (...,STATE_DIM) (x,dx,y,dy,heading,omega), dx,dy in global frame
+# u: (...,CONTROL_DIM) (throttle,steering)
+# models are picklable so they can be sent to MppiRacecarPool workers
+import numpy as np
+
+# kinematic model, same as forward_kinematics() in mppi_racecar.cu
+# note this model is tuned on actual car data, it may not work well with dynamic simulator
+class KinematicModel:
+    name = 'kinematic'
+
+    def advance(self,x,u,dt):
+        dt = np.float32(dt)
+        dx = x[...,1]
+        dy = x[...,3]
+        psi = x[...,4]
+
+        throttle = u[...,0]
+        steering = u[...,1]
+
+        cos_psi = np.cos(psi)
+        sin_psi = np.sin(psi)
+        tan_steering = np.tan(steering)
+
+        # convert to car frame
+        local_dx = dx*cos_psi + dy*sin_psi
+        local_dy = -dx*sin_psi + dy*cos_psi
+
+        beta = np.arctan(0.036/0.102*tan_steering)
+        local_dx = local_dx + (throttle - 0.24) * 7.0 * dt
+        # avoid negative velocity
+        local_dx = np.maximum(local_dx,0.0)
+        local_dy = np.sqrt(local_dx*local_dx + local_dy*local_dy) * np.sin(beta)
+        local_dy += -0.68*local_dx*steering
+
+        dpsi = local_dx/0.102*tan_steering
+
+        # convert back to global frame
+        dx = local_dx*cos_psi - local_dy*sin_psi
+        dy = local_dx*sin_psi + local_dy*cos_psi
+
+        x[...,0] += dx * dt
+        x[...,1] = dx
+        x[...,2] += dy * dt
+        x[...,3] = dy
+        x[...,4] += dpsi * dt
+        x[...,5] = dpsi
+        return x
+
+# dynamic bicycle model with pacejka tire and motor model, same as ethCarSim and ukf.advanceModel()
+# default parameters are the initial values in ukf.py
+class PacejkaModel:
+    name = 'pacejka'
+
+    # tire: Df,Dr,C,B, B is per radian
+    # motor: Cm1,Cm2,Cr,Cd
+    def __init__(self,Df=1.0,Dr=1.0,C=1.4,B=0.714/np.pi*180.0,Cm1=7.0,Cm2=0.0,Cr=0.24*7.0,Cd=0.0):
+        self.Df = Df
+        self.Dr = Dr
+        self.C = C
+        self.B = B
+        self.Cm1 = Cm1
+        self.Cm2 = Cm2
+        self.Cr = Cr
+        self.Cd = Cd
+
+        self.m = 0.1667
+        self.lf = 0.09-0.036
+        self.lr = 0.036
+        self.Iz = self.m/12.0*(0.1**2+0.1**2)
+        # longitudinal speed used in slip angle calculation is kept above this
+        # the model is singular at vx = 0
+        self.min_vx = 0.05
+        return
+
+    def advance(self,x,u,dt):
+        dt = np.float32(dt)
+        vxg = x[...,1]
+        vyg = x[...,3]
+        psi = x[...,4]
+        omega = x[...,5]
+
+        throttle = u[...,0]
+        steering = u[...,1]
+
+        cos_psi = np.cos(psi)
+        sin_psi = np.sin(psi)
+        # convert to local frame
+        vx = vxg*cos_psi + vyg*sin_psi
+        vy = -vxg*sin_psi + vyg*cos_psi
+
+        # tire model
+        vx_slip = np.maximum(vx,self.min_vx)
+        slip_f = -np.arctan((omega*self.lf + vy)/vx_slip) + steering
+        slip_r = np.arctan((omega*self.lr - vy)/vx_slip)
+
+        # lateral forces normalized by mass
+        # TODO add load transfer
+        Ffy = self.Df * np.sin(self.C*np.arctan(self.B*slip_f)) * (9.8*self.lr/(self.lr + self.lf))
+        Fry = self.Dr * np.sin(self.C*np.arctan(self.B*slip_r)) * (9.8*self.lf/(self.lr + self.lf))
+
+        # motor model
+        Frx = (self.Cm1 - self.Cm2*vx)*throttle - self.Cr - self.Cd*vx*vx
+
+        # dynamics
+        cos_steering = np.cos(steering)
+        d_vx = Frx - Ffy*np.sin(steering) + vy*omega
+        d_vy = Fry + Ffy*cos_steering - vx*omega
+        d_omega = self.m/self.Iz*(Ffy*self.lf*cos_steering - Fry*self.lr)
+
+        # discretization
+        vx = vx + d_vx*dt
+        vy = vy + d_vy*dt
+        omega = omega + d_omega*dt
+
+        # convert back to global frame
+        vxg = vx*cos_psi - vy*sin_psi
+        vyg = vx*sin_psi + vy*cos_psi
+
+        x[...,0] += vxg*dt
+        x[...,1] = vxg
+        x[...,2] += vyg*dt
+        x[...,3] = vyg
+        x[...,4] += omega*dt + 0.5*d_omega*dt*dt
+        x[...,5] = omega
+        return x
+
+# name used in ctrlMppiWrapper config -> model class
+rollout_models = {KinematicModel.name:KinematicModel, PacejkaModel.name:PacejkaModel}
@@ -0,0 +1,87 @@
+# lap-indexed library of converged MPPI control sequences
+# the raceline is divided into bins along s, each bin keeps the last converged control sequence solved there
+# when the car arrives at a position again after a reset or a large disturbance,
+# the sequence stored at the nearest bin is used as warm start instead of zeros / a stale shifted plan
+import os
+import hashlib
+import numpy as np
+from common import *
+
+class WarmStartLibrary:
+    # raceline_len_m: total length of raceline, s wraps around at this value
+    # horizon_steps, control_dim, dt: MPPI settings, stored sequences are (horizon_steps,control_dim) at dt
+    # bin_size: spacing of bins along s, in meter
+    # max_gap: lookup only returns an entry within this distance (m) along s
+    def __init__(self,raceline_len_m,horizon_steps,control_dim,dt,bin_size=0.05,max_gap=0.2):
+        self.raceline_len_m = float(raceline_len_m)
+        self.T = horizon_steps
+        self.m = control_dim
+        self.dt = float(dt)
+        self.bin_count = max(1,int(np.ceil(self.raceline_len_m/bin_size)))
+        self.bin_size = self.raceline_len_m/self.bin_count
+        self.max_gap = max_gap
+        self.controls = np.zeros((self.bin_count,self.T,self.m),dtype=np.float32)
+        self.filled = np.zeros(self.bin_count,dtype=bool)
+        # file the library is saved to by save(), set by fromTrack()
+        self.filename = None
+        return
+
+    # create an empty library for track, or load it from the file next to the track file
+    # tag: distinguishes libraries on the same track solved with different settings, e.g. rollout model
+    @staticmethod
+    def fromTrack(track,horizon_steps,control_dim,dt,bin_size=0.05,max_gap=0.2,tag=''):
+        library = WarmStartLibrary(track.raceline_len_m,horizon_steps,control_dim,dt,bin_size,max_gap)
+        track_filename = getattr(track,'raceline_filename',None)
+        if track_filename is None:
+            return library
+
+        key = WarmStartLibrary.cacheKey(track.raceline_s,track.raceline_len_m,horizon_steps,control_dim,dt,library.bin_size,tag)
+        library.filename = os.path.splitext(track_filename)[0] + "_warmstart_%s.npz"%(key)
+        if os.path.isfile(library.filename):
+            data = np.load(library.filename)
+            library.controls[:] = data['controls']
+            library.filled[:] = data['filled']
+            print_info("loaded %d warm start entries from %s"%(np.count_nonzero(library.filled),library.filename))
+        return library
+
+    # hash of everything the stored sequences depend on
+    @staticmethod
+    def cacheKey(raceline_s,raceline_len_m,horizon_steps,control_dim,dt,bin_size,tag=''):
+        h = hashlib.sha1()
+        t,c,k = raceline_s
+        h.update(np.asarray(t,dtype=np.float64).tobytes())
+        for coeff in c:
+            h.update(np.asarray(coeff,dtype=np.float64).tobytes())
+        h.update(np.array([k,raceline_len_m,horizon_steps,control_dim,dt,bin_size],dtype=np.float64).tobytes())
+        h.update(tag.encode())
+        return h.hexdigest()[:10]
+
+    def save(self,filename=None):
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            return
+        np.savez(filename,controls=self.controls,filled=self.filled)
+        print_ok("%d warm start entries saved at %s"%(np.count_nonzero(self.filled),filename))
+        return
+
+    def binIndex(self,s):
+        return int((s%self.raceline_len_m)/self.bin_size) % self.bin_count
+
+    # uu: (T,m) converged control sequence solved at s
+    def record(self,s,uu):
+        i = self.binIndex(s)
+        self.controls[i] = uu
+        self.filled[i] = True
+        return
+
+    # return: (T,m) sequence stored at the filled bin nearest to s, None if there is none within max_gap
+    def lookup(self,s):
+        i = self.binIndex(s)
+        max_bins = int(self.max_gap/self.bin_size)
+        for d in range(max_bins+1):
+            for j in (i+d,i-d):
+                j = j % self.bin_count
+                if self.filled[j]:
+                    return self.controls[j]
+        return None
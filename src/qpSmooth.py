@@ -7,6 +7,7 @@ import warnings
 import pickle
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy import sparse
 from math import pi,isclose,radians,cos,sin,atan2,tan
 from scipy.interpolate import splprep, splev,CubicSpline,interp1d
 
@@ -18,6 +19,11 @@ from common import *
 from RCPTrack import RCPtrack
 
 
+# scipy sparse matrix -> cvxopt spmatrix
+def toCvxoptSparse(M):
+    M = sparse.coo_matrix(M)
+    return cvxopt.spmatrix(M.data.tolist(),M.row.tolist(),M.col.tolist(),size=M.shape)
+
 class QpSmooth(RCPtrack):
     # track: RCPtrack object
     def __init__(self):
@@ -102,61 +108,54 @@ class QpSmooth(RCPtrack):
 
     # generate a bezier spline matching derivative estimated from lagrange interpolation
     # break_pts.shape = (n,2)
-    # return: vector function, domain [0,len(points)]
+    # return: control points of all segments, (n,6,2), see evalBezierSpline()
+    # all segments are handled at once, this gives the same result as calling bezierCurve() on each
     def bezierSpline(self,break_pts):
-        break_pts = np.array(break_pts).T
+        break_pts = np.array(break_pts,dtype=np.float64).T
+        # r_k-1, r_k, r_k+1 for every k, (2,n) each
+        rl = np.roll(break_pts,1,axis=1)
+        r = break_pts
+        rr = np.roll(break_pts,-1,axis=1)
 
         # calculate first and second derivative
         # w.r.t. ds, estimated with 2-norm
-        df = []
-        ddf = []
-        n = break_pts.shape[1]
-        for i in range(n):
-            rl = break_pts[:,(i-1)%n]
-            r  = break_pts[:,(i)%n]
-            rr = break_pts[:,(i+1)%n]
-            points = [rl, r, rr]
-            
-            ((al,a,ar),(bl,b,br)) = self.lagrangeDer(points)
-            df.append( al*rl + a*r + ar*rr)
-            ddf.append(bl*rl + b*r + br*rr)
-
-        P = []
-        for i in range(n):
-            # generate bezier spline segments
-            rl = break_pts[:,(i)%n]
-            r  = break_pts[:,(i+1)%n]
-            section_P = self.bezierCurve([rl,r],[df[i],df[(i+1)%n]],[ddf[i],ddf[(i+1)%n]],ds=None)
-            # NOTE testing
-            B = lambda t,p: (1-t)**5*p[0] + 5*t*(1-t)**4*p[1] + 10*t**2*(1-t)**3*p[2] + 10*t**3*(1-t)**2*p[3] + 5*t**4*(1-t)*p[4] + t**5*p[5]
-            x_i = B(0,section_P[:,0])
-            y_i = B(0,section_P[:,1])
-            x_f = B(1,section_P[:,0])
-            y_f = B(1,section_P[:,1])
-            assert np.isclose(x_i,rl[0],atol=1e-5) and np.isclose(y_i,rl[1],atol=1e-5) and np.isclose(x_f,r[0],atol=1e-5) and np.isclose(y_f,r[1],atol=1e-5)
-
-            P.append(section_P)
-
-        # NOTE verify P dimension n*2*5
-        return np.array(P)
-
-    # P: array of control points, shape n*2*5
-    # u (iterable): parameter, domain [0,n], where n is number of break points in spline generation
+        ((al,a,ar),(bl,b,br)) = self.lagrangeDer([rl,r,rr])
+        df = al*rl + a*r + ar*rr
+        ddf = bl*rl + b*r + br*rr
+
+        # segment k goes from r_k to r_k+1, see bezierCurve() for the linear system
+        ds = np.linalg.norm(rr-r,axis=0)
+        df_r = np.roll(df,-1,axis=1)
+        ddf_r = np.roll(ddf,-1,axis=1)
+        # (n,6,2)
+        rhs = np.stack([r,rr,df*ds,df_r*ds,ddf*ds*ds,ddf_r*ds*ds],axis=1).transpose(2,1,0)
+        A = [[ 1, 0, 0, 0, 0, 0],
+             [ 0, 0, 0, 0, 0, 1],
+             [-5, 5, 0, 0, 0, 0],
+             [ 0, 0, 0, 0,-5, 5],
+             [20,-40,20,0, 0, 0],
+             [0 , 0, 0,20,-40,20]]
+        A = np.array(A,dtype=np.float64)
+        P = np.linalg.solve(A[np.newaxis],rhs)
+
+        # NOTE testing, B(0) and B(1) of each segment should be its end points
+        assert np.allclose(P[:,0,:],r.T,atol=1e-5) and np.allclose(P[:,5,:],rr.T,atol=1e-5)
+        return P
 
+    # P: array of control points, shape n*6*2
+    # u (iterable): parameter, domain [0,n], where n is number of break points in spline generation
+    # return: (len(u),2)
     def evalBezierSpline(self,P,u):
-        u = np.array(u).reshape(-1,1)
+        u = np.array(u,dtype=np.float64).reshape(-1)
         n = len(P)
         assert (u>=0).all()
         assert (u<=n).all()
 
-        B = lambda t,p: (1-t)**5*p[0] + 5*t*(1-t)**4*p[1] + 10*t**2*(1-t)**3*p[2] + 10*t**3*(1-t)**2*p[3] + 5*t**4*(1-t)*p[4] + t**5*p[5]
-
-        try:
-            r = [ [B(uu%1,np.array(P[int(uu)%n,:,0])),B(uu%1,np.array(P[int(uu)%n,:,1]))] for uu in u]
-        except Warning as e:
-            print(e)
-
-        return np.array(r)
+        index = u.astype(np.int64) % n
+        t = (u % 1)[:,np.newaxis]
+        # bernstein basis, (len(u),6)
+        basis = np.hstack([(1-t)**5, 5*t*(1-t)**4, 10*t**2*(1-t)**3, 10*t**3*(1-t)**2, 5*t**4*(1-t), t**5])
+        return np.einsum('mk,mkd->md',basis,P[index])
 
     # calculate arc length of <x,y> = fun(u) from ui to uf
     def arcLen(self,fun,ui,uf):
@@ -170,112 +169,74 @@ class QpSmooth(RCPtrack):
             last_x,last_y = x,y
         return s
 
+    # arc length of every segment [i,i+1] of self.raceline_fun, i = 0..n-1
+    # same as arcLen() on each segment, evaluated in one call
+    def segmentArcLen(self,n):
+        steps = 20
+        uu = np.arange(n)[:,np.newaxis] + np.linspace(0,1,steps)
+        r = self.raceline_fun(uu.flatten()).reshape(n,steps,2)
+        return np.sum(np.linalg.norm(np.diff(r,axis=1),axis=2),axis=1)
+
     # calculate variance of curvature w.r.t. break point variation
     # correspond to equation 6 in paper
+    # all break points are handled at once
+    # return: K (N,1), C (N,N) cyclic tridiagonal, Ds (N,N) diagonal, C and Ds are scipy sparse matrices
     def curvatureJac(self):
-        break_pts = np.array(self.break_pts).T
+        break_pts = np.array(self.break_pts,dtype=np.float64).T
         # u_max is also number of break points
         N = self.u_max
-        A = np.array([[0,-1],[1,0]])
-
+        # rotate by 90 deg, A @ v = (-v_y, v_x)
+        rot = lambda v: np.array([-v[1],v[0]])
+        dot = lambda v,w: np.sum(v*w,axis=0)
 
         # prepare ds vector with initial raceline
         # s[i] = arc distance r_i to r_{i+1}
         # NOTE maybe more accurately this is ds
-        ds = []
-        fun = lambda x:self.raceline_fun(x).flatten()
-        for i in range(N):
-            ds.append(self.arcLen(fun,i,(i+1)))
+        ds = self.segmentArcLen(N)
+
+        # rl -> r_k-1, r -> r_k, rr -> r_k+1, (2,N) each
+        rl = np.roll(break_pts,1,axis=1)
+        r = break_pts
+        rr = np.roll(break_pts,-1,axis=1)
+        sl = np.roll(ds,1)
+        sr = ds
 
         # calculate first and second derivative
         # w.r.t. ds
-        dr_vec = []
-        ddr_vec = []
-        # (N,3)
-        # see eq 1
-        alfa_vec = []
-        # see eq 2
-        beta_vec = []
-        # see eq 6
-        x_vec = []
-        # see eq 3
-        k_vec = []
-        # normal vector
-        n_vec = []
-
+        # see eq 1 (alfa) and eq 2 (beta)
+        ((al,a,ar),(bl,b,br)) = self.lagrangeDer([rl,r,rr],ds=(sl,sr))
+        dr = al*rl + a*r + ar*rr
+        ddr = bl*rl + b*r + br*rr
 
-        # calculate terms in eq 6
-        for i in range(N):
-            # rl -> r_k-1
-            rl = break_pts[:,(i-1)%N]
-            # r -> r_k
-            r  = break_pts[:,(i)%N]
-            # rr -> r_k+1
-            rr = break_pts[:,(i+1)%N]
-            points = [rl, r, rr]
-            sl = ds[(i-1)%N]
-            sr = ds[(i)%N]
-            
-            ((al,a,ar),(bl,b,br)) = self.lagrangeDer(points,ds=(sl,sr))
-            dr = al*rl + a*r + ar*rr
-            ddr = bl*rl + b*r + br*rr
-
-            dr_vec.append(dr)
-            ddr_vec.append(ddr)
-
-            alfa_vec.append( [al,a,ar])
-            beta_vec.append( [bl,b,br])
-
-            n = A @ dr
-            n_vec.append(n.T)
-
-        for i in range(N):
-            # curvature at this characteristic point
-            k = np.dot(A @ dr_vec[i], ddr_vec[i])
-            xl = np.dot(A @ dr_vec[i], beta_vec[i][0] * n_vec[(i-1)%N])
-            xl += np.dot(ddr_vec[i], alfa_vec[i][0] * A @ n_vec[(i-1)%N])
-
-            x = beta_vec[i][1] + np.dot(ddr_vec[i], alfa_vec[i][1] * A @ n_vec[i])
-            
-            xr = np.dot(A @ dr_vec[i], beta_vec[i][2] * n_vec[(i+1)%N])
-            xr += np.dot(ddr_vec[i], alfa_vec[i][2] * A @ n_vec[(i+1)%N])
+        # normal vector
+        n = rot(dr)
+        n_l = np.roll(n,1,axis=1)
+        n_r = np.roll(n,-1,axis=1)
 
-            k_vec.append(k)
-            x_vec.append([xl,x,xr])
+        # curvature at characteristic points, see eq 3
+        k = dot(rot(dr),ddr)
+        # see eq 6
+        xl = dot(rot(dr),bl*n_l) + dot(ddr,al*rot(n_l))
+        x = b + dot(ddr,a*rot(n))
+        xr = dot(rot(dr),br*n_r) + dot(ddr,ar*rot(n_r))
 
         # assemble matrix K, C, Ds
-        x_vec = np.array(x_vec)
-        k_vec = np.array(k_vec)
-
-        K = np.array(k_vec).reshape(N,1)
-        C = np.zeros([N,N])
-        C[0,0] = x_vec[0,1]
-        C[0,1] = x_vec[0,2]
-        C[0,-1] = x_vec[0,0]
-
-        C[-1,-2] = x_vec[-1,0]
-        C[-1,-1] = x_vec[-1,1]
-        C[-1,0] = x_vec[-1,2]
-
-        for i in range(1,N-1):
-            C[i,i-1] = x_vec[i,0]
-            C[i,i] = x_vec[i,1]
-            C[i,i+1] = x_vec[i,2]
-
-        C = np.array(C)
+        K = k.reshape(N,1)
+        index = np.arange(N)
+        rows = np.hstack([index,index,index])
+        cols = np.hstack([(index-1)%N,index,(index+1)%N])
+        C = sparse.csr_matrix((np.hstack([xl,x,xr]),(rows,cols)),shape=(N,N))
 
         # NOTE Ds is not simply ds
         # it is a helper for trapezoidal rule
-        Ds = np.array(ds[:-2]) + np.array(ds[1:-1])
-        Ds = np.hstack([ds[0], Ds, ds[-1]])
-
-        Ds = 0.5*np.array(np.diag(Ds))
+        Ds = np.hstack([ds[0], ds[:-2] + ds[1:-1], ds[-1]])
+        Ds = sparse.diags(0.5*Ds,format='csr')
 
         self.ds = ds
-        self.k = k_vec
-        self.n = np.array(n_vec).reshape(-1,2)
-        self.dr = np.array(dr_vec)
-        self.ddr = ddr_vec
+        self.k = k
+        self.n = n.T
+        self.dr = dr.T
+        self.ddr = ddr.T
 
         return K, C, Ds
 
@@ -354,9 +315,9 @@ class QpSmooth(RCPtrack):
 
         # figure out which grid the coord is in
         # grid coordinate, (col, row), col starts from left and row starts from bottom, both indexed from 0
-        nondim= np.array(np.array(coord)/self.scale//1,dtype=np.int)
-        nondim[0] = np.clip(nondim[0],0,len(self.track)-1).astype(np.int)
-        nondim[1] = np.clip(nondim[1],0,len(self.track[0])-1).astype(np.int)
+        nondim= np.array(np.array(coord)/self.scale//1,dtype=int)
+        nondim[0] = np.clip(nondim[0],0,len(self.track)-1).astype(int)
+        nondim[1] = np.clip(nondim[1],0,len(self.track[0])-1).astype(int)
 
         # e.g. 'WE','SE'
         grid_type = self.track[nondim[0]][nondim[1]]
@@ -424,6 +385,38 @@ class QpSmooth(RCPtrack):
 
         return min(F*self.scale,delta_max), min(R*self.scale,delta_max)
 
+    # vectorized checkTrackBoundary() over all break points
+    # NOTE on turn tiles the two differ: checkTrackBoundary() measures the distance to the arcs
+    # along the tile's fixed 45 degree diagonal, here the radial direction at each point is used
+    # so F,R are the exact first order distances along n. Both agree on straights and on the diagonal,
+    # elsewhere on a turn tile they differ with the angle between the radial direction and the diagonal
+    # coords: (N,2) unit:m
+    # n: (N,2) normal direction vectors, NOTE |n|!=1
+    # return:
+    # F,R (N,) such that r+F*n and r-R*n are boundaries of the track, bounded by delta_max
+    def checkTrackBoundaryBatch(self,coords,n,delta_max):
+        # same workaround for small components as checkTrackBoundary()
+        n = np.array(n,dtype=np.float64).reshape(-1,2)
+        n[np.abs(n) < 0.01] = 0.01
+        n /= np.linalg.norm(n,axis=1)[:,np.newaxis]
+
+        wall,grad,kind = self.trackBoundaryWalls(coords,deadzone=0.087*3.0)
+        # rate each side's distance changes per unit length along n
+        rate = np.einsum('nij,nj->ni',grad,n)
+        # moving along n (F) or -n (R), the side whose distance is shrinking is hit first
+        with np.errstate(divide='ignore',invalid='ignore'):
+            reach = wall/np.abs(rate)
+        F = np.min(np.where(rate < 0,reach,np.inf),axis=1)
+        R = np.min(np.where(rate > 0,reach,np.inf),axis=1)
+        # off track tiles have no boundary to move toward
+        F[kind == self.TILE_NONE] = 0
+        R[kind == self.TILE_NONE] = 0
+
+        # if the point given already violates constrain, then F, R may <0
+        F = np.maximum(F,0)
+        R = np.maximum(R,0)
+        return np.minimum(F*self.scale,delta_max), np.minimum(R*self.scale,delta_max)
+
     # convert raceline to a B spline to reuse old code for velocity generation and localTrajectory, since they expect a spline object
     def convertToSpline(self):
         # sample entire path
@@ -656,13 +649,9 @@ class QpSmooth(RCPtrack):
 
         # resample with equal arc distance
         # NOTE this seems to introduce instability
-        arc_len = [0]
         # we have N+1 points here
-        for i in range(1,N+1):
-            s = self.arcLen(self.raceline_fun,i-1,i)
-            arc_len.append(s)
+        arc_len = np.hstack([0,self.segmentArcLen(N)])
         uu = np.linspace(0,N,N+1)
-        arc_len = np.array(arc_len)
         arc_len = np.cumsum(arc_len)
         s2u = interp1d(arc_len,uu)
         ss = np.linspace(0,arc_len[-1],new_n+1)
@@ -676,9 +665,7 @@ class QpSmooth(RCPtrack):
         # if we include both we would have numerical issues
         uu = uu[:-1]
         #uu += np.hstack([0,np.random.rand(new_n-2)/3,0])
-        new_break_pts =[]
-        for u in uu:
-            new_break_pts.append(self.raceline_fun(u).flatten())
+        new_break_pts = self.raceline_fun(uu)
 
         # regenerate spline
         self.break_pts = np.array(new_break_pts)
@@ -694,6 +681,46 @@ class QpSmooth(RCPtrack):
         plt.show()
         '''
 
+    # assemble the QP solved in each iteration of optimizePath()
+    # minimize 1/2 x^T P_qp x + q_qp^T x subject to G x <= h
+    # x: (N,) displacement of each break point along its normal self.n
+    # K, C, Ds: from curvatureJac()
+    # delta_max: max displacement of break points in one iteration, m
+    # return: P_qp (N,N), G (4N,N) scipy sparse, q_qp (N,1), h (4N,)
+    def assembleQp(self,K,C,Ds,delta_max):
+        N = K.shape[0]
+        # NOTE ignored W, W=I
+        # C is cyclic tridiagonal and Ds diagonal, so P_qp is cyclic banded (5 diagonals), all kept sparse
+        P_qp = 2 * C.T @ Ds @ C
+        q_qp = 2 * C.T @ (Ds @ K)
+
+        # assemble constrains
+        # as in Gx <= h
+
+        # track boundary
+        # h = [F..., R...], split into two vec
+        F,R = self.checkTrackBoundaryBatch(self.break_pts,self.n,delta_max)
+        h = np.hstack([F,R])
+        G = sparse.vstack([sparse.identity(N),-sparse.identity(N)])
+
+        # curvature constrain
+        # CX <= Kmax - K
+        # min radius allowed
+        Rmin = 0.102/tan(radians(18))
+        Kmax = 1.0/Rmin
+        Kmin = -1.0/Rmin
+        h3 = Kmax - K
+        h3 = h3.flatten()
+        h4 = -(Kmin - K)
+        h4 = h4.flatten()
+        h = np.hstack([h,h3,h4])
+        G = sparse.vstack([G,C,-C],format='csr')
+
+        assert G.shape[1]==N
+        assert G.shape[0]==4*N
+        assert h.shape[0]==4*N
+        return P_qp, q_qp, G, h
+
     # optimize path and save to pickle file
     def optimizePath(self):
         # initialize
@@ -739,55 +766,15 @@ class QpSmooth(RCPtrack):
                 self.gifimages.append(Image.fromarray(cv2.cvtColor(img_track.copy(),cv2.COLOR_BGR2RGB)))
 
             K, C, Ds = self.curvatureJac()
-
-            # assemble matrices in QP
-            # NOTE ignored W, W=I
-            P_qp = 2 * C.T @ Ds @ C
-            q_qp = np.transpose(K.T @ Ds @ C + K.T @ Ds @ C)
-
-            # assemble constrains
-            # as in Gx <= h
-
-            # track boundary
-            # h = [F..., R...], split into two vec
-            h1 =  []
-            h2 =  []
             delta_max = 5e-2
-            for i in range(N):
-                coord = self.break_pts[i]
-                F,R = self.checkTrackBoundary(coord,self.n[i],delta_max)
-                h1.append(F)
-                h2.append(R)
-
-            h = np.array(h1+h2)
-            G = np.vstack([np.identity(N),-np.identity(N)])
-
-            # curvature constrain
-            # CX <= Kmax - K
-            # min radius allowed
-            Rmin = 0.102/tan(radians(18))
-            Kmax = 1.0/Rmin
-            Kmin = -1.0/Rmin
-            h3 = Kmax - K
-            h3 = h3.flatten()
-            h4 = -(Kmin - K)
-            h4 = h4.flatten()
-            h = np.hstack([h,h3,h4])
-            G = np.vstack([G,C,-C])
+            P_qp, q_qp, G, h = self.assembleQp(K, C, Ds, delta_max)
             print_info("min radius = %.2f"%np.min(np.abs(1.0/K)))
 
-            assert G.shape[1]==N
-            assert G.shape[0]==4*N
-            assert h.shape[0]==4*N
-
-
             # optimize
-            P_qp = cvxopt.matrix(P_qp)
-            q_qp = cvxopt.matrix(q_qp)
-            G = cvxopt.matrix(G)
-            h = cvxopt.matrix(h)
+            # NOTE no warm start, x is the displacement from break points that were just moved and resampled,
+            # the previous solution doesn't carry over to this problem
             cvxopt.solvers.options['show_progress'] = False
-            sol = cvxopt.solvers.qp(P_qp, q_qp, G, h)
+            sol = cvxopt.solvers.qp(toCvxoptSparse(P_qp), cvxopt.matrix(q_qp), toCvxoptSparse(G), cvxopt.matrix(h))
 
             # DEBUG
             # verify Gx <= h is not violated
@@ -797,7 +784,7 @@ class QpSmooth(RCPtrack):
             variance = sol['x']
             # verify Gx <= h
             #print("h-GX, should be positive")
-            constrain_met = np.array(h) - np.array(G) @ np.array(variance)
+            constrain_met = h.reshape(-1,1) - G @ np.array(variance)
             assert constrain_met.all()
 
             # verify K do not violate constrain
@@ -814,11 +801,7 @@ class QpSmooth(RCPtrack):
             # apply changes to break points
             # move break points in tangential direction by variance vector
             n = np.array(self.n).reshape(-1,2)
-            perturbed_break_pts = np.array(self.break_pts)
-            for i in range(N):
-                perturbed_break_pts[i,:] += n[i]*variance[i]
-
-            self.break_pts = perturbed_break_pts
+            self.break_pts = np.array(self.break_pts) + n*np.array(variance).reshape(-1,1)
 
         if self.saveGif:
             print_info("saving gif.. This may take a while")
@@ -0,0 +1,163 @@
+# uniform grid lookup tables for quantities along the raceline
+# replaces per call interp1d / splev evaluation of u<->s, s->v, s->heading, s->curvature in RCPtrack
+# u: raceline spline parameter, [0,track_length_grid)
+# s: distance along raceline, [0,raceline_len_m)
+# values between grid samples are linearly interpolated, inputs outside the range are wrapped
+#
+# every lookup accepts a scalar or an array
+# scalar input returns np.float64 and takes a fast path with no array temporaries
+# array input may be given an out array, scratch buffers are kept per thread and input shape
+# so repeated calls with the same shape don't allocate
+import numpy as np
+import threading
+from math import pi
+from scipy.interpolate import splev,CubicSpline
+
+# np.ndim() costs about as much as a scalar lookup itself
+def _isScalar(x):
+    if isinstance(x,np.ndarray):
+        return x.ndim == 0
+    return not isinstance(x,(list,tuple))
+
+class RacelineTable:
+    # names of the tables, in the order they are passed to __init__()
+    table_names = ['s_of_u','u_of_s','v_of_s','x_of_s','y_of_s','heading_of_s','curvature_of_s']
+
+    # u_len: u of one full lap, track_length_grid
+    # s_len: s of one full lap, raceline_len_m
+    # s_of_u: (u_count+1,) s at uniform u from 0 to u_len
+    # u_of_s,v_of_s,x_of_s,y_of_s,heading_of_s,curvature_of_s: (s_count+1,) at uniform s from 0 to s_len
+    #       heading is unwrapped, curvature is signed, positive when turning left (ccw)
+    def __init__(self,u_len,s_len,s_of_u,u_of_s,v_of_s,x_of_s,y_of_s,heading_of_s,curvature_of_s):
+        self.u_len = float(u_len)
+        self.s_len = float(s_len)
+        self.s_of_u = s_of_u
+        self.u_of_s = u_of_s
+        self.v_of_s = v_of_s
+        self.x_of_s = x_of_s
+        self.y_of_s = y_of_s
+        self.heading_of_s = heading_of_s
+        self.curvature_of_s = curvature_of_s
+        # the last sample of each table sits at one full lap so index i+1 is always valid
+        self.u_step = self.u_len/(s_of_u.shape[0]-1)
+        self.s_step = self.s_len/(u_of_s.shape[0]-1)
+
+        # scratch buffers for array lookups, keyed by input shape
+        # thread local, the async mppi solver thread looks up the same tables as the main thread
+        self.scratch = threading.local()
+        return
+
+    # raceline: spline tck parameterized by u, as RCPtrack.raceline
+    # raceline_s: spline tck parameterized by s, as RCPtrack.raceline_s
+    # uu,ss: (n,) corresponding u and s samples, both increasing from 0 to one full lap
+    # targetVfromU: callable, target velocity at u
+    # u_density: u table samples per unit u (one grid)
+    # s_step: s table spacing, in meter
+    @staticmethod
+    def build(raceline,raceline_s,uu,ss,targetVfromU,u_density=128,s_step=0.002):
+        uu = np.asarray(uu,dtype=np.float64)
+        ss = np.asarray(ss,dtype=np.float64)
+        u_len = float(uu[-1])
+        s_len = float(ss[-1])
+
+        # u -> s
+        u_count = max(2,int(np.ceil(u_len*u_density)))
+        u_grid = np.linspace(0,u_len,u_count+1)
+        s_of_u = CubicSpline(uu,ss)(u_grid)
+
+        # s -> u,v,x,y,heading,curvature
+        s_count = max(2,int(np.ceil(s_len/s_step)))
+        s_grid = np.linspace(0,s_len,s_count+1)
+        u_of_s = CubicSpline(ss,uu)(s_grid)
+        v_of_s = np.asarray(targetVfromU(np.clip(u_of_s,0,u_len)),dtype=np.float64)
+        x_of_s,y_of_s = [np.asarray(val) for val in splev(s_grid%s_len,raceline_s)]
+        dr = np.array(splev(s_grid%s_len,raceline_s,der=1))
+        ddr = np.array(splev(s_grid%s_len,raceline_s,der=2))
+        # heading is unwrapped so interpolation never crosses a 2pi jump, wrapped again on lookup
+        heading_of_s = np.unwrap(np.arctan2(dr[1],dr[0]))
+        curvature_of_s = (dr[0]*ddr[1]-dr[1]*ddr[0])/np.linalg.norm(dr,axis=0)**3
+        return RacelineTable(u_len,s_len,s_of_u,u_of_s,v_of_s,x_of_s,y_of_s,heading_of_s,curvature_of_s)
+
+    # return: dict of table name -> array, see table_names
+    def arrays(self):
+        return {name:getattr(self,name) for name in self.table_names}
+
+    # return: position in table, integer index (int64) and fraction, both in scratch buffers
+    def _locate(self,x,period,step):
+        buffers = getattr(self.scratch,'buffers',None)
+        if buffers is None:
+            buffers = self.scratch.buffers = {}
+        buf = buffers.get(x.shape)
+        if buf is None:
+            buf = (np.empty(x.shape),np.empty(x.shape,dtype=np.int64),np.empty(x.shape),np.empty(x.shape))
+            buffers[x.shape] = buf
+        pos,idx,lo,hi = buf
+        np.mod(x,period,out=pos)
+        np.multiply(pos,1.0/step,out=pos)
+        np.floor(pos,out=lo)
+        np.subtract(pos,lo,out=pos)
+        idx[...] = lo
+        return idx,pos,lo,hi
+
+    # linear interpolation in table at x
+    def _lookup(self,table,x,period,step,out=None):
+        if _isScalar(x):
+            pos = (float(x) % period)/step
+            i = min(int(pos),table.shape[0]-2)
+            frac = pos - i
+            return np.float64(table[i] + frac*(table[i+1]-table[i]))
+
+        x = np.asarray(x,dtype=np.float64)
+        idx,frac,lo,hi = self._locate(x,period,step)
+        np.minimum(idx,table.shape[0]-2,out=idx)
+        # mode='raise' would buffer out
+        np.take(table,idx,out=lo,mode='clip')
+        idx += 1
+        np.take(table,idx,out=hi,mode='clip')
+        if out is None:
+            out = np.empty(x.shape)
+        # lo + frac*(hi-lo)
+        np.subtract(hi,lo,out=out)
+        np.multiply(out,frac,out=out)
+        np.add(out,lo,out=out)
+        return out
+
+    def uToS(self,u,out=None):
+        return self._lookup(self.s_of_u,u,self.u_len,self.u_step,out)
+
+    def sToU(self,s,out=None):
+        return self._lookup(self.u_of_s,s,self.s_len,self.s_step,out)
+
+    def sToV(self,s,out=None):
+        return self._lookup(self.v_of_s,s,self.s_len,self.s_step,out)
+
+    def uToV(self,u,out=None):
+        return self.sToV(self.uToS(u,out),out)
+
+    # return: heading in (-pi,pi]
+    def sToHeading(self,s,out=None):
+        heading = self._lookup(self.heading_of_s,s,self.s_len,self.s_step,out)
+        if _isScalar(heading):
+            return np.float64(pi - (pi - heading) % (2*pi))
+        # pi - ((pi - heading) mod 2pi)
+        np.subtract(pi,heading,out=heading)
+        np.mod(heading,2*pi,out=heading)
+        np.subtract(pi,heading,out=heading)
+        return heading
+
+    # return: signed curvature, 1/m, positive when turning left
+    def sToCurvature(self,s,out=None):
+        return self._lookup(self.curvature_of_s,s,self.s_len,self.s_step,out)
+
+    # out: optional (...,2) array
+    # return: raceline point (...,2) at s
+    def sToPoint(self,s,out=None):
+        if out is None:
+            out = np.empty(np.shape(s)+(2,))
+        if _isScalar(s):
+            out[0] = self._lookup(self.x_of_s,s,self.s_len,self.s_step)
+            out[1] = self._lookup(self.y_of_s,s,self.s_len,self.s_step)
+            return out
+        self._lookup(self.x_of_s,s,self.s_len,self.s_step,out[...,0])
+        self._lookup(self.y_of_s,s,self.s_len,self.s_step,out[...,1])
+        return out
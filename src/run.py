@@ -82,6 +82,9 @@ class Main():
         # run the track in reverse direction
         self.reverse = False
 
+        # solve all cars using mppi controller in one batched pass instead of one at a time
+        self.batchMppi = True
+
         # prepare track object
         #self.track = self.prepareSkidpad()
         # or, use RCP track
@@ -185,9 +188,16 @@ class Main():
         # exit point
         print_info("Exiting ...")
         cv2.destroyAllWindows()
-        for car in self.cars:
+        for i,car in enumerate(self.cars):
             car.stopStateUpdate(car)
 
+            if (car.controller == Controller.mppi):
+                car.close()
+                if not (car.mppi.metrics is None):
+                    car.mppi.metrics.dump("car %d mppi metrics"%(i))
+                if not (car.warm_start_library is None):
+                    car.warm_start_library.save()
+
             if (car.controller == Controller.joystick):
                 print_info("exiting joystick... move joystick a little")
                 car.joystick.quit()
@@ -295,29 +305,29 @@ class Main():
     # when a new vicon/optitrack state is available, vi.newState.isSet() will be true
     # client (this function) need to unset that event
     def update(self,):
+        # mppi controlled cars are solved together in one batch when batchMppi is set and more than one can be batched
+        # their states are all retrieved first, otherwise each car's state is retrieved right before it's controlled
+        batch_cars = [car for car in self.cars if car.controller == Controller.mppi and not car.async_mode]
+        batch = self.batchMppi and len(batch_cars) > 1
+        mppi_retvals = {}
+        if batch:
+            for car in self.cars:
+                self.retrieveState(car)
+            mppi_cars = [car for car in batch_cars if not self.startDelayPending(car)]
+            if len(mppi_cars) > 0:
+                retvals = ctrlMppiWrapper.ctrlCarBatch(mppi_cars)
+                for car,retval in zip(mppi_cars,retvals):
+                    mppi_retvals[id(car)] = retval
+
         for i in range(len(self.cars)):
             car = self.cars[i]
-            # wait on next state update
-            car.new_state_update.wait()
-            # manually clear the Event()
-            car.new_state_update.clear()
-            # retrieve car state from visual tracking update
-            car.updateState(car)
-            #print("car %d T: %.2f S: %.2f, y pos %.2f"%(i,car.throttle, car.steering, car.state[1]))
-
+            if not batch:
+                self.retrieveState(car)
             # force motor freeze if start_delay has not been reached
-            if (self.cars[i].stateUpdateSource == StateUpdateSource.dynamic_simulator \
-                    or self.cars[i].stateUpdateSource == StateUpdateSource.simulator \
-                    or self.cars[i].stateUpdateSource == StateUpdateSource.eth_simulator):
-                if (car.simulator.t < car.start_delay):
-                    car.steering = 0
-                    car.throttle = 0
-                    continue
-            else:
-                if (time() < car.start_delay):
-                    car.steering = 0
-                    car.throttle = 0
-                    continue
+            if self.startDelayPending(car):
+                car.steering = 0
+                car.throttle = 0
+                continue
 
 
                 
@@ -361,7 +371,10 @@ class Main():
                 # TODO debugging...
                 # (x,y,theta,vforward,vsideway=0,omega)
                 #print("pos = %.2f, %.2f, psi = %.0f,v=%4.1f  omega=%.1f "%(car.state[0],car.state[1],degrees(car.state[2]),car.state[3],degrees(car.state[5])))
-                throttle,steering,valid,debug_dict = car.ctrlCar(car.state,car.track,reverse=self.reverse)
+                if id(car) in mppi_retvals:
+                    throttle,steering,valid,debug_dict = mppi_retvals[id(car)]
+                else:
+                    throttle,steering,valid,debug_dict = car.ctrlCar(car.state,car.track,reverse=self.reverse,state_time=car.state_time)
                 #print("T= %4.1f, S= %4.1f"%( throttle,degrees(steering)))
                 if isnan(steering):
                     print("error steering nan")
@@ -400,6 +413,25 @@ class Main():
         self.updateVisualization()
         
 # ---- Short Routine ----
+    # wait on next state update of car and retrieve it
+    def retrieveState(self,car):
+        car.new_state_update.wait()
+        # manually clear the Event()
+        car.new_state_update.clear()
+        # retrieve car state from visual tracking update
+        car.updateState(car)
+        #print("car %d T: %.2f S: %.2f, y pos %.2f"%(i,car.throttle, car.steering, car.state[1]))
+        return
+
+    # whether car is still waiting for its start_delay
+    def startDelayPending(self,car):
+        if (car.stateUpdateSource == StateUpdateSource.dynamic_simulator \
+                or car.stateUpdateSource == StateUpdateSource.simulator \
+                or car.stateUpdateSource == StateUpdateSource.eth_simulator):
+            return car.simulator.t < car.start_delay
+        else:
+            return time() < car.start_delay
+
     def prepareGif(self):
         if self.saveGif:
             self.gifimages = []
@@ -666,6 +698,8 @@ class Main():
         #(x,y,theta) = self.vi.getState2d(self.car.internal_id)
         # (x,y,theta,vforward,vsideway=0,omega)
         car.state = (x,y,theta,v,0,omega)
+        # time the frame was received, not when it's retrieved here
+        car.state_time = car.vi.getFrameTime(car.internal_id)
         return
 
     def stopOptitrack(self,car):
@@ -730,6 +764,7 @@ class Main():
         sim_states = car.sim_states = car.simulator.updateCar(self.sim_dt,car.sim_states,car.throttle,car.steering)
         # (x,y,theta,vforward,vsideway=0,omega)
         car.state = np.array([sim_states['coord'][0],sim_states['coord'][1],sim_states['heading'],sim_states['vf'],sim_states['vs'],sim_states['omega']])
+        car.state_time = time()
         if isnan(sim_states['heading']):
             print("error")
         #print(car.state)
@@ -765,6 +800,7 @@ class Main():
         sim_states = car.sim_states = car.simulator.updateCar(self.sim_dt,car.sim_states,car.throttle,car.steering)
         # (x,y,theta,vforward,vsideway=0,omega)
         car.state = np.array([sim_states['coord'][0],sim_states['coord'][1],sim_states['heading'],sim_states['vf'],sim_states['vs'],sim_states['omega']])
+        car.state_time = time()
         if isnan(sim_states['heading']):
             print("error")
         #print(car.state)
@@ -0,0 +1,74 @@
+# binary track artifact, stores everything RCPtrack derives from a track file so it can start without rebuilding
+# layout:
+#   MAGIC (8 bytes)
+#   header length (uint32, little endian)
+#   header, utf-8 json: {'version':..., 'scalars':{name:value}, 'arrays':{name:[dtype,shape,offset]}}
+#   raw array data, each array starts at a multiple of ALIGNMENT from the beginning of the file
+# arrays are returned as read only views into a single np.memmap of the file, so loading doesn't copy them
+import os
+import json
+import hashlib
+import numpy as np
+
+MAGIC = b'RCPTRACK'
+# increase when the layout or the set of stored arrays changes, artifacts of other versions are rebuilt
+ARTIFACT_VERSION = 3
+ALIGNMENT = 64
+
+# content hash of a track file, artifacts built from it are named with this key
+def artifactKey(track_filename):
+    h = hashlib.sha1()
+    with open(track_filename,'rb') as f:
+        h.update(f.read())
+    h.update(str(ARTIFACT_VERSION).encode())
+    return h.hexdigest()[:10]
+
+def artifactFilename(track_filename):
+    return os.path.splitext(track_filename)[0] + "_track_%s.bin"%(artifactKey(track_filename))
+
+# scalars: dict, json serializable values
+# arrays: dict of name -> np array
+def writeArtifact(filename,scalars,arrays):
+    arrays = {name:np.ascontiguousarray(val) for name,val in arrays.items()}
+    # header length depends on offsets and offsets depend on header length,
+    # so offsets are counted from the end of a header padded to ALIGNMENT
+    entries = {}
+    offset = 0
+    for name,val in arrays.items():
+        entries[name] = [val.dtype.str,list(val.shape),offset]
+        offset += -(-val.nbytes//ALIGNMENT)*ALIGNMENT
+    header = {'version':ARTIFACT_VERSION,'scalars':scalars,'arrays':entries}
+    header = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC)+4+len(header))//ALIGNMENT)*ALIGNMENT
+    header += b' '*(data_start-len(MAGIC)-4-len(header))
+
+    # write to a temporary file first so a reader never sees a partial artifact
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename,'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(len(header),dtype='<u4').tobytes())
+        f.write(header)
+        for name,val in arrays.items():
+            f.seek(data_start+entries[name][2])
+            f.write(val.tobytes())
+    os.replace(tmp_filename,filename)
+    return
+
+# return: scalars,arrays as given to writeArtifact(), None if the file is not an artifact of the current version
+def readArtifact(filename):
+    with open(filename,'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        header_len = int(np.frombuffer(f.read(4),dtype='<u4')[0])
+        header = json.loads(f.read(header_len).decode())
+    if header['version'] != ARTIFACT_VERSION:
+        return None
+    data_start = len(MAGIC)+4+header_len
+
+    buf = np.memmap(filename,dtype=np.uint8,mode='r')
+    arrays = {}
+    for name,(dtype,shape,offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buf,dtype=dtype,count=count,offset=data_start+offset).reshape(shape)
+    return header['scalars'],arrays
@@ -0,0 +1,69 @@
+# shared fixtures for tests, run with `python -m pytest tests` from repository root
+import os
+import sys
+from math import radians,asin
+
+import matplotlib
+# track construction plots, never open a window
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+
+base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'../src')
+sys.path.insert(0,base_dir)
+sys.path.insert(0,os.path.join(base_dir,'mppi'))
+
+# full track with raceline and speed profile, see RCPtrack.prepareTrack()
+# built in memory rather than loaded from raceline.p so tests need no data files
+# built once per session, takes a couple of seconds
+# caches derived from the track (frenet raster, ...) go to a temporary directory
+@pytest.fixture(scope='session')
+def track(tmp_path_factory):
+    from RCPTrack import RCPtrack
+    track = RCPtrack()
+    track.prepareTrack()
+    track.generateSpeedProfile()
+    track.reconstructRaceline()
+    track.raceline_filename = str(tmp_path_factory.mktemp('track')/'raceline.p')
+    return track
+
+# car settings as in run.py prepareCar(), without serial port
+porsche_setting = {'wheelbase':90e-3,
+                 'max_steer_angle_left':radians(27.1),
+                 'max_steer_pwm_left':1150,
+                 'max_steer_angle_right':radians(27.1),
+                 'max_steer_pwm_right':1850,
+                 'serial_port':None,
+                 'max_throttle':0.55}
+
+lambo_setting = {'wheelbase':98e-3,
+                 'max_steer_angle_left':asin(2*98e-3/0.52),
+                 'max_steer_pwm_left':1100,
+                 'max_steer_angle_right':asin(2*98e-3/0.47),
+                 'max_steer_pwm_right':1850,
+                 'serial_port':None,
+                 'max_throttle':0.5}
+
+# factory for mppi controlled cars without opponents, keyword arguments are added to the car setting
+# e.g. makeMppiCar(lambo_setting,noise_seed=0), cars are closed at the end of the test
+@pytest.fixture
+def makeMppiCar(track):
+    from ctrlMppiWrapper import ctrlMppiWrapper
+    cars = []
+    def make(setting=porsche_setting,**kwargs):
+        car = ctrlMppiWrapper(dict(setting,**kwargs),0.01)
+        car.init(track)
+        car.opponents = []
+        cars.append(car)
+        return car
+    yield make
+    for car in cars:
+        car.close()
+
+# pose (x,y,heading,v_forward,v_sideway,omega) on the start straight
+@pytest.fixture
+def start_pose(track):
+    from scipy.interpolate import splev
+    x,y = splev(0.5,track.raceline_s)
+    dx,dy = splev(0.5,track.raceline_s,der=1)
+    return (float(x),float(y),float(np.arctan2(dy,dx)),1.0,0.0,0.0)
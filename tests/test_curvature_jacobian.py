@@ -0,0 +1,67 @@
+# analytic jacobians used by RCPtrack.minimizeCurvatureRoutine() against central finite differences
+import numpy as np
+import pytest
+
+from RCPTrack import RCPtrack
+
+STEPS = 100
+
+@pytest.fixture(scope='module')
+def curvature_track():
+    track = RCPtrack()
+    track.prepareTrack()
+    # sets K, ds and the start pose x0,y0,phi0 used by kenselTransform()
+    track.discretizePath(STEPS)
+    # cost() counts its calls
+    track.cost_count = 0
+    return track
+
+# random curvature profiles around the discretized raceline
+def randomK(track,count=3,seed=0):
+    rng = np.random.default_rng(seed)
+    return [track.K + rng.normal(0,0.05,STEPS) for i in range(count)]
+
+# (len(fun(k)),STEPS) jacobian by central differences, (STEPS,) gradient if fun is scalar
+def numericJac(fun,k,h=1e-6):
+    jac = []
+    for i in range(k.shape[0]):
+        dk = np.zeros_like(k)
+        dk[i] = h
+        jac.append((np.asarray(fun(k+dk))-np.asarray(fun(k-dk)))/(2*h))
+    return np.array(jac).T
+
+def test_kensel_transform_jac(curvature_track):
+    track = curvature_track
+    for k in randomK(track):
+        x,y,dx,dy = track.kenselTransform(k,track.ds,jac=True)
+        assert np.array_equal(np.vstack([x,y]),np.vstack(track.kenselTransform(k,track.ds)))
+        assert np.allclose(dx,numericJac(lambda k: track.kenselTransform(k,track.ds)[0],k),rtol=1e-5,atol=1e-8)
+        assert np.allclose(dy,numericJac(lambda k: track.kenselTransform(k,track.ds)[1],k),rtol=1e-5,atol=1e-8)
+
+def test_boundary_clearance_jac(curvature_track):
+    track = curvature_track
+    for k in randomK(track):
+        jac = track.boundaryClearanceJac(k)
+        numeric = numericJac(track.boundaryClearanceVector,k)
+        # clearance is only piecewise smooth, leave out points close to a tile border
+        # or about equally far from both sides, where a finite difference step may cross a kink
+        x,y = track.kenselTransform(k,track.ds)
+        local = np.vstack([x,y]).T/track.scale
+        wall,_,_ = track.trackBoundaryWalls(np.vstack([x,y]).T)
+        smooth = np.min(np.abs(local-np.rint(local)),axis=1) > 1e-3
+        smooth &= np.abs(wall[:,0]-wall[:,1]) > 1e-3
+        assert np.count_nonzero(smooth) > STEPS//2
+        assert np.allclose(jac[smooth],numeric[smooth],rtol=1e-4,atol=1e-6)
+
+def test_cost_jac(curvature_track):
+    track = curvature_track
+    for k in randomK(track):
+        assert np.allclose(track.costJac(k),numericJac(track.cost,k,h=1e-7),rtol=1e-5,atol=1e-6)
+    # the smoothed cost is differentiable at dK = 0 too, e.g. a constant curvature profile
+    k = np.full(STEPS,0.3)
+    assert np.allclose(track.costJac(k),numericJac(track.cost,k,h=1e-7),rtol=1e-5,atol=1e-6)
+
+def test_loop_constraint_jac(curvature_track):
+    track = curvature_track
+    for k in randomK(track):
+        assert np.allclose(track.loopConstraintJac(k),numericJac(track.loopConstraint,k))
@@ -0,0 +1,58 @@
+# FrenetRaster.query() against the exact closest raceline point
+import numpy as np
+import pytest
+from scipy.interpolate import splev
+
+from frenet_raster import FrenetRaster
+
+@pytest.fixture(scope='module')
+def raster(track):
+    return FrenetRaster.fromTrack(track)
+
+# s and signed offset (left positive) of the closest point on a densely sampled raceline
+def exactFrenet(track,x,y):
+    ss = np.arange(0,track.raceline_len_m,1e-3)
+    rx,ry = splev(ss,track.raceline_s)
+    i = np.argmin((rx[:,np.newaxis]-x)**2 + (ry[:,np.newaxis]-y)**2,axis=0)
+    tx,ty = splev(ss[i],track.raceline_s,der=1)
+    offset = (tx*(y-ry[i]) - ty*(x-rx[i]))/np.sqrt(tx*tx+ty*ty)
+    return ss[i],offset
+
+def sDistance(track,s0,s1):
+    ds = np.abs(s0-s1)%track.raceline_len_m
+    return np.minimum(ds,track.raceline_len_m-ds)
+
+# points on both sides of the start/finish line, s wraps from raceline_len_m to 0 there
+def test_start_finish_line(track,raster):
+    ss = np.linspace(-0.05,0.05,41)%track.raceline_len_m
+    offsets = np.linspace(-0.1,0.1,5)
+    rx,ry = splev(ss,track.raceline_s)
+    tx,ty = splev(ss,track.raceline_s,der=1)
+    x = (rx[:,np.newaxis] - ty[:,np.newaxis]*offsets).flatten()
+    y = (ry[:,np.newaxis] + tx[:,np.newaxis]*offsets).flatten()
+    s,offset,heading = raster.query(x,y)
+    s_exact,offset_exact = exactFrenet(track,x,y)
+    assert np.all((s >= 0) & (s < track.raceline_len_m))
+    assert np.max(sDistance(track,s,s_exact)) < 5e-3
+    assert np.max(np.abs(offset-offset_exact)) < 2e-3
+    assert np.max(np.abs(heading - np.arctan2(ty,tx)[:,np.newaxis].repeat(5,axis=1).flatten())) < 0.05
+
+# across the medial axis between the two closest sections of the raceline neighbouring nodes
+# belong to different sections, the lookup must not blend them into a small offset
+def test_medial_axis(track,raster):
+    ss = np.arange(0,track.raceline_len_m,0.01)
+    points = np.array(splev(ss,track.raceline_s)).T
+    dist = np.linalg.norm(points[:,np.newaxis]-points[np.newaxis],axis=2)
+    ds = sDistance(track,ss[:,np.newaxis],ss[np.newaxis])
+    dist[ds < 1.0] = np.inf
+    i,j = np.unravel_index(np.argmin(dist),dist.shape)
+
+    t = np.linspace(0.3,0.7,401)
+    x = points[i,0] + t*(points[j,0]-points[i,0])
+    y = points[i,1] + t*(points[j,1]-points[i,1])
+    s,offset,_ = raster.query(x,y)
+    s_exact,offset_exact = exactFrenet(track,x,y)
+    # at most one node spacing away from the exact value, even right at the medial axis
+    assert np.max(np.abs(np.abs(offset)-np.abs(offset_exact))) < 2*raster.cell_size
+    # s is on one of the two sections, never in between
+    assert np.all(np.minimum(sDistance(track,s,ss[i]),sDistance(track,s,ss[j])) < 0.2)
@@ -0,0 +1,64 @@
+import numpy as np
+from conftest import porsche_setting,lambo_setting
+
+def makeCars(makeMppiCar,pose):
+    cars = [makeMppiCar(porsche_setting,noise_seed=1),makeMppiCar(lambo_setting,noise_seed=2)]
+    for car in cars:
+        # start every solver from the same zero warm start
+        car.warm_start_library = None
+        car.state = pose
+    return cars
+
+# cars with different max_throttle must not share control limits or noise in a batch
+def test_batch_matches_single_car(makeMppiCar,start_pose):
+    batch_cars = makeCars(makeMppiCar,start_pose)
+    single_cars = makeCars(makeMppiCar,start_pose)
+    assert batch_cars[0].mppiBatchKey() != batch_cars[1].mppiBatchKey()
+
+    from ctrlMppiWrapper import ctrlMppiWrapper
+    batch_rets = ctrlMppiWrapper.ctrlCarBatch(batch_cars)
+    for batch_car,single_car,batch_ret in zip(batch_cars,single_cars,batch_rets):
+        single_ret = single_car.ctrlCar(start_pose,single_car.track)
+        assert batch_ret[2] and single_ret[2]
+        assert np.allclose(batch_ret[:2],single_ret[:2],atol=1e-5)
+        assert np.allclose(batch_car.mppi.old_ref_control,single_car.mppi.old_ref_control,atol=1e-5)
+        limit = batch_car.control_limit
+        assert np.all(batch_car.mppi.old_ref_control >= limit[:,0]-1e-6)
+        assert np.all(batch_car.mppi.old_ref_control <= limit[:,1]+1e-6)
+
+# cars with the same settings are still solved together
+def test_same_setting_shares_batch(makeMppiCar):
+    cars = [makeMppiCar(lambo_setting),makeMppiCar(lambo_setting)]
+    assert cars[0].mppiBatchKey() == cars[1].mppiBatchKey()
+
+# with a process pool, a batch is evaluated in the pool's shared noise slots without a copy
+# and gives the same cost as the in process evaluator
+def test_pool_batch_zero_copy(track,start_pose):
+    from mppi_racecar import MppiRacecarCpu
+    from mppi_pool import MppiRacecarPool
+    from noise_pool import NoisePool
+    from ctrlMppiWrapper import ctrlMppiWrapper
+    car = ctrlMppiWrapper(dict(porsche_setting),0.01)
+    car.init(track)
+    K,T,m = 256,car.horizon_steps,car.control_dim
+    pool = MppiRacecarPool(K,T,m,car.state_dim,car.mppi_dt,car.discretized_raceline,worker_count=2,frenet_raster=car.frenet_raster,slot_count=4)
+    cpu = MppiRacecarCpu(K,T,m,car.state_dim,car.mppi_dt,car.discretized_raceline,frenet_raster=car.frenet_raster)
+    noise_pool = NoisePool(K,T,m,car.noise_cov,seed=0,buffer=pool.epsilon_slots)
+    try:
+        state = car.prepareMppiState(start_pose,track,{})
+        states = np.array([state,state])
+        ref_control = np.zeros((2,T,m),dtype=np.float32)
+        for i in range(3):
+            epsilon = noise_pool.getBatch(2)
+            assert not (pool._slotOffset(epsilon) is None)
+            epsilon_cpu = [eps.copy() for eps in epsilon]
+            cost = pool.evaluateControlSequenceBatch(states,ref_control,car.control_limit,epsilon,[[],[]])
+            cost_cpu = cpu.evaluateControlSequenceBatch(states,ref_control,car.control_limit,epsilon_cpu,[[],[]])
+            assert np.allclose(cost,cost_cpu,rtol=1e-5)
+            # noise is clipped in place in the slots
+            for eps,eps_cpu in zip(epsilon,epsilon_cpu):
+                assert np.array_equal(eps,eps_cpu)
+    finally:
+        noise_pool.close()
+        pool.close()
+        car.close()
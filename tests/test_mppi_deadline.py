@@ -0,0 +1,15 @@
+import numpy as np
+
+# a deadline far shorter than a full solve still gives a usable control from the samples that finished
+def test_tight_deadline_returns_valid_control(makeMppiCar,start_pose):
+    car = makeMppiCar(mppi_deadline=1e-4,noise_seed=0)
+    assert car.mppi.deadline == 1e-4
+    for i in range(5):
+        throttle,steering,valid,debug_dict = car.ctrlCar(start_pose,car.track)
+        assert valid
+        assert np.isfinite(throttle) and np.isfinite(steering)
+        # limits are applied in float32
+        assert car.control_limit[0,0]-1e-6 <= throttle <= car.control_limit[0,1]+1e-6
+        assert car.control_limit[1,0]-1e-6 <= steering <= car.control_limit[1,1]+1e-6
+        # at least one batch is always evaluated, but not all of them
+        assert 0 < car.mppi.samples_evaluated < car.samples_count
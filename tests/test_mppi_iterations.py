@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+# cost of a control sequence from state, as evaluated in rollouts, without noise
+def sequenceCost(car,pose,ref_control):
+    state = car.prepareMppiState(pose,car.track,{})
+    noise = np.zeros((1,car.horizon_steps,car.control_dim),dtype=np.float32)
+    return car.mppi.cpu_evaluator.evaluateControlSequence(state,ref_control,car.control_limit,noise,[])[0]
+
+def solve(makeMppiCar,pose,**kwargs):
+    car = makeMppiCar(noise_seed=0,**kwargs)
+    # start every solver from the same zero warm start
+    car.warm_start_library = None
+    car.ctrlCar(pose,car.track)
+    return car,sequenceCost(car,pose,car.mppi.old_ref_control)
+
+@pytest.mark.parametrize('elite_fraction',[None,0.1])
+def test_refinement_does_not_increase_cost(makeMppiCar,start_pose,elite_fraction):
+    _,plain_cost = solve(makeMppiCar,start_pose)
+    car,refined_cost = solve(makeMppiCar,start_pose,mppi_iterations=4,mppi_elite_fraction=elite_fraction)
+    assert car.mppi.iterations == 4
+    assert car.mppi.elite_fraction == elite_fraction
+    # mean sample cost of each round is no higher than the one before
+    costs = car.mppi.iteration_costs
+    assert len(costs) == 4
+    assert all(b <= a for a,b in zip(costs[:-1],costs[1:]))
+    # and the synthesized sequence is no worse than plain mppi under the same sample budget
+    assert refined_cost <= plain_cost
@@ -0,0 +1,105 @@
+# MppiRacecarCpu against a per sample reference of evaluate_control_sequence() in mppi_racecar.cu
+# one sample and one step at a time, same structure as the kernel
+from math import atan,cos,sin,sqrt,tan
+
+import numpy as np
+import pytest
+
+from mppi_racecar import MppiRacecarCpu,COLLISION_RADIUS,COLLISION_WINDOW
+
+SAMPLES = 64
+
+def forwardKinematics(x,u,dt):
+    dx,dy,psi = x[1],x[3],x[4]
+    throttle,steering = u
+    local_dx = dx*cos(-psi) - dy*sin(-psi)
+    local_dy = dx*sin(-psi) + dy*cos(-psi)
+    beta = atan(0.036/0.102*tan(steering))
+    local_dx += (throttle - 0.24)*7.0*dt
+    local_dx = max(local_dx,0.0)
+    local_dy = sqrt(local_dx*local_dx + local_dy*local_dy)*sin(beta)
+    local_dy += -0.68*local_dx*steering
+    dpsi = local_dx/0.102*tan(steering)
+    dx = local_dx*cos(psi) - local_dy*sin(psi)
+    dy = local_dx*sin(psi) + local_dy*cos(psi)
+    x[0] += dx*dt
+    x[1] = dx
+    x[2] += dy*dt
+    x[3] = dy
+    x[4] += dpsi*dt
+    x[5] = dpsi
+
+def stepCost(x,raceline):
+    # exhaustive find_closest_id()
+    dist2 = (x[0]-raceline[:,0])**2 + (x[2]-raceline[:,1])**2
+    idx = int(np.argmin(dist2))
+    dv = sqrt(x[1]*x[1] + x[3]*x[3]) - raceline[idx,3]
+    return (sqrt(dist2[idx]) + 0.1*dv*dv)*5.0
+
+def collisionCost(x,opponent_pos):
+    dist = sqrt((x[0]-opponent_pos[0])**2 + (x[2]-opponent_pos[1])**2)
+    return max((COLLISION_RADIUS - dist)*5.0,0.0)
+
+# return: cost, collision part of the cost and clipped epsilon of every sample
+def referenceCost(x0,ref_control,limits,epsilon,opponents_prediction,raceline,dt):
+    T = ref_control.shape[0]
+    epsilon = epsilon.astype(np.float64)
+    cost = np.zeros(epsilon.shape[0])
+    collision = np.zeros(epsilon.shape[0])
+    for k in range(epsilon.shape[0]):
+        x = list(x0)
+        for i in range(T):
+            u = np.clip(ref_control[i] + epsilon[k,i],limits[:,0],limits[:,1])
+            epsilon[k,i] = u - ref_control[i]
+            forwardKinematics(x,u,dt)
+            cost[k] += stepCost(x,raceline)
+            k0 = max(i+1-COLLISION_WINDOW,0)
+            k1 = min(i+1+COLLISION_WINDOW,T)
+            for opponent in opponents_prediction:
+                for j in range(k0,k1+1):
+                    collision[k] += collisionCost(x,opponent[j])
+        # terminal cost is ignored in the kernel
+        cost[k] += collision[k] + 0.0
+    return cost,collision,epsilon
+
+@pytest.fixture
+def setup(makeMppiCar,start_pose):
+    car = makeMppiCar()
+    state = car.prepareMppiState(start_pose,car.track,{}).astype(np.float64)
+    rng = np.random.default_rng(0)
+    T,m = car.horizon_steps,car.control_dim
+    ref_control = np.zeros((T,m),dtype=np.float32)
+    ref_control[:,0] = 0.4
+    # wide enough that some samples are clipped at the limits
+    epsilon = (rng.standard_normal((SAMPLES,T,m))*np.array([0.4,0.6])).astype(np.float32)
+    # two stationary opponents on the path ahead, one far away
+    heading = state[4]
+    ahead = lambda d: (state[0]+d*cos(heading),state[2]+d*sin(heading))
+    opponents = np.array([[ahead(0.15)]*(T+1),[ahead(0.3)]*(T+1),[(100.0,100.0)]*(T+1)],dtype=np.float32)
+    return car,state,ref_control,epsilon,opponents
+
+def test_cost_matches_reference(setup):
+    car,state,ref_control,epsilon,opponents = setup
+    limits = np.array(car.control_limit,dtype=np.float32)
+    raceline = np.array(car.discretized_raceline,dtype=np.float32).reshape(-1,4)
+    evaluator = MppiRacecarCpu(SAMPLES,car.horizon_steps,car.control_dim,car.state_dim,car.mppi_dt,raceline)
+
+    cost_ref,collision_ref,epsilon_ref = referenceCost(state,ref_control,limits.astype(np.float64),epsilon,opponents,raceline.astype(np.float64),float(np.float32(car.mppi_dt)))
+    epsilon_cpu = epsilon.copy()
+    cost = evaluator.evaluateControlSequence(state,ref_control,limits,epsilon_cpu,opponents)
+
+    # epsilon is clipped in place the same way
+    assert np.allclose(epsilon_cpu,epsilon_ref,atol=1e-6)
+    assert np.any(epsilon_cpu != epsilon)
+    # some samples hit an opponent, so collision cost is covered
+    assert np.count_nonzero(collision_ref) > 0
+    assert np.allclose(evaluator.last_collision_cost,collision_ref,rtol=1e-3,atol=1e-3)
+    # float32 rollouts against float64 reference
+    assert np.allclose(cost,cost_ref,rtol=1e-5,atol=1e-3)
+
+def test_terminal_cost_is_zero(setup):
+    car,state,_,_,_ = setup
+    raceline = np.array(car.discretized_raceline,dtype=np.float32).reshape(-1,4)
+    evaluator = MppiRacecarCpu(SAMPLES,car.horizon_steps,car.control_dim,car.state_dim,car.mppi_dt,raceline)
+    x = np.tile(state.astype(np.float32),(1,SAMPLES,1))
+    assert np.array_equal(evaluator.evaluateTerminalCost(x,x),np.zeros((1,SAMPLES),dtype=np.float32))
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+
+from noise_pool import NoisePool
+
+K,T,M = 4096,10,2
+
+def waitFilled(pool,timeout=10.0):
+    t_end = time.time() + timeout
+    while not all(pool.filled):
+        assert time.time() < t_end
+        time.sleep(0.001)
+
+def test_same_seed_same_noise():
+    cov = np.diag([0.1,0.2])
+    for threaded in (True,False):
+        a = NoisePool(K,T,M,cov,seed=7,threaded=threaded)
+        b = NoisePool(K,T,M,cov,seed=7,threaded=threaded)
+        c = NoisePool(K,T,M,cov,seed=8,threaded=threaded)
+        # more calls than slots, so the ring buffer wraps
+        for i in range(6):
+            noise_a = a.get()
+            noise_b = b.get()
+            noise_c = c.get()
+            assert np.array_equal(noise_a,noise_b)
+            assert not np.array_equal(noise_a,noise_c)
+        for pool in (a,b,c):
+            pool.close()
+
+def test_covariance():
+    cov = np.array([[0.09,0.02],[0.02,0.04]])
+    pool = NoisePool(K,T,M,cov,seed=0)
+    noise = pool.get().reshape(-1,M)
+    assert np.allclose(np.cov(noise.T),cov,atol=3e-3)
+    pool.close()
+
+def test_rescale_keeps_requested_covariance():
+    cov = np.diag([0.25,0.01])
+    new_cov = np.array([[0.04,-0.01],[-0.01,0.09]])
+    pool = NoisePool(K,T,M,cov,seed=0)
+    # every slot is generated with the old covariance before it changes
+    waitFilled(pool)
+    for i in range(pool.slot_count):
+        noise = pool.get(noise_cov=new_cov).reshape(-1,M)
+        assert np.allclose(np.cov(noise.T),new_cov,atol=3e-3)
+    pool.close()
+
+# rescaling a slot gives the same noise as generating it with the new covariance in the first place
+def test_rescale_matches_direct_generation():
+    cov = np.diag([0.25,0.01])
+    new_cov = np.array([[0.04,-0.01],[-0.01,0.09]])
+    rescaled = NoisePool(K,T,M,cov,seed=3)
+    waitFilled(rescaled)
+    direct = NoisePool(K,T,M,new_cov,seed=3,threaded=False)
+    assert np.allclose(rescaled.get(noise_cov=new_cov),direct.get(),atol=1e-5)
+    rescaled.close()
+    direct.close()
+
+# getBatch() hands out the same sequence as get(), every slot of a batch stays valid until the next call
+def test_get_batch_same_sequence():
+    cov = np.diag([0.1,0.2])
+    for threaded in (True,False):
+        a = NoisePool(K,T,M,cov,seed=3,threaded=threaded)
+        b = NoisePool(K,T,M,cov,seed=3,threaded=threaded)
+        for count in (3,1,4,2):
+            expected = [a.get().copy() for i in range(count)]
+            batch = b.getBatch(count)
+            assert len(batch) == count
+            for noise in batch:
+                assert np.may_share_memory(noise,b.buffer)
+            for noise,noise_expected in zip(batch,expected):
+                assert np.array_equal(noise,noise_expected)
+        for pool in (a,b):
+            pool.close()
@@ -0,0 +1,60 @@
+# predictOpponentBatch() searches near each opponent's last u, as localTrajectory() does with track.last_u
+# without it an opponent between two close sections of the raceline snaps to whichever is nearer
+import numpy as np
+from scipy.interpolate import splev
+
+# (u_a,u_b) of two points on different sections of the raceline that are closest to each other
+def closeSections(track):
+    uu = np.linspace(0,track.track_length_grid,1000,endpoint=False)
+    points = np.array(splev(uu,track.raceline)).T
+    s = track.raceline_table.uToS(uu)
+    dist = np.linalg.norm(points[:,np.newaxis]-points[np.newaxis],axis=2)
+    ds = np.abs(s[:,np.newaxis]-s[np.newaxis])
+    dist[np.minimum(ds,track.raceline_len_m-ds) < 1.0] = np.inf
+    i,j = np.unravel_index(np.argmin(dist),dist.shape)
+    return uu[i],uu[j]
+
+def uDistance(track,u_a,u_b):
+    du = abs(u_a-u_b) % track.track_length_grid
+    return min(du,track.track_length_grid-du)
+
+# pose on section a that has drifted towards section b, past the midpoint, heading along section a
+def driftedState(track,u_a,u_b):
+    a = np.array(splev(u_a,track.raceline)).ravel()
+    b = np.array(splev(u_b,track.raceline)).ravel()
+    dx,dy = splev(u_a,track.raceline,der=1)
+    heading = np.arctan2(dy,dx)
+    # the projection uses a point wheelbase/2 ahead of the pose
+    coord = a + 0.6*(b-a) - 0.102/2.0*np.array([np.cos(heading),np.sin(heading)])
+    return np.array([[coord[0],coord[1],heading]])
+
+def test_u_guess_keeps_section(track):
+    u_a,u_b = closeSections(track)
+    states = driftedState(track,u_a,u_b)
+
+    _,u_global = track.predictOpponentBatch(states,20,0.03,return_u=True)
+    assert uDistance(track,u_global[0],u_b) < uDistance(track,u_global[0],u_a)
+    traj,u_local = track.predictOpponentBatch(states,20,0.03,u_guess=[u_a],return_u=True)
+    assert uDistance(track,u_local[0],u_a) < 0.6
+    assert traj.shape == (1,21,2)
+
+# the wrapper passes each opponent's u from the previous step
+def test_wrapper_tracks_opponent_u(makeMppiCar,track):
+    from types import SimpleNamespace
+    car = makeMppiCar()
+    # predictOpponent() only reads opponent.state
+    opponent = SimpleNamespace(state=None)
+    car.opponents = [opponent]
+    u_a,u_b = closeSections(track)
+    # opponent drives along section a, then drifts towards section b
+    for u in np.linspace(u_a-1.0,u_a,6):
+        x,y = splev(u%track.track_length_grid,track.raceline)
+        dx,dy = splev(u%track.track_length_grid,track.raceline,der=1)
+        opponent.state = (float(x),float(y),float(np.arctan2(dy,dx)),1.0,0,0)
+        car.predictOpponent()
+        assert uDistance(track,car.opponent_u[id(opponent)],u) < 0.3
+    states = driftedState(track,u_a,u_b)
+    opponent.state = tuple(states[0])+(1.0,0,0)
+    car.predictOpponent()
+    assert uDistance(track,car.opponent_u[id(opponent)],u_a) < 0.6
+    assert car.opponent_prediction[0].shape == (car.horizon_steps+1,2)
@@ -0,0 +1,76 @@
+# sparse QP of QpSmooth.optimizePath() against the dense per break point assembly it replaced
+import numpy as np
+import pytest
+
+cvxopt = pytest.importorskip('cvxopt')
+
+BREAK_POINTS = 48
+DELTA_MAX = 5e-2
+
+@pytest.fixture(scope='module')
+def qp():
+    from qpSmooth import QpSmooth
+    qp = QpSmooth()
+    qp.prepareTrack()
+    qp.break_pts = np.array(qp.ctrl_pts)
+    qp.resamplePath(BREAK_POINTS)
+    qp.P = qp.bezierSpline(qp.break_pts)
+    qp.u_max = len(qp.break_pts)
+    qp.raceline_fun = lambda u: qp.evalBezierSpline(qp.P,u)
+    return qp
+
+# the removed implementation of curvatureJac(), one break point at a time with dense matrices
+def denseCurvatureJac(qp):
+    break_pts = np.array(qp.break_pts).T
+    N = qp.u_max
+    A = np.array([[0,-1],[1,0]])
+    fun = lambda x: qp.raceline_fun(x).flatten()
+    ds = [qp.arcLen(fun,i,i+1) for i in range(N)]
+
+    dr_vec,ddr_vec,alfa_vec,beta_vec,n_vec = [],[],[],[],[]
+    for i in range(N):
+        rl,r,rr = break_pts[:,(i-1)%N],break_pts[:,i],break_pts[:,(i+1)%N]
+        ((al,a,ar),(bl,b,br)) = qp.lagrangeDer([rl,r,rr],ds=(ds[(i-1)%N],ds[i]))
+        dr_vec.append(al*rl + a*r + ar*rr)
+        ddr_vec.append(bl*rl + b*r + br*rr)
+        alfa_vec.append([al,a,ar])
+        beta_vec.append([bl,b,br])
+        n_vec.append(A @ dr_vec[i])
+
+    K = np.zeros((N,1))
+    C = np.zeros((N,N))
+    for i in range(N):
+        K[i,0] = np.dot(A @ dr_vec[i],ddr_vec[i])
+        C[i,(i-1)%N] = np.dot(A @ dr_vec[i],beta_vec[i][0]*n_vec[(i-1)%N]) + np.dot(ddr_vec[i],alfa_vec[i][0]*A @ n_vec[(i-1)%N])
+        C[i,i] = beta_vec[i][1] + np.dot(ddr_vec[i],alfa_vec[i][1]*A @ n_vec[i])
+        C[i,(i+1)%N] = np.dot(A @ dr_vec[i],beta_vec[i][2]*n_vec[(i+1)%N]) + np.dot(ddr_vec[i],alfa_vec[i][2]*A @ n_vec[(i+1)%N])
+    Ds = 0.5*np.diag(np.hstack([ds[0],np.array(ds[:-2])+np.array(ds[1:-1]),ds[-1]]))
+    return K,C,Ds
+
+def test_sparse_assembly_matches_dense(qp):
+    K,C,Ds = qp.curvatureJac()
+    P_qp,q_qp,G,h = qp.assembleQp(K,C,Ds,DELTA_MAX)
+    N = qp.u_max
+
+    K_dense,C_dense,Ds_dense = denseCurvatureJac(qp)
+    assert np.allclose(K,K_dense,rtol=1e-9,atol=1e-12)
+    assert np.allclose(C.toarray(),C_dense,rtol=1e-9,atol=1e-12)
+    assert np.allclose(Ds.toarray(),Ds_dense,rtol=1e-9,atol=1e-12)
+
+    P_dense = 2*C_dense.T @ Ds_dense @ C_dense
+    q_dense = np.transpose(K_dense.T @ Ds_dense @ C_dense + K_dense.T @ Ds_dense @ C_dense)
+    G_dense = np.vstack([np.identity(N),-np.identity(N),C_dense,-C_dense])
+    assert np.allclose(P_qp.toarray(),P_dense,rtol=1e-9,atol=1e-12)
+    assert np.allclose(q_qp,q_dense,rtol=1e-9,atol=1e-12)
+    assert np.allclose(G.toarray(),G_dense,rtol=1e-9,atol=1e-12)
+    # boundary rows of h are compared with the scalar version in test_qp_boundary.py
+    Rmin = 0.102/np.tan(np.radians(18))
+    assert np.allclose(h[2*N:],np.hstack([1.0/Rmin-K_dense.flatten(),K_dense.flatten()+1.0/Rmin]))
+
+    # both forms of the problem have the same solution
+    from qpSmooth import toCvxoptSparse
+    cvxopt.solvers.options['show_progress'] = False
+    sol = cvxopt.solvers.qp(toCvxoptSparse(P_qp),cvxopt.matrix(q_qp),toCvxoptSparse(G),cvxopt.matrix(h))
+    sol_dense = cvxopt.solvers.qp(cvxopt.matrix(P_dense),cvxopt.matrix(q_dense),cvxopt.matrix(G_dense),cvxopt.matrix(h))
+    assert sol['status'] == 'optimal' and sol_dense['status'] == 'optimal'
+    assert np.allclose(np.array(sol['x']),np.array(sol_dense['x']),atol=1e-6)
@@ -0,0 +1,79 @@
+# QpSmooth.checkTrackBoundaryBatch() against the scalar checkTrackBoundary()
+# on turn tiles the batch version uses the radial direction at each point instead of the tile's 45 degree diagonal
+import numpy as np
+import pytest
+
+pytest.importorskip('cvxopt')
+
+DEADZONE = 0.087*3.0
+DELTA_MAX = 10.0
+APEX = {'SE':(1,0),'SW':(0,0),'NE':(1,1),'NW':(0,1)}
+
+@pytest.fixture(scope='module')
+def qp():
+    from qpSmooth import QpSmooth
+    qp = QpSmooth()
+    qp.prepareTrack()
+    return qp
+
+def tiles(qp,types):
+    return [(i,j) for i in range(len(qp.track)) for j in range(len(qp.track[0])) if qp.track[i][j] in types]
+
+# random normal directions with neither component close to zero
+def randomNormals(rng,count):
+    angle = rng.uniform(0,2*np.pi,count)
+    n = np.vstack([np.cos(angle),np.sin(angle)]).T*rng.uniform(0.5,2.0,(count,1))
+    n[np.abs(n) < 0.05] = 0.05
+    return n
+
+def scalarBoundary(qp,coords,n):
+    return np.array([qp.checkTrackBoundary(coord,normal,DELTA_MAX) for coord,normal in zip(coords,n)]).T
+
+def test_straight_tiles_match(qp):
+    rng = np.random.default_rng(0)
+    coords = []
+    for i,j in tiles(qp,['WE','NS']):
+        local = rng.uniform(DEADZONE+0.01,1-DEADZONE-0.01,(5,2))
+        coords.append((local+(i,j))*qp.scale)
+    coords = np.vstack(coords)
+    n = randomNormals(rng,coords.shape[0])
+    F,R = qp.checkTrackBoundaryBatch(coords,n,DELTA_MAX)
+    F_ref,R_ref = scalarBoundary(qp,coords,n)
+    assert np.allclose(F,F_ref,rtol=1e-9,atol=1e-12)
+    assert np.allclose(R,R_ref,rtol=1e-9,atol=1e-12)
+
+def test_turn_tiles_match_on_diagonal(qp):
+    rng = np.random.default_rng(1)
+    coords = []
+    for i,j in tiles(qp,APEX.keys()):
+        apex = np.array(APEX[qp.track[i][j]],dtype=np.float64)
+        # from the apex towards the opposite corner
+        diagonal = (np.array([0.5,0.5])-apex)*2**0.5
+        radius = rng.uniform(DEADZONE+0.01,1-DEADZONE-0.01,5)
+        local = apex + radius[:,np.newaxis]*diagonal
+        coords.append((local+(i,j))*qp.scale)
+    coords = np.vstack(coords)
+    n = randomNormals(rng,coords.shape[0])
+    F,R = qp.checkTrackBoundaryBatch(coords,n,DELTA_MAX)
+    F_ref,R_ref = scalarBoundary(qp,coords,n)
+    assert np.allclose(F,F_ref,rtol=1e-9,atol=1e-12)
+    assert np.allclose(R,R_ref,rtol=1e-9,atol=1e-12)
+
+# off the diagonal, moving radially reaches the arcs after exactly the radial clearance
+# the scalar version divides by the cosine between radial direction and diagonal
+def test_turn_tiles_radial_off_diagonal(qp):
+    rng = np.random.default_rng(2)
+    for i,j in tiles(qp,APEX.keys()):
+        apex = np.array(APEX[qp.track[i][j]],dtype=np.float64)
+        diagonal_angle = np.arctan2(*(np.array([0.5,0.5])-apex)[::-1])
+        angle = diagonal_angle + rng.uniform(0.2,0.6)*rng.choice([-1,1])
+        radial = np.array([np.cos(angle),np.sin(angle)])
+        radius = rng.uniform(DEADZONE+0.05,1-DEADZONE-0.05)
+        coord = (apex + radius*radial + (i,j))*qp.scale
+        F,R = qp.checkTrackBoundaryBatch(coord[np.newaxis],radial[np.newaxis],DELTA_MAX)
+        assert np.isclose(F[0],(1-DEADZONE-radius)*qp.scale)
+        assert np.isclose(R[0],(radius-DEADZONE)*qp.scale)
+        F_ref,R_ref = qp.checkTrackBoundary(coord,radial,DELTA_MAX)
+        cos_val = np.cos(angle-diagonal_angle)
+        assert np.isclose(F_ref,F[0]/cos_val)
+        assert np.isclose(R_ref,R[0]/cos_val)
@@ -0,0 +1,72 @@
+# RacelineIndex.query must return the same index as a brute force argmin over all raceline points
+import numpy as np
+import pytest
+from scipy.interpolate import splev
+
+from raceline_index import RacelineIndex
+
+# discretized raceline as in ctrlMppiWrapper.prepareDiscretizedRaceline()
+# first and last point coincide at the lap seam
+@pytest.fixture(scope='module')
+def points(track):
+    ss = np.linspace(0,track.raceline_len_m,1024)
+    return np.array(splev(ss%track.raceline_len_m,track.raceline_s)).T
+
+def bruteForce(points,x,y):
+    px = points[:,0].astype(np.float32)
+    py = points[:,1].astype(np.float32)
+    dx = x[:,np.newaxis] - px
+    dy = y[:,np.newaxis] - py
+    dist2 = dx*dx + dy*dy
+    idx = np.argmin(dist2,axis=1)
+    return idx,np.sqrt(dist2[np.arange(x.shape[0]),idx])
+
+def checkQuery(index,points,x,y):
+    idx,dist = index.query(x,y)
+    ref_idx,ref_dist = bruteForce(points,x,y)
+    assert np.array_equal(idx,ref_idx)
+    assert np.allclose(dist,ref_dist,rtol=0,atol=1e-6)
+
+def test_random_points(points):
+    index = RacelineIndex(points)
+    rng = np.random.default_rng(0)
+    lo = points.min(axis=0) - 0.3
+    hi = points.max(axis=0) + 0.3
+    xy = rng.uniform(lo,hi,(20000,2))
+    checkQuery(index,points,xy[:,0],xy[:,1])
+
+def test_near_seam(points):
+    index = RacelineIndex(points)
+    rng = np.random.default_rng(1)
+    # around the first and last few points, including the duplicated seam point itself
+    base = np.vstack([points[:5],points[-5:]])
+    xy = (base[:,np.newaxis,:] + rng.normal(0,0.03,(base.shape[0],200,2))).reshape(-1,2)
+    xy = np.vstack([xy,points[[0,-1]]])
+    checkQuery(index,points,xy[:,0],xy[:,1])
+    # ties resolve to the smallest index, same as argmin
+    idx,_ = index.query(points[-1,0],points[-1,1])
+    assert idx == 0
+
+def test_outside_grid(points):
+    index = RacelineIndex(points,margin=0.5)
+    lo = points.min(axis=0)
+    hi = points.max(axis=0)
+    # beyond the grid margin on every side, and a mix of inside and outside in one call
+    x = np.array([lo[0]-2.0,hi[0]+2.0,(lo[0]+hi[0])/2,(lo[0]+hi[0])/2,lo[0]-10.0,(lo[0]+hi[0])/2])
+    y = np.array([(lo[1]+hi[1])/2,(lo[1]+hi[1])/2,lo[1]-2.0,hi[1]+2.0,hi[1]+10.0,(lo[1]+hi[1])/2])
+    checkQuery(index,points,x,y)
+
+def test_shape_and_dtype(points):
+    index = RacelineIndex(points)
+    rng = np.random.default_rng(2)
+    lo = points.min(axis=0)
+    hi = points.max(axis=0)
+    # (K,T) float32 rollouts, as in mppi
+    xy = rng.uniform(lo,hi,(64,10,2)).astype(np.float32)
+    idx,dist = index.query(xy[...,0],xy[...,1])
+    assert idx.shape == (64,10) and dist.shape == (64,10)
+    ref_idx,_ = bruteForce(points,xy[...,0].ravel(),xy[...,1].ravel())
+    assert np.array_equal(idx.ravel(),ref_idx)
+    # scalar query
+    idx,dist = index.query(float(xy[0,0,0]),float(xy[0,0,1]))
+    assert idx.ndim == 0
@@ -0,0 +1,64 @@
+# RacelineTable replaced interp1d (cubic) conversions and per call splev evaluation in RCPtrack
+# the tables interpolate linearly between samples, these tests bound the difference to what they replaced
+import numpy as np
+import pytest
+from scipy.interpolate import interp1d,splev
+
+# u,s samples as in RCPtrack.reconstructRaceline(), which the interp1d conversions were built on
+def referenceSamples(track):
+    uu = np.linspace(0,track.track_length_grid,1001)
+    rr = splev(uu,track.raceline)
+    ss = np.concatenate([[0],np.cumsum(np.linalg.norm(np.diff(np.array(rr),axis=1),axis=0))])
+    return uu,ss
+
+@pytest.fixture(scope='module')
+def queries(track):
+    rng = np.random.default_rng(0)
+    uq = rng.uniform(0,track.track_length_grid,5000)
+    sq = rng.uniform(0,track.raceline_len_m,5000)
+    return uq,sq
+
+def test_conversions_match_interp1d(track,queries):
+    table = track.raceline_table
+    uq,sq = queries
+    uu,ss = referenceSamples(track)
+    vv = track.targetVfromU(uu)
+    # s in meter, u in grid, v in m/s
+    assert np.max(np.abs(table.uToS(uq) - interp1d(uu,ss,kind='cubic')(uq))) < 2e-5
+    assert np.max(np.abs(table.sToU(sq) - interp1d(ss,uu,kind='cubic')(sq))) < 5e-5
+    assert np.max(np.abs(table.sToV(sq) - interp1d(ss,vv,kind='cubic')(sq))) < 1e-3
+    assert np.max(np.abs(table.uToV(uq) - track.targetVfromU(uq))) < 1e-3
+
+def test_geometry_matches_spline(track,queries):
+    table = track.raceline_table
+    _,sq = queries
+    x,y = splev(sq,track.raceline_s)
+    dr = np.array(splev(sq,track.raceline_s,der=1))
+    ddr = np.array(splev(sq,track.raceline_s,der=2))
+    heading = np.arctan2(dr[1],dr[0])
+    curvature = (dr[0]*ddr[1]-dr[1]*ddr[0])/np.linalg.norm(dr,axis=0)**3
+
+    point = table.sToPoint(sq)
+    assert np.max(np.hypot(point[:,0]-x,point[:,1]-y)) < 2e-5
+    assert np.max(np.abs((table.sToHeading(sq) - heading + np.pi)%(2*np.pi) - np.pi)) < 5e-4
+    # curvature has kinks at spline knots that linear interpolation rounds off, peak curvature here is ~20 1/m
+    assert np.max(np.abs(table.sToCurvature(sq) - curvature)) < 0.1
+
+def test_scalar_and_wrap(track,queries):
+    table = track.raceline_table
+    uq,sq = queries
+    # scalar fast path agrees with the array path
+    for u,s in zip(uq[:100],sq[:100]):
+        assert table.uToS(float(u)) == table.uToS(np.array([u]))[0]
+        assert table.sToHeading(float(s)) == pytest.approx(table.sToHeading(np.array([s]))[0],abs=1e-12)
+    # inputs outside one lap wrap around
+    assert table.uToS(track.track_length_grid+0.3) == pytest.approx(table.uToS(0.3),abs=1e-9)
+    assert table.sToU(-0.2) == pytest.approx(table.sToU(track.raceline_len_m-0.2),abs=1e-9)
+
+def test_out_argument(track,queries):
+    table = track.raceline_table
+    _,sq = queries
+    out = np.empty(sq.shape)
+    ret = table.sToV(sq,out=out)
+    assert ret is out
+    assert np.array_equal(out,table.sToV(sq))
@@ -0,0 +1,51 @@
+# a track loaded from its cached artifact must behave the same as one built from the track file
+import numpy as np
+
+from RCPTrack import RCPtrack
+from trackArtifact import MAGIC,artifactFilename
+
+def test_artifact_roundtrip(track,tmp_path):
+    filename = str(tmp_path/"raceline.p")
+    track.save(filename)
+    fresh = RCPtrack()
+    fresh.load(filename)
+    cached = RCPtrack()
+    cached.load(filename)
+
+    # header length is little endian regardless of platform
+    with open(artifactFilename(filename),'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+        header_len = int.from_bytes(f.read(4),'little')
+    assert 0 < header_len < 1<<20
+
+    uu = np.linspace(0,fresh.track_length_grid,2001)
+    assert np.array_equal(fresh.targetVfromU(uu),cached.targetVfromU(uu))
+    ss = np.linspace(0,fresh.raceline_len_m,2001)
+    assert np.array_equal(fresh.sToU(ss),cached.sToU(ss))
+    assert np.array_equal(fresh.sToV(ss),cached.sToV(ss))
+
+    state = (2.1,1.05,np.pi/2,1.0,0,0)
+    assert np.allclose(fresh.localTrajectory(state,return_u=True)[1:],cached.localTrajectory(state,return_u=True)[1:],rtol=0,atol=1e-12)
+
+# a cache hit builds nothing with scipy, target velocity comes from the raceline table
+# and the boundary raster is read from the artifact
+def test_artifact_derived_tables(track,tmp_path):
+    filename = str(tmp_path/"raceline.p")
+    track.save(filename)
+    fresh = RCPtrack()
+    fresh.load(filename)
+    cached = RCPtrack()
+    cached.load(filename)
+
+    assert cached.targetVfromU == cached.raceline_table.uToV
+    # the table is sampled densely enough to follow the cubic speed profile of the built track
+    uu = np.linspace(0,track.track_length_grid,2001)[:-1]
+    assert np.allclose(cached.targetVfromU(uu),track.targetVfromU(uu),atol=1e-3)
+
+    assert cached.boundary_tiles_track is cached.track
+    kind,apex = cached.boundary_tiles
+    fresh.prepareBoundaryTiles()
+    assert np.array_equal(kind,fresh.boundary_tiles[0])
+    assert np.array_equal(apex,fresh.boundary_tiles[1])
+    coords = np.random.default_rng(0).uniform(0,1,(200,2))*np.array(fresh.gridsize[::-1])*fresh.scale
+    assert np.array_equal(cached.trackBoundaryClearance(coords)[0],fresh.trackBoundaryClearance(coords)[0])
@@ -0,0 +1,83 @@
+# localTrajectory() projects the front axle onto the raceline with a table search plus newton refinement
+# it used to fit a cubic to five samples of the squared distance and minimize that with L-BFGS-B
+# the two don't give identical results, the cubic fit is off by up to several cm where the raceline curves
+# these tests pin the new projection to the exact local minimum and bound its difference to the old fit
+from math import atan2,cos,pi,sin
+
+import numpy as np
+import pytest
+from scipy.interpolate import splev
+from scipy.optimize import minimize
+
+WHEELBASE = 0.051
+
+# poses along the raceline with random lateral offset and heading error, in driving order
+def samplePoses(track,count=400,max_offset=0.15,max_heading_error=0.3,seed=0):
+    rng = np.random.default_rng(seed)
+    poses = []
+    for u in np.linspace(0,track.track_length_grid,count,endpoint=False):
+        x,y = splev(u,track.raceline)
+        dx,dy = splev(u,track.raceline,der=1)
+        norm = (dx*dx+dy*dy)**0.5
+        offset = rng.uniform(-max_offset,max_offset)
+        heading = atan2(dy,dx) + rng.uniform(-max_heading_error,max_heading_error)
+        # pose of rear axle such that front axle sits at the offset point
+        px = x - dy/norm*offset - WHEELBASE*cos(heading)
+        py = y + dx/norm*offset - WHEELBASE*sin(heading)
+        poses.append((px,py,heading,1.0,0,0))
+    return poses
+
+def frontAxle(pose):
+    return np.array([pose[0]+WHEELBASE*cos(pose[2]),pose[1]+WHEELBASE*sin(pose[2])])
+
+# the removed implementation: cubic fit of squared distance at seq +- 0.6, minimized with L-BFGS-B
+def legacyProjection(track,coord,seq):
+    fun = lambda u: np.sum((np.array(splev(u%track.track_length_grid,track.raceline)).T-coord)**2,axis=-1)
+    iv = np.array([-0.6,-0.3,0,0.3,0.6])+seq
+    A = np.vstack([iv**3,iv**2,iv,np.ones(5)]).T
+    a,b,c,d = np.linalg.lstsq(A,fun(iv),rcond=-1)[0]
+    fit = minimize(lambda x: a*x*x*x + b*x*x + c*x + d,x0=seq,method='L-BFGS-B',bounds=((seq-0.6,seq+0.6),))
+    return fit.x[0]
+
+@pytest.fixture(scope='module')
+def projections(track):
+    track.last_u = None
+    results = []
+    for pose in samplePoses(track):
+        retval = track.localTrajectory(pose,wheelbase=WHEELBASE,return_u=True)
+        results.append((pose,track.debug['seq'],retval))
+    return results
+
+def test_projection_is_exact_local_minimum(track,projections):
+    for pose,seq,(point,offset,heading,curvature,v_target,u) in projections:
+        coord = frontAxle(pose)
+        exact_point = np.array(splev(u,track.raceline)).ravel()
+        tangent = np.array(splev(u,track.raceline,der=1)).ravel()
+        tangent /= np.linalg.norm(tangent)
+        # point and heading agree with the spline at u
+        assert np.allclose(point,exact_point,atol=1e-9)
+        assert abs((heading - atan2(tangent[1],tangent[0]) + pi)%(2*pi) - pi) < 1e-9
+        # offset vector is perpendicular to the raceline, i.e. u is a stationary point of the distance
+        assert abs(np.dot(coord-exact_point,tangent)) < 1e-5
+        assert abs(abs(offset) - np.linalg.norm(coord-exact_point)) < 1e-9
+
+def test_projection_close_to_legacy_fit(track,projections):
+    L = track.track_length_grid
+    du = []
+    doffset = []
+    for pose,seq,(point,offset,heading,curvature,v_target,u) in projections:
+        coord = frontAxle(pose)
+        u_legacy = legacyProjection(track,coord,seq)
+        du.append(abs((u - u_legacy + L/2)%L - L/2))
+        legacy_dist = np.linalg.norm(coord - np.array(splev(u_legacy%L,track.raceline)).ravel())
+        doffset.append(legacy_dist - abs(offset))
+    du = np.array(du)
+    doffset = np.array(doffset)
+    # new projection is never farther from the car than the legacy one
+    assert np.all(doffset > -1e-6)
+    # typical difference is well under the legacy fit's own error
+    assert np.median(du) < 0.01
+    assert np.median(doffset) < 1e-3
+    # worst case is where the cubic fit is poor, tight turns
+    assert np.max(du) < 0.4
+    assert np.max(doffset) < 0.1